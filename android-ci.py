@@ -21,14 +21,16 @@ class AndroidBuild(LinaroCIJob):
             ["machine type x86_64",
              "memory 8GB",
              "cpus %d" % (cpus),
-             "OS Ubuntu 12.04"]
+             "OS Ubuntu 12.04",
+             # Prefer a machine that has checked this out before
+             "repo " + config["check out"]["repo"]]
         )
 
         self.x86_64.chdir("dev")
         self.x86_64.in_directory("android")
         base_directory = self.x86_64.cwd()
 
-        self.x86_64.install_deps(["repo", "gcc", "git"])
+        self.x86_64.install_deps(["repo", "gcc", "git", "pbzip2"])
         self.source = self.x86_64.checkout("repo",
                                            config["check out"]["repo"],
                                            config["check out"]["branch"],
@@ -52,17 +54,22 @@ class AndroidBuild(LinaroCIJob):
         self.android_build = self.x86_64.build(
             # Until self.x86_64.build is refined and correctly implemented,
             # just specify the full command
-            build_command="make"
-            " -j4 "
+            build_command="make "
             "TARGET_PRODUCT=%s TARGET_SIMULATOR=false " % (config["target"]) +
             "TARGET_TOOLS_PREFIX=" + toolchain_dir +
             " boottarball systemtarball userdatatarball showcommands",
-            jobs=cpus, target=config["target"],
+            # jobs is chosen from the slave's CPUs and memory
+            target=config["target"],
             # If this code has been checked out and built before, use cached
             # build
             cached=True,
             # UID to work out if this has already been built
-            source_uid=self.source.uid)
+            source_uid=self.source.uid,
+            # What to store in / restore from the build cache
+            outputs=["out/target/product/%s/*.tar.bz2" % config["target"]],
+            toolchain=toolchain_dir,
+            # Compile through ccache when the cache above misses
+            ccache=True)
 
 
 class AndroidBuildBootSnowball(AndroidBuild):
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+"""Measure how long lrn takes to start.
+
+Times importing commands.commands on its own, then whole lrn runs of a
+job that only runs pwd on a localhost slave, first on their own and then
+sent to an lrn daemon. Also lists which of the slow to import transport
+modules a localhost job ended up loading.
+
+Run from the top of the tree:
+    python benchmarks/startup.py [--runs N]
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+TOP = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+JOB = '''
+import sys
+from commands.commands import *
+
+
+class DefaultJob(LinaroCIJob):
+    def run(self):
+        slave = x86_64({"reserved": {"hostname": "localhost"}})
+        slave.cwd()
+        with open("modules", "w") as f:
+            f.write(" ".join(name for name in %r if name in sys.modules))
+'''
+
+TRANSPORT_MODULES = ["paramiko", "pexpect", "telnetlib", "getpass"]
+
+
+def time_runs(command, runs, env, cwd):
+    times = []
+    for _ in range(runs):
+        start = time.time()
+        with open(os.devnull, "w") as devnull:
+            subprocess.check_call(command, env=env, cwd=cwd, stdout=devnull,
+                                  stderr=devnull)
+        times.append(time.time() - start)
+    return times
+
+
+def report(name, times):
+    print "%-30s min %6.3fs mean %6.3fs" % (name, min(times),
+                                              sum(times) / len(times))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    job_dir = tempfile.mkdtemp()
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([job_dir, TOP])
+
+    try:
+        with open(os.path.join(job_dir, "CIJob.py"), "w") as f:
+            f.write(JOB % TRANSPORT_MODULES)
+
+        report("import commands.commands", time_runs(
+            [sys.executable, "-c", "import commands.commands"], args.runs,
+            env, job_dir))
+        report("lrn localhost job", time_runs(
+            [sys.executable, os.path.join(TOP, "lrn")], args.runs, env,
+            job_dir))
+
+        with open(os.path.join(job_dir, "modules")) as f:
+            print "transport modules loaded: %s" % (f.read() or "none")
+
+        # HOME is the job directory so this daemon's socket doesn't clash
+        # with one already running
+        env["HOME"] = job_dir
+        daemon = subprocess.Popen([sys.executable, os.path.join(TOP, "lrn"),
+                                   "--daemon"], env=env, cwd=job_dir)
+        try:
+            socket_path = os.path.join(job_dir, ".cache/ci-runtime/lrn.sock")
+            while not os.path.exists(socket_path):
+                time.sleep(0.01)
+            report("lrn localhost job, daemon", time_runs(
+                [sys.executable, os.path.join(TOP, "lrn")], args.runs, env,
+                job_dir))
+        finally:
+            daemon.terminate()
+            daemon.wait()
+    finally:
+        shutil.rmtree(job_dir)
+
+
+if __name__ == "__main__":
+    main()
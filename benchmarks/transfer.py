@@ -0,0 +1,130 @@
+#!/usr/bin/python
+
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+"""Compare plain SFTP with TransferEngine.
+
+Copies one large file and a directory of small files to a scratch
+directory on an SSH server and back, first with paramiko's sftp.put/get,
+then with TransferEngine. By default the server is an in-process one
+serving a local temporary directory; give --host to use a real one (key
+based login, as for a slave).
+
+Run from the top of the tree:
+    python benchmarks/transfer.py [--host HOST --username USER]
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import paramiko
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from commands.transfer import TransferEngine
+
+
+def connect(args, remote_root):
+    if args.host:
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(args.host, username=args.username)
+        return ssh.get_transport(), None
+
+    from tests.sftp_server import LocalSSHServer
+    server = LocalSSHServer(remote_root)
+    return server.connect(), server
+
+
+def report(name, size, seconds):
+    print "%-30s %8.2fs %8.1f MB/s" % (name, seconds,
+                                       size / seconds / (1024 * 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--host")
+    parser.add_argument("--username")
+    parser.add_argument("--size", type=int, default=256,
+                        help="Size of the large file in MB")
+    parser.add_argument("--files", type=int, default=200,
+                        help="Number of 16kB files")
+    parser.add_argument("--channels", type=int, default=4)
+    args = parser.parse_args()
+
+    local = tempfile.mkdtemp()
+    remote_root = tempfile.mkdtemp()
+    transport, server = connect(args, remote_root)
+    # Paths are relative to the login directory
+    remote = "ci-transfer-benchmark"
+
+    try:
+        sftp = paramiko.SFTPClient.from_transport(transport)
+        sftp.mkdir(remote)
+
+        big = os.path.join(local, "big")
+        with open(big, "wb") as f:
+            for _ in range(args.size):
+                f.write(os.urandom(1024 * 1024))
+        small = []
+        for index in range(args.files):
+            path = os.path.join(local, "small%d" % index)
+            with open(path, "wb") as f:
+                f.write(os.urandom(16 * 1024))
+            small.append((path, "%s/small%d" % (remote, index)))
+        big_size = args.size * 1024 * 1024
+        small_size = args.files * 16 * 1024
+
+        start = time.time()
+        sftp.put(big, remote + "/big")
+        report("sftp.put large", big_size, time.time() - start)
+
+        start = time.time()
+        sftp.get(remote + "/big", big + ".got")
+        report("sftp.get large", big_size, time.time() - start)
+
+        start = time.time()
+        for local_path, remote_path in small:
+            sftp.put(local_path, remote_path)
+        report("sftp.put small files", small_size, time.time() - start)
+
+        for name in sftp.listdir(remote):
+            sftp.remove(remote + "/" + name)
+        os.remove(big + ".got")
+
+        engine = TransferEngine(transport, channels=args.channels)
+
+        start = time.time()
+        engine.put(big, remote + "/big")
+        report("engine put large", big_size, time.time() - start)
+
+        start = time.time()
+        engine.get(remote + "/big", big + ".got")
+        report("engine get large", big_size, time.time() - start)
+
+        start = time.time()
+        engine.put_files(small)
+        report("engine put_files small", small_size, time.time() - start)
+
+        start = time.time()
+        engine.put_files(small)
+        report("engine put_files unchanged", small_size, time.time() - start)
+
+        for name in sftp.listdir(remote):
+            sftp.remove(remote + "/" + name)
+        sftp.rmdir(remote)
+        engine.close()
+    finally:
+        transport.close()
+        if server:
+            server.stop()
+        shutil.rmtree(local)
+        shutil.rmtree(remote_root)
+
+
+if __name__ == "__main__":
+    main()
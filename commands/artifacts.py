@@ -0,0 +1,297 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import hashlib
+import json
+import logging
+import os
+import pipes
+import re
+import time
+import urllib
+import urllib2
+import urlparse
+
+
+DEFAULT_INDEX = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             "artifacts.json")
+
+# Shell run on the slave to make an artifact available in the workspace.
+# The download is kept in a content addressed cache and extracted once into
+# a tree next to it; the workspace gets a symlink to that tree. A download
+# is streamed through the decompressor into tar as it arrives, with a copy
+# kept for the cache. Exit codes: 0 ready, 2 download failed its size or
+# checksum, anything else failed.
+FETCH = (
+    '(set -o pipefail; '
+    'x=%(root)s/extracted/%(id)s; d=%(root)s/downloads/%(id)s; '
+    '%(revalidate)s'
+    'if [ ! -f $x/.ci-complete ]; then '
+    'mkdir -p %(root)s/downloads %(root)s/extracted && '
+    'rm -rf $x.tmp && mkdir -p $x.tmp || exit 1; '
+    'if [ -f $d ]; then echo "ci-artifact-from: cache"; '
+    '%(decompress)s < $d | %(tar)s; '
+    'else echo "ci-artifact-from: url"; '
+    'curl -sSfLk %(url)s | tee $d.tmp | %(decompress)s | %(tar)s && '
+    'mv $d.tmp $d; fi || { rm -rf $x.tmp $d.tmp; exit 1; }; '
+    '%(check)s%(stamp)s'
+    'echo "ci-artifact-files: $(find $x.tmp -type f | wc -l)"; '
+    'touch $x.tmp/.ci-complete && rm -rf $x && mv $x.tmp $x || exit 1; '
+    'fi; '
+    'if [ -d %(dest)s ] && [ ! -L %(dest)s ]; then rm -rf %(dest)s; fi; '
+    'ln -sfn $x %(dest)s); echo "ci-artifact: $?"')
+
+# Inserted into FETCH when the index gives a size or checksum
+SIZE_CHECK = ('{ test "$(stat -c %%s $d)" = %(size)d || '
+              '{ rm -rf $d $x.tmp; exit 2; }; }; ')
+CHECK = ('{ echo "%(sha256)s  $d" | sha256sum -c --quiet - || '
+         '{ rm -rf $d $x.tmp; exit 2; }; }; ')
+
+# Inserted into FETCH for artifacts without a checksum, whose URL can give
+# different archives over time. The headers saying which version the URL
+# has are kept with the extracted tree; if the server now gives different
+# ones, the tree and download are thrown away and fetched again. If the
+# server can't be asked, what was extracted before is used.
+REVALIDATE = (
+    'if h=$(curl -sSfLkI %(url)s); then '
+    's=$(echo "$h" | tr -d "\\r" | '
+    'grep -iE "^(etag|last-modified|content-length):" | sort | sha1sum); '
+    'if [ "$(cat $x/.ci-stamp 2>/dev/null)" != "$s" ]; then '
+    'rm -f $x/.ci-complete $d; fi; '
+    'else echo "ci-artifact-unchecked"; fi; ')
+STAMP = 'echo "$s" > $x.tmp/.ci-stamp; '
+
+TAR = 'tar -C $x.tmp --strip-components %d -x'
+
+# Decompressors by archive extension. The parallel one is used if the
+# slave has it.
+DECOMPRESSORS = [
+    (r"\.(tar\.bz2|tbz2?)$", "$(command -v pbzip2 || echo bzip2) -dc"),
+    (r"\.(tar\.gz|tgz)$", "$(command -v pigz || echo gzip) -dc"),
+    (r"\.(tar\.xz|txz)$", "xz -T0 -dc"),
+]
+
+
+def decompressor(url):
+    """Shell command that decompresses the archive at url to stdout"""
+    for pattern, command in DECOMPRESSORS:
+        if re.search(pattern, url):
+            return command
+    return "cat"
+
+
+class ArtifactNotFound(Exception):
+    """Exception: No artifact in the index matches a name and tags"""
+
+
+class ArtifactFailed(Exception):
+    """Exception: An artifact couldn't be made ready on a slave"""
+
+
+class Artifact(object):
+    """An entry in the artifact index.
+
+    url is where to download the archive from, size and sha256 describe it
+    and are checked when it is downloaded. sha256 is None if the archive
+    isn't pinned, for example a nightly build; the URL is then checked for
+    a new version each time the artifact is used. directory is the name
+    the extracted tree is given in the workspace and strip_components is
+    passed to tar.
+    """
+    def __init__(self, name, tags, url, size=None, sha256=None,
+                 directory=None, strip_components=0):
+        self.name = name
+        self.tags = tags
+        self.url = url
+        self.size = size
+        self.sha256 = sha256
+        self.directory = directory or name
+        self.strip_components = strip_components
+
+    @property
+    def id(self):
+        """Name of the artifact in the slave's caches.
+
+        The checksum if there is one, so the same content is only stored
+        once whatever URL it came from, else a hash of the URL.
+        """
+        if self.sha256:
+            return self.sha256
+        return hashlib.sha1(self.url).hexdigest()
+
+
+class ArtifactIndex(object):
+    """Index of artifacts, mapping a name and tags to a download.
+
+    location is a JSON file, a directory containing index.json, or an
+    http(s) URL of a JSON file. Relative artifact URLs are resolved against
+    it, so a directory of archives with an index.json next to them is a
+    complete store. The JSON looks like:
+
+    {"artifacts": [{"name": "linaro-gnu-toolchain",
+                    "tags": ["2012.10", "v4.7"],
+                    "url": "gcc-linaro-arm-linux-gnueabihf-4.7.tar.bz2",
+                    "size": 12345, "sha256": "...",
+                    "directory": "toolchain", "strip_components": 1}]}
+
+    An index fetched over HTTP is cached in cache_dir and re-used for ttl
+    seconds, after which it is revalidated with its ETag. If the server
+    can't be reached the cached copy is used, however old.
+    """
+    def __init__(self, location=DEFAULT_INDEX,
+                 cache_dir="~/.cache/ci-runtime/artifact-index", ttl=3600):
+        self.location = location
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.ttl = ttl
+        self.index = None
+
+    def _is_http(self):
+        return re.search(r"^https?://", self.location) is not None
+
+    def _base_url(self):
+        if self._is_http():
+            return self.location
+        path = os.path.abspath(os.path.expanduser(self.location))
+        if os.path.isdir(path):
+            path = os.path.join(path, "index.json")
+        return "file://" + urllib.pathname2url(path)
+
+    def _load_file(self):
+        path = os.path.expanduser(self.location)
+        if os.path.isdir(path):
+            path = os.path.join(path, "index.json")
+        with open(path) as f:
+            return json.load(f)
+
+    def _load_http(self):
+        cache_path = os.path.join(self.cache_dir,
+                                  hashlib.sha1(self.location).hexdigest() +
+                                  ".json")
+        cached = None
+        if os.path.isfile(cache_path):
+            with open(cache_path) as f:
+                cached = json.load(f)
+            if time.time() - cached["fetched"] < self.ttl:
+                return cached["index"]
+
+        request = urllib2.Request(self.location)
+        if cached and cached.get("etag"):
+            request.add_header("If-None-Match", cached["etag"])
+        try:
+            response = urllib2.urlopen(request)
+            cached = {"index": json.load(response),
+                      "etag": response.info().getheader("ETag")}
+        except urllib2.HTTPError, e:
+            if e.code != 304 or not cached:
+                raise
+            logging.info("artifacts: index %s not modified" % self.location)
+        except urllib2.URLError, e:
+            if not cached:
+                raise
+            logging.warning("artifacts: can't fetch %s (%s), using cached "
+                            "index" % (self.location, e))
+            return cached["index"]
+
+        cached["fetched"] = time.time()
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        with open(cache_path + ".tmp", "w") as f:
+            json.dump(cached, f)
+        os.rename(cache_path + ".tmp", cache_path)
+        return cached["index"]
+
+    def load(self):
+        if self._is_http():
+            return self._load_http()
+        return self._load_file()
+
+    def find(self, name, tags):
+        """Return the Artifact with name that has all of tags.
+
+        If more than one matches, the last in the index wins, so newer
+        entries can be appended.
+        """
+        if self.index is None:
+            self.index = self.load()
+
+        match = None
+        for entry in self.index["artifacts"]:
+            if entry["name"] == name and set(tags) <= set(entry["tags"]):
+                match = entry
+
+        if match is None:
+            raise ArtifactNotFound("%s tagged %s" % (name, " ".join(tags)))
+
+        return Artifact(match["name"], match["tags"],
+                        urlparse.urljoin(self._base_url(), match["url"]),
+                        match.get("size"), match.get("sha256"),
+                        match.get("directory"),
+                        match.get("strip_components", 0))
+
+
+class SlaveArtifactStore(object):
+    """Artifact downloads and extracted trees kept on the slave.
+
+    Both are shared by every workspace on the slave, so an artifact is
+    downloaded and extracted once and each workspace gets a symlink.
+    """
+    def __init__(self, root="~/.cache/ci-runtime/artifacts"):
+        self.root = root
+        self.status_search = re.compile(r"^ci-artifact: (\d+)$")
+        self.source_search = re.compile(r"^ci-artifact-from: (\w+)$")
+        self.files_search = re.compile(r"^ci-artifact-files: (\d+)$")
+
+    def fetch(self, slave, artifact):
+        """Make artifact available as artifact.directory in slave's cwd"""
+        url = pipes.quote(artifact.url)
+        check = ""
+        if artifact.size is not None:
+            check += SIZE_CHECK % {"size": int(artifact.size)}
+        if artifact.sha256:
+            check += CHECK % {"sha256": artifact.sha256}
+            revalidate = stamp = ""
+        else:
+            logging.warning("artifacts: %s has no checksum, not verified" %
+                            artifact.url)
+            revalidate = REVALIDATE % {"url": url}
+            stamp = STAMP
+
+        rx = slave._in_shell_cmd(
+            FETCH % {"root": self.root,
+                     "id": artifact.id,
+                     "url": url,
+                     "revalidate": revalidate,
+                     "check": check,
+                     "stamp": stamp,
+                     "decompress": decompressor(artifact.url),
+                     "tar": TAR % artifact.strip_components,
+                     "dest": pipes.quote(artifact.directory)},
+            quiet=True)
+        status = None
+        source = "extracted"
+        files = None
+        for line in rx:
+            if line.strip() == "ci-artifact-unchecked":
+                logging.warning("artifacts: can't check %s for a new "
+                                "version" % artifact.url)
+            status_search = self.status_search.search(line)
+            if status_search:
+                status = int(status_search.group(1))
+            source_search = self.source_search.search(line)
+            if source_search:
+                source = source_search.group(1)
+            files_search = self.files_search.search(line)
+            if files_search:
+                files = int(files_search.group(1))
+
+        if status == 2:
+            raise ArtifactFailed("%s doesn't match the size or checksum in "
+                                 "the index" % artifact.url)
+        if status != 0:
+            raise ArtifactFailed("unable to fetch %s" % artifact.url)
+
+        if files is None:
+            logging.info("artifacts: %s already extracted" % artifact.url)
+        else:
+            logging.info("artifacts: extracted %d files from %s (%s)" %
+                         (files, artifact.url, source))
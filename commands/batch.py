@@ -0,0 +1,85 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import re
+
+# Run after each command in a batch script. Prints "ci-batch: <index>
+# <status>" and stops the script if the command failed. The script is
+# sourced, so cd and export still change the slave's shell, and return
+# leaves the script without leaving the shell.
+STATUS = ('ci_status=$?; printf "\\nci-batch: %d $ci_status\\n"; '
+          'test $ci_status = 0 || return $ci_status')
+
+status_search = re.compile(r"^ci-batch: (\d+) (\d+)$")
+
+
+def script(commands, path):
+    """Bash script, to be saved at path, that runs commands in order
+
+    The script deletes itself first: bash has read all of it by then.
+    """
+    lines = ["rm -f " + path]
+    for index, command in enumerate(commands):
+        lines.append(command)
+        lines.append(STATUS % index)
+    return "\n".join(lines) + "\n"
+
+
+def run_command(path):
+    return ". " + path
+
+
+def parse(lines):
+    """[(status, output lines)] for each command in a script that ran"""
+    results = []
+    output = []
+    for line in lines:
+        search = status_search.search(line)
+        if search and int(search.group(1)) == len(results):
+            # The marker starts on a new line, so one ends the output of
+            # a command that didn't print a newline at the end
+            if output and output[-1] == "":
+                output.pop()
+            results.append((int(search.group(2)), output))
+            output = []
+        else:
+            output.append(line)
+    return results
+
+
+class Output(object):
+    """Output of a command a slave has deferred, see CISlave.batch
+
+    Behaves like the list of lines cmd returns. Reading it runs the batch
+    the command is in, so the output is there to be read.
+    """
+    def __init__(self, flush):
+        self._flush = flush
+        self._lines = None
+
+    def set(self, lines):
+        self._lines = lines
+
+    @property
+    def lines(self):
+        if self._lines is None:
+            self._flush()
+        return self._lines or []
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, index):
+        return self.lines[index]
+
+    def __eq__(self, other):
+        return self.lines == other
+
+    def __ne__(self, other):
+        return self.lines != other
+
+    def __repr__(self):
+        return repr(self.lines)
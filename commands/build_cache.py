@@ -0,0 +1,285 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import hashlib
+import json
+import logging
+import os
+import re
+
+
+DEFAULT_MAX_SIZE = 20 * 1024 ** 3
+
+# Shell run on the slave to restore an entry. Exit codes: 0 restored,
+# 1 no entry, 2 object missing, 3 restored files failed the integrity check.
+# A broken entry is deleted, with those of its objects that don't match their
+# hash, so the next store replaces them. Objects are shared between entries,
+# so the good ones are kept; eviction removes them once nothing refers to
+# them.
+RESTORE = (
+    '(e=%(root)s/entries/%(key)s; test -f $e || exit 1; touch $e; '
+    'while read sum mode path; do mkdir -p "$(dirname "$path")" && '
+    'cp %(root)s/objects/$sum "$path" && chmod $mode "$path" || exit 2; '
+    'done < $e; '
+    'while read sum mode path; do echo "$sum  $path"; done < $e | '
+    'sha256sum -c --quiet - || exit 3); r=$?; '
+    'if [ $r -gt 1 ]; then while read sum mode path; do '
+    'o=%(root)s/objects/$sum; test -f $o && '
+    'test "$(sha256sum < $o | cut -d" " -f1)" = $sum || rm -f $o; '
+    'done < %(root)s/entries/%(key)s; '
+    'rm -f %(root)s/entries/%(key)s; fi; echo "ci-build-cache: $r"')
+
+# Shell run on the slave to store outputs under a key, then evict least
+# recently used entries until the objects fit in max_size bytes. Entries are
+# lines of "<sha256> <mode> <path>".
+STORE = (
+    '(mkdir -p %(root)s/objects %(root)s/entries && '
+    'find %(outputs)s -type f | while read path; do '
+    'sum=$(sha256sum < "$path" | cut -d" " -f1) || exit 1; '
+    'test -f %(root)s/objects/$sum || '
+    '{ cp "$path" %(root)s/objects/$sum.tmp && '
+    'mv %(root)s/objects/$sum.tmp %(root)s/objects/$sum; } || exit 1; '
+    'echo "$sum $(stat -c %%a "$path") $path"; '
+    'done > %(root)s/entries/%(key)s.tmp && '
+    'test -s %(root)s/entries/%(key)s.tmp && '
+    'mv %(root)s/entries/%(key)s.tmp %(root)s/entries/%(key)s); '
+    'echo "ci-build-cache-stored: $?"; rm -f %(root)s/entries/%(key)s.tmp; '
+    '(cd %(root)s && '
+    'while [ $(du -sb objects | cut -f1) -gt %(max_size)d ] && '
+    '[ -n "$(ls entries)" ]; do '
+    'rm -f "entries/$(ls -tr entries | head -n 1)"; '
+    'echo ci-build-cache-evicted; '
+    'cat entries/* 2>/dev/null | cut -d" " -f1 | sort -u > refs; '
+    'ls objects | sort | comm -23 - refs | sed "s|^|objects/|" | '
+    'xargs -r rm -f; done; rm -f refs)')
+
+
+def build_key(source_uid, build_command, target, env, toolchain_id):
+    """Cache key for a build: a hash of everything that decides its output"""
+    key = hashlib.sha1()
+    for part in [source_uid, build_command, target, env, toolchain_id]:
+        key.update("%s\0" % part)
+    return key.hexdigest()
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), ""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class BuildCache(object):
+    """Content addressed store of build outputs.
+
+    Each file is stored once per unique content as an object named by its
+    SHA-256. A build key maps to an entry listing which object is restored
+    to which path (relative to the build directory) with which mode. Restored
+    files are checked against their hashes before a hit is reported. When
+    the objects use more than max_size bytes, the least recently used entries
+    are evicted along with any objects no remaining entry refers to.
+    """
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.corrupt = 0
+        self.evictions = 0
+
+    def restore(self, slave, key):
+        """Restore the outputs stored under key. Returns True on a hit."""
+        raise NotImplementedError
+
+    def store(self, slave, key, outputs):
+        """Store the files in outputs (paths or globs) under key"""
+        raise NotImplementedError
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "corrupt": self.corrupt,
+            "evictions": self.evictions,
+        }
+
+    def log_stats(self):
+        logging.info("build cache: %(hits)d hits, %(misses)d misses, "
+                     "%(corrupt)d corrupt, %(evictions)d evicted" %
+                     self.stats())
+
+
+class SlaveBuildCache(BuildCache):
+    """Build cache kept on the slave that runs the build"""
+    def __init__(self, root="~/.cache/ci-runtime/build-cache",
+                 max_size=DEFAULT_MAX_SIZE):
+        super(SlaveBuildCache, self).__init__(max_size)
+        self.root = root
+        self.status_search = re.compile(r"^ci-build-cache: (\d+)$")
+
+    def restore(self, slave, key):
+        status = None
+        rx = slave._in_shell_cmd(RESTORE % {"root": self.root, "key": key},
+                                 quiet=True)
+        for line in rx:
+            status_search = self.status_search.search(line)
+            if status_search:
+                status = int(status_search.group(1))
+
+        if status == 0:
+            self.hits += 1
+            return True
+
+        if status in [2, 3]:
+            logging.warning("build cache: entry %s failed integrity check, "
+                            "discarded" % key)
+            self.corrupt += 1
+        self.misses += 1
+        return False
+
+    def store(self, slave, key, outputs):
+        rx = slave._in_shell_cmd(STORE % {"root": self.root,
+                                          "key": key,
+                                          "outputs": " ".join(outputs),
+                                          "max_size": self.max_size},
+                                 quiet=True)
+        if "ci-build-cache-stored: 0" not in rx:
+            logging.warning("build cache: unable to store %s" %
+                            " ".join(outputs))
+        self.evictions += rx.count("ci-build-cache-evicted")
+
+
+class LocalBuildCache(BuildCache):
+    """Build cache kept in a directory on the machine running the job.
+
+    Outputs are copied to and from the slave over SFTP, so one cache can be
+    shared by every slave the controller uses.
+    """
+    def __init__(self, root, max_size=DEFAULT_MAX_SIZE):
+        super(LocalBuildCache, self).__init__(max_size)
+        self.root = os.path.expanduser(root)
+        self.objects = os.path.join(self.root, "objects")
+        self.entries = os.path.join(self.root, "entries")
+
+    def _entry_path(self, key):
+        return os.path.join(self.entries, key + ".json")
+
+    def _discard(self, key, corrupt):
+        """Remove the entry for key and the objects in corrupt, those of its
+        objects that don't match their hash. Its other objects may be used
+        by other entries, so are left for _evict."""
+        for sha256 in corrupt:
+            object_path = os.path.join(self.objects, sha256)
+            if os.path.exists(object_path):
+                os.remove(object_path)
+        os.remove(self._entry_path(key))
+
+    def restore(self, slave, key):
+        entry_path = self._entry_path(key)
+        if not os.path.isfile(entry_path):
+            self.misses += 1
+            return False
+
+        with open(entry_path) as f:
+            files = json.load(f)
+
+        corrupt = []
+        for sha256, _, _ in files:
+            object_path = os.path.join(self.objects, sha256)
+            if(not os.path.isfile(object_path) or
+               file_sha256(object_path) != sha256):
+                corrupt.append(sha256)
+        if corrupt:
+            logging.warning("build cache: entry %s failed integrity check, "
+                            "discarded" % key)
+            self._discard(key, corrupt)
+            self.corrupt += 1
+            self.misses += 1
+            return False
+
+        remote_dir = slave.cwd()
+        directories = set(os.path.dirname(path) for _, _, path in files)
+        directories.discard("")
+        if directories:
+            slave.mkdir(" ".join(sorted(directories)))
+
+        slave.put_files([(os.path.join(self.objects, sha256),
+                          os.path.join(remote_dir, path))
+                         for sha256, _, path in files])
+        for sha256, mode, path in files:
+            slave.sftp.chmod(os.path.join(remote_dir, path), int(mode, 8))
+
+        # Check what landed on the slave, in one round trip
+        check = " ".join("%s %s" % (sha256, path)
+                         for sha256, _, path in files)
+        rx = slave._in_shell_cmd("printf '%%s  %%s\\n' %s | "
+                                 "sha256sum -c --quiet -; "
+                                 "echo \"ci-build-cache: $?\"" % check,
+                                 quiet=True)
+        if "ci-build-cache: 0" not in rx:
+            logging.warning("build cache: restored files for %s don't match "
+                            "the cache" % key)
+            self.misses += 1
+            return False
+
+        os.utime(entry_path, None)
+        self.hits += 1
+        return True
+
+    def store(self, slave, key, outputs):
+        for directory in [self.objects, self.entries]:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+
+        files = [[stat.sha256, "%o" % stat.mode, stat.path]
+                 for stat in slave.glob(outputs, sha256=True, recursive=True)
+                 if stat.type == "file"]
+
+        if not files:
+            logging.warning("build cache: no outputs matching %s" %
+                            " ".join(outputs))
+            return
+
+        remote_dir = slave.cwd()
+        missing = dict((sha256, path) for sha256, _, path in files
+                       if not os.path.isfile(os.path.join(self.objects,
+                                                          sha256)))
+        slave.get_files([(os.path.join(remote_dir, path),
+                          os.path.join(self.objects, sha256) + ".tmp")
+                         for sha256, path in missing.items()])
+        for sha256, path in missing.items():
+            object_path = os.path.join(self.objects, sha256)
+            if file_sha256(object_path + ".tmp") != sha256:
+                os.remove(object_path + ".tmp")
+                logging.warning("build cache: %s changed while being stored" %
+                                path)
+                return
+            os.rename(object_path + ".tmp", object_path)
+
+        with open(self._entry_path(key) + ".tmp", "w") as f:
+            json.dump(files, f)
+        os.rename(self._entry_path(key) + ".tmp", self._entry_path(key))
+
+        self._evict()
+
+    def _size(self):
+        return sum(os.path.getsize(os.path.join(self.objects, name))
+                   for name in os.listdir(self.objects))
+
+    def _evict(self):
+        """Remove least recently used entries until objects fit max_size"""
+        entries = sorted(os.listdir(self.entries),
+                         key=lambda name: os.path.getmtime(
+                             os.path.join(self.entries, name)))
+
+        while entries and self._size() > self.max_size:
+            os.remove(os.path.join(self.entries, entries.pop(0)))
+            self.evictions += 1
+
+            referenced = set()
+            for name in entries:
+                with open(os.path.join(self.entries, name)) as f:
+                    referenced.update(sha256 for sha256, _, _ in json.load(f))
+            for name in os.listdir(self.objects):
+                if name not in referenced:
+                    os.remove(os.path.join(self.objects, name))
@@ -0,0 +1,198 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import functools
+import importlib
+import json
+import logging
+import os
+import threading
+
+
+class Unsaved(Exception):
+    """Exception: A value can't be saved in a checkpoint"""
+
+
+def encode(value, objects=True):
+    """Return value in a form json can save, or raise Unsaved.
+
+    Entries of dicts that can't be saved are left out, so a job's config
+    keeps what it can. Other objects, such as a Checkout, are saved with
+    their attributes if those are all plain values; objects holding other
+    objects, like slaves, can't be saved.
+    """
+    if value is None or isinstance(value, (basestring, int, long, float)):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [encode(item, objects) for item in value]
+    if isinstance(value, dict):
+        encoded = {}
+        # dict.items, so lazy config values aren't worked out to save them
+        for key, item in dict.items(value):
+            try:
+                encoded[key] = encode(item, objects)
+            except Unsaved:
+                pass
+        return encoded
+    if objects and hasattr(value, "__dict__") and not callable(value):
+        cls = type(value)
+        return {"__object__": "%s.%s" % (cls.__module__, cls.__name__),
+                "attributes": dict((key, encode(item, False))
+                                   for key, item in vars(value).items())}
+    raise Unsaved(repr(value))
+
+
+def decode(value):
+    if isinstance(value, list):
+        return [decode(item) for item in value]
+    if isinstance(value, dict):
+        if "__object__" in value:
+            module_name, class_name = value["__object__"].rsplit(".", 1)
+            cls = getattr(importlib.import_module(module_name), class_name)
+            obj = cls.__new__(cls)
+            obj.__dict__.update(decode(value["attributes"]))
+            return obj
+        return dict((key, decode(item)) for key, item in value.items())
+    return value
+
+
+def merge(target, saved):
+    """Update dict target with saved, recursing into dicts in both"""
+    for key, value in saved.items():
+        current = dict.get(target, key)
+        if isinstance(current, dict) and isinstance(value, dict):
+            merge(current, value)
+        else:
+            dict.__setitem__(target, key, value)
+
+
+def snapshot(job):
+    """The job's public attributes that can be saved, encoded"""
+    state = {}
+    for name, value in vars(job).items():
+        if name.startswith("_"):
+            continue
+        try:
+            state[name] = encode(value)
+        except Unsaved:
+            pass
+    return state
+
+
+def restore(job, state):
+    """Set the job's attributes from a snapshot.
+
+    Saved dicts are merged into the job's current ones, so values that
+    weren't saved, like lazy config values, are kept.
+    """
+    for name, value in state.items():
+        value = decode(value)
+        current = getattr(job, name, None)
+        if isinstance(current, dict) and isinstance(value, dict):
+            merge(current, value)
+        else:
+            setattr(job, name, value)
+
+
+class Checkpoint(object):
+    """Record of the steps a job has completed, so a failed run can resume.
+
+    After each step (see step) the job's attributes that can be saved are
+    written to path along with the step's name. With resume, what an
+    earlier run saved is loaded as long as its key matches: steps it
+    completed are skipped and the job's attributes are restored instead.
+    key should identify the job's source and parameters so changing either
+    starts the job from the beginning.
+    """
+    def __init__(self, path, key, resume=False):
+        self.path = os.path.expanduser(path)
+        self.key = key
+        self.completed = []
+        self.state = {}
+        self.skip = set()
+        self.restored = False
+        # Steps can run concurrently
+        self.lock = threading.RLock()
+
+        if resume:
+            self._load()
+        elif os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            logging.info("checkpoint: nothing to resume, starting job")
+            return
+
+        with open(self.path) as f:
+            saved = json.load(f)
+        if saved["key"] != self.key:
+            logging.info("checkpoint: job source or parameters have "
+                         "changed, starting job again")
+            return
+
+        self.completed = saved["completed"]
+        self.state = saved["state"]
+        self.skip = set(self.completed)
+        logging.info("checkpoint: resuming after %s" %
+                     ", ".join(self.completed))
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"key": self.key, "completed": self.completed,
+                       "state": self.state}, f)
+        os.rename(self.path + ".tmp", self.path)
+
+    def run(self, job, name, function, *args, **kwargs):
+        """Run a step of job, or skip it if the run being resumed did it"""
+        if name in self.skip:
+            with self.lock:
+                if not self.restored:
+                    restore(job, self.state)
+                    self.restored = True
+            logging.info("checkpoint: %s done by an earlier run, skipped" %
+                         name)
+            return None
+
+        result = function(*args, **kwargs)
+        with self.lock:
+            if name not in self.completed:
+                self.completed.append(name)
+            self.state = snapshot(job)
+            self._save()
+        return result
+
+    def finish(self):
+        """Forget the checkpoint once every step has completed"""
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def step(function=None, depends=(), shared=False):
+    """Decorator marking a job method as a step that can be checkpointed.
+
+    When the job is run by CIJobRuntime, each completed step is recorded so
+    a run with --resume carries on after the last one that worked. Called
+    any other way, the method just runs.
+
+    Used as @step(depends=["checkout"]) it also names the steps that must
+    have run first, so LinaroCIJob.run_steps can run steps that don't
+    depend on each other at the same time. shared=True marks a step that
+    a matrix run (see matrix.Matrix) does once for all its variants.
+    """
+    if function is None:
+        return lambda function: step(function, depends, shared)
+
+    @functools.wraps(function)
+    def wrapper(self, *args, **kwargs):
+        checkpoint = getattr(self, "_checkpoint", None)
+        if checkpoint is None:
+            return function(self, *args, **kwargs)
+        return checkpoint.run(self, function.__name__, function, self,
+                              *args, **kwargs)
+    wrapper.depends = list(depends)
+    wrapper.shared = shared
+    return wrapper
@@ -1,27 +1,92 @@
 # Copyright 2013 Linaro Ltd.  This software is licensed under the
 # GNU General Public License version 3 (see the file COPYING).
 
+import hashlib
 import logging
 import sys
-import paramiko
 import time
 import re
-import getpass
 import socket
-import pexpect
 import os
 import random
 import string
 import atexit
 import importlib
-import telnetlib
-
-
-class Checkout():
-    """Placeholder. In the future this may be used to store information about
-    checkouts.
+import inspect
+import json
+import contextlib
+import threading
+
+from artifacts import ArtifactIndex, SlaveArtifactStore
+import batch
+from build_cache import build_key, SlaveBuildCache
+from checkpoint import Checkpoint, step
+from local_files import LocalFiles
+from matrix import Matrix
+import publish
+from query_cache import QueryCache, change_directory
+import remote_fs
+from slave_pool import SlavePool
+from steps import SlaveSessions, StepGraph
+from sync import (DirectorySync, LocalDirectorySync,
+                  SlaveDirectorySync)
+from transfer import TransferEngine
+
+
+class Checkout(object):
+    """Information about a source checkout.
+
+    Records the VCS type, URL and branch that were checked out, the revision
+    of every tree in the checkout (just "." for git and bzr, one entry per
+    project path for repo) and whether any tree had local modifications.
+
+    uid is a hash of the VCS type and revisions, so identical source trees
+    have identical UIDs wherever they were fetched from. It is None for dirty
+    or unidentified checkouts because their content isn't described by their
+    revisions, so they must never be used as a cache key.
     """
-    uid = 0
+    def __init__(self, vcs_type=None, url=None, branch=None, revisions=None,
+                 dirty=False):
+        self.vcs_type = vcs_type
+        self.url = url
+        self.branch = branch
+        self.revisions = revisions or {}
+        self.dirty = dirty
+
+        # Filled in for repo checkouts so sync performance can be tracked
+        self.sync_seconds = None
+        self.bytes_transferred = None
+
+    @property
+    def revision(self):
+        """Revision of the top level tree (git HEAD, bzr revision ID)"""
+        return self.revisions.get(".")
+
+    @property
+    def uid(self):
+        if self.dirty or not self.revisions:
+            return None
+
+        uid = hashlib.sha1(self.vcs_type)
+        for path in sorted(self.revisions):
+            uid.update("\0%s\0%s" % (path, self.revisions[path]))
+        return uid.hexdigest()
+
+
+# Shell snippets that print "ci-revision: <path> <revision> <changed files>"
+# for the tree in the current directory. They are appended to checkout
+# commands so revisions are found in the same round trip as the checkout.
+# Untracked files, like build output, don't count as changes.
+GIT_REVISION = ('echo "ci-revision: %s $(git rev-parse HEAD) '
+                '$(git status --porcelain --untracked-files=no | wc -l)"')
+BZR_REVISION = ('echo "ci-revision: . '
+                '$(bzr revision-info | awk \'{print $2}\') '
+                '$(bzr status --short --versioned | wc -l)"')
+
+# Print "ci-rx-bytes: <n>", the bytes received by all non-loopback network
+# interfaces since boot. Sampled either side of a fetch to measure it.
+RX_BYTES = ('echo "ci-rx-bytes: $(awk \'{sub(/:/, " ")} '
+            'NR > 2 && $1 != "lo" {rx += $2} END {print rx}\' /proc/net/dev)"')
 
 
 class CommandFailed(Exception):
@@ -37,6 +102,58 @@ class CommandFailed(Exception):
                     "\n".join(self.command_output))
 
 
+def make_target_status(output, targets):
+    """Say which targets a make -k run built, from its output
+
+    Returns {target: "ok", "failed" or "unknown"}. With -k, make carries on
+    past errors and at the end prints "Target 'modules' not remade because
+    of errors." for each goal it couldn't build, so goals it doesn't list
+    were built. Error lines like "make[3]: *** [drivers/foo.o] Error 1"
+    name object files and directories rather than goals, so they aren't
+    used. A kernel build with O= runs the real build in a sub-make; the top
+    level make only reports its goals as not remade because the sub-make
+    failed, so its list is ignored. If make didn't get as far as listing
+    what it couldn't build, every target is unknown.
+    """
+    not_remade = {}
+    wrapper = False
+    for line in output:
+        search = re.search(r"^make(?:\[(\d+)\])?: Target [`'](.+)' not remade "
+                           r"because of errors\.$", line)
+        if search:
+            level = int(search.group(1) or 0)
+            not_remade.setdefault(level, set()).add(search.group(2))
+        elif re.search(r"^make: \*\*\* \[(?:[^\]]*:\d+: )?sub-make\] Error",
+                       line):
+            wrapper = True
+
+    levels = [level for level in not_remade if level > 0 or not wrapper]
+    if not levels:
+        return dict((target, "unknown") for target in targets)
+
+    failed = set()
+    for level in levels:
+        failed.update(not_remade[level])
+    status = {}
+    for target in targets:
+        if([path for path in failed
+            if path == target or path.endswith("/" + target)]):
+            status[target] = "failed"
+        else:
+            status[target] = "ok"
+    return status
+
+
+def reserved_machine(config):
+    """The "reserved" block of a slave's config, saying where to connect"""
+    if "reserved" not in config:
+        raise ValueError(
+            'slave config has no "reserved" block giving the machine to '
+            'connect to; give an x86_64 a list of machine requirements to '
+            'lease one from its SlavePool')
+    return config["reserved"]
+
+
 class BashShell(object):
     """Base class to encapsulate interacting with a bash shell
     """
@@ -120,6 +237,40 @@ class BashShell(object):
             except socket.timeout:
                 pass
 
+    def _sync(self, timeout=30):
+        """Wait until the shell has caught up with what has been sent.
+
+        Echoes a marker and reads up to it, so output from earlier commands
+        isn't mistaken for what comes next.
+        """
+        marker = "ci-sync-%d" % random.randint(0, 2 ** 30)
+        self._raw_send("echo %s\n" % marker)
+        rx = ""
+        start = time.time()
+        while not re.search("^%s$" % marker, rx, re.MULTILINE):
+            if time.time() - start > timeout:
+                raise socket.timeout("shell didn't respond")
+            try:
+                rx += self._strip_excape_sequences(self._raw_recv(1000))
+            except socket.timeout:
+                time.sleep(0.01)
+
+    def start_session(self):
+        """Start a new bash inside this one, for a job reusing the shell.
+
+        Whatever the job changes, such as its directory or environment
+        variables, goes away with end_session, leaving this shell as it was.
+        """
+        self._raw_send("bash\n")
+        self._sync()
+        self._set_up_shell()
+
+    def end_session(self):
+        """Exit the bash started by start_session"""
+        self._raw_send("exit\n")
+        self._sync()
+        self._set_up_shell()
+
     def _strip_excape_sequences(self, rx):
         # Process the recieved text and strip it of non-loggable text. This
         # logic handles both terminal colour codes as well as ANSI escape
@@ -213,12 +364,16 @@ class LocalShell(BashShell):
     identically.
     """
     def __init__(self, prompt):
+        import pexpect
         super(LocalShell, self).__init__(prompt)
         self.proc = pexpect.spawn('/bin/bash -li')
+        # pexpect waits 50ms before each send by default
+        self.proc.delaybeforesend = 0
         self._raw_send('TERM="vt100"\n')
         self._set_up_shell()
 
     def _raw_recv(self, size):
+        import pexpect
         try:
             return self.proc.read_nonblocking(size, timeout=0.1)
         except pexpect.TIMEOUT:
@@ -236,10 +391,6 @@ class LocalShell(BashShell):
         self._raw_send(value)
 
 
-class LocalFiles(object):
-    pass
-
-
 class SSHShell(BashShell):
     """Execute commands on a remote machine.
 
@@ -256,23 +407,21 @@ class SSHShell(BashShell):
         atexit.register(self.terminate)
 
     def _start_ssh_shell_and_sftp(self):
-        if "reserved" in self.config:
-            config = self.config["reserved"]
-            self.ssh.connect(config["hostname"], username=config["username"])
-        else:
-            # TODO: Exception rather than print & exit
-            print "Machine request not implemented, please provide reserved."
-            sys.exit(1)
-
+        # Slaves given machine requirements rather than a reserved machine
+        # lease one from their SlavePool before connecting
+        config = reserved_machine(self.config)
+        self.ssh.connect(config["hostname"], username=config["username"])
         self.sftp = self.ssh.open_sftp()
         self.shell = self.ssh.invoke_shell()
         self.shell.setblocking(0)
         self.ssh_transport = self.ssh.get_transport()
+        self.transfer = TransferEngine(self.ssh_transport)
         self.agent_chan = self.ssh_transport.open_session()
 
     def _connect(self):
         """Connect to remote machine"""
-        self.screen_name = "ci-runtime"
+        import paramiko
+        self.screen_name = self.config.get("screen name", "ci-runtime")
         self.ssh = paramiko.SSHClient()
         self.ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         self._start_ssh_shell_and_sftp()
@@ -364,17 +513,13 @@ class TelnetShell(BashShell):
         """Connect to remote machine"""
         self.screen_name = "ci-runtime"
 
-        if "reserved" in self.config:
-            config = self.config["reserved"]
-            if "port" in config:
-                port = config["port"]
-            else:
-                port = 23
-            self.shell = telnetlib.Telnet(config["hostname"], port)
+        config = reserved_machine(self.config)
+        if "port" in config:
+            port = config["port"]
         else:
-            # TODO: Exception rather than print & exit
-            print "Machine request not implemented, please provide reserved."
-            sys.exit(1)
+            port = 23
+        import telnetlib
+        self.shell = telnetlib.Telnet(config["hostname"], port)
 
         if self.booted:
             self._raw_send('TERM="vt100"\n')
@@ -398,21 +543,200 @@ class TelnetShell(BashShell):
             self.shell.close()
             self.shell = None
 
+
+class JobsTuner(object):
+    """Remembers which make -j was fastest for each host, target and kind.
+
+    Wall times are kept in a JSON file on the machine running the job:
+    {host: {target: {kind: {"builds": n, "jobs": {jobs: [[time, seconds],
+    ...]}}}}}. kind separates builds whose times can't be compared, such as
+    full and incremental ones. Each untried candidate is tried once, after
+    that the one with the lowest median of its recent times is used. So
+    that one lucky build doesn't decide for good, every explore_every
+    builds the candidate tried longest ago is tried again, and times older
+    than max_age seconds are forgotten.
+    """
+    samples = 5
+    explore_every = 10
+    max_age = 30 * 24 * 60 * 60
+
+    def __init__(self, path="~/.cache/ci-runtime/build-jobs.json"):
+        self.path = os.path.expanduser(path)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _entry(self, history, host, target, kind):
+        targets = history.setdefault(host, {})
+        kinds = targets.get(target)
+        if(not isinstance(kinds, dict) or
+           [value for value in kinds.values()
+            if not isinstance(value, dict)]):
+            # Missing, or saved before builds had kinds
+            kinds = targets[target] = {}
+        entry = kinds.setdefault(kind, {"builds": 0, "jobs": {}})
+
+        now = time.time()
+        for jobs, times in entry["jobs"].items():
+            times = [sample for sample in times
+                     if now - sample[0] < self.max_age]
+            if times:
+                entry["jobs"][jobs] = times
+            else:
+                del entry["jobs"][jobs]
+        return entry
+
+    def choose(self, host, target, default, candidates, kind="full"):
+        entry = self._entry(self._load(), host, target, kind)
+        times = entry["jobs"]
+        if str(default) not in times:
+            return default
+
+        for candidate in candidates:
+            if str(candidate) not in times:
+                return candidate
+
+        tried = [str(candidate) for candidate in candidates]
+        if entry["builds"] % self.explore_every == self.explore_every - 1:
+            return int(min(tried, key=lambda jobs: times[jobs][-1][0]))
+
+        def median(jobs):
+            seconds = sorted(sample[1] for sample in times[jobs])
+            return seconds[len(seconds) / 2]
+        return int(min(tried, key=median))
+
+    def record(self, host, target, jobs, seconds, kind="full"):
+        history = self._load()
+        entry = self._entry(history, host, target, kind)
+        entry["builds"] += 1
+        times = entry["jobs"].setdefault(str(jobs), [])
+        times.append([time.time(), seconds])
+        del times[:-self.samples]
+
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(history, f, indent=2)
+        os.rename(self.path + ".tmp", self.path)
+
+
+# make targets that configure or clean rather than compile. Their time has
+# little to do with -j, so they aren't tuned.
+UNTUNED_TARGETS = re.compile(r"^(\w*clean|mrproper|\w*config)$")
+
+
 class CISlave(object):
     """Generic CI slave base class"""
+    # Set by the lrn daemon to a daemon.ShellPool, so slaves reuse
+    # connections kept from earlier jobs.
+    shell_pool = None
+    # Slaves created with a list of requirements rather than a reserved
+    # machine lease one from here; None for the default SlavePool().
+    slave_pool = None
+    # False where no one is there to answer a prompt, as in the lrn daemon,
+    # so sudo needing a password is an error rather than a question.
+    interactive = True
+
     def __init__(self, tags=""):
         self.got_machine = False
         self.tags = tags
         self.shell = None
-        self.sudo_password = None
+        # What is known about the machine rather than this connection to
+        # it, see sudo_password and resources. Sessions on the same machine
+        # share it, and sudo_lock, held while finding out about sudo.
+        self.machine = {"sudo password": None, "resources": None}
+        self.sudo_lock = threading.Lock()
         self.return_code_search = re.compile("(\d+)$")
+        self.revision_search = re.compile(
+            r"^ci-revision: ([^\s$]+) ([^\s$]+) (\d+)$")
+        self.rx_bytes_search = re.compile(r"^ci-rx-bytes: (\d+)$")
+
+        # Automatic build parallelism allows this much memory (kB) per job
+        self.memory_per_job = 512 * 1024
+        self.jobs_tuner = JobsTuner()
+
+        # repo checkouts reference a mirror of the manifest's projects kept
+        # here, so new workspaces only fetch what the mirror doesn't have.
+        # Set to None to disable.
+        self.repo_mirror_dir = "~/.cache/ci-runtime/repo-mirrors"
+        # URLs checked out, so a leased host is known to have them
+        self.checked_out = []
+
+        # Replace with a LocalBuildCache to keep build outputs on the machine
+        # running the job rather than the slave.
+        self.build_cache = SlaveBuildCache()
+        self.toolchain_ids = {}
+
+        self.ccache_root = "~/.cache/ci-runtime/ccache"
+        self.ccache_dirs = []
+
+        # use() looks artifacts up here and keeps them on the slave
+        self.artifact_index = ArtifactIndex()
+        self.artifact_store = SlaveArtifactStore()
+        # Set by slaves that can reach the slave's files: an SFTP client
+        # or LocalFiles, and a TransferEngine for those with an SSH
+        # transport. Without a transfer engine, files are copied with
+        # self.sftp.
+        self.sftp = None
+        self.transfer = None
+        # (command, sudo, batch.Output) deferred by batch, None when not in
+        # a batch
+        self.batched = None
+        # Answers to query, and the shell's directory as a key for them.
+        # The directory the shell starts in, or is left in by a command
+        # other than chdir, isn't known, so gets a name of its own.
+        self.query_cache = QueryCache()
+        self.shell_directory = "<start %x>" % id(self)
+        # Held by install_deps. Sessions on the same machine share it, as
+        # only one package manager can run there at a time.
+        self.package_lock = threading.Lock()
         self.disk_image = None
         self.kernel = None
         # Have a few pre-defined classes
 
+    @property
+    def sudo_password(self):
+        """None until sudo has been tried, then the password it needs, ""
+        if none"""
+        return self.machine["sudo password"]
+
+    @sudo_password.setter
+    def sudo_password(self, password):
+        self.machine["sudo password"] = password
+
+    @property
+    def resources(self):
+        """(CPUs, memory in kB) found by host_resources, None until then"""
+        return self.machine["resources"]
+
+    @resources.setter
+    def resources(self, resources):
+        self.machine["resources"] = resources
+
+    def _check_sudo(self):
+        """Find out if sudo needs a password, asking for it if so"""
+        self._in_shell_cmd("sudo -n ls", mutating=False)
+
+        try:
+            self._test_return_code("", "")
+            self.sudo_password = ""
+        except CommandFailed:
+            if not self.interactive:
+                raise RuntimeError(
+                    "sudo needs a password, which can't be asked for here; "
+                    "set up passwordless sudo or run with lrn --no-daemon")
+            import getpass
+            self.sudo_password = getpass.getpass(
+                "Please enter sudo password: ")
+
     def _test_return_code(self, cmd, command_output):
         """Check return code of previous command"""
-        rx = self._in_shell_cmd("echo $?\n", quiet=True)
+        rx = self._in_shell_cmd("echo $?\n", quiet=True, mutating=False)
 
         return_code = None
         for line in rx:
@@ -430,7 +754,7 @@ class CISlave(object):
             return True
 
     def _in_shell_cmd(self, cmd, quiet=False, sudo=False,
-                      expect_response={}):
+                      expect_response={}, mutating=True):
         """Run command in shell. Handles sudo with and without password
 
         The specified command is run, with optional pre-defined interaction,
@@ -443,7 +767,24 @@ class CISlave(object):
         quiet           -- If True, don't log command output
         sudo            -- run command as root using sudo
         expect_response -- dict of {<regexp>: <text to send>}
+        mutating        -- False if the command can't change the slave, so
+                           answers to queries (see query) are kept
         """
+        # Commands deferred by batch have to run first
+        self.flush()
+        if mutating:
+            self.query_cache.changed()
+            # The command could have changed directory too, say with a cd
+            # in a script, so the directory isn't known until chdir
+            self.shell_directory = "<changed %x %d>" % (
+                id(self), self.query_cache.generation)
+            try:
+                return self._in_shell_cmd(cmd, quiet, sudo, expect_response,
+                                          mutating=False)
+            finally:
+                # Another session sharing the cache could have queried the
+                # slave while the command ran, seeing it half done
+                self.query_cache.changed()
 
         if sudo:
             # Test to see if we need a password for sudo. We do this by
@@ -452,16 +793,9 @@ class CISlave(object):
             # prompt being given.
             cmd = "sudo " + cmd
 
-            if self.sudo_password is None:
-                self._in_shell_cmd("sudo -n ls")
-
-                try:
-                    self._test_return_code("", "")
-                    self.sudo_password = ""
-                except CommandFailed:
-                    if not self.sudo_password:
-                        self.sudo_password = getpass.getpass(
-                            "Please enter sudo password: ")
+            with self.sudo_lock:
+                if self.sudo_password is None:
+                    self._check_sudo()
 
         sent_sudo_password = False
         sleep_seconds_reset = 0.0001
@@ -588,12 +922,83 @@ class CISlave(object):
         # an SSH command.
         return self.lines[1:-1]
 
-    def _cmd(self, cmd, sudo=False, expect_response={}):
+    def _cmd(self, cmd, sudo=False, expect_response={}, defer=False,
+             mutating=True):
+        """Run cmd, raising CommandFailed if it fails. Returns its output.
+
+        With defer, in a batch, the command is added to the batch instead
+        and a batch.Output is returned. mutating is as for _in_shell_cmd.
+        """
+        if defer and self.batched is not None and not expect_response:
+            output = batch.Output(self.flush)
+            self.batched.append((cmd, sudo, output))
+            return output
+
         rx = self._in_shell_cmd(cmd, sudo=sudo,
-                                expect_response=expect_response)
+                                expect_response=expect_response,
+                                mutating=mutating)
         self._test_return_code(cmd, rx)
         return rx
 
+    @contextlib.contextmanager
+    def batch(self):
+        """Send the commands run in a with block to the slave together
+
+        Inside "with slave.batch():", cmd, mkdir, chdir, copy, move, rm,
+        in_directory, set_env and append_to_file are recorded rather than
+        run. They are uploaded as one script and run in a single round trip
+        when the block ends, or as soon as the job needs anything else from
+        the slave, including reading the output of a recorded cmd. If one
+        fails, the rest aren't run and CommandFailed is raised then, rather
+        than by the call that recorded it.
+        """
+        if self.batched is not None:
+            # Already in a batch
+            yield
+            return
+
+        self.batched = []
+        try:
+            yield
+            self.flush()
+        finally:
+            if self.batched:
+                logging.warning("batch: not running %d commands after an "
+                                "error" % len(self.batched))
+            self.batched = None
+
+    def flush(self):
+        """Run the commands batch has deferred"""
+        if not self.batched:
+            return
+        pending, self.batched[:] = list(self.batched), []
+
+        if len(pending) == 1 or (self.sftp is None and
+                                 self.transfer is None):
+            # Not worth a script, or nowhere to upload one to
+            for command, sudo, output in pending:
+                output.set(self._cmd(command, sudo=sudo))
+            return
+
+        if any(sudo for _, sudo, _ in pending) and self.sudo_password != "":
+            # Get sudo its password now, the script can't answer it
+            self._cmd("true", sudo=True)
+
+        path = "/tmp/ci-batch-%x.sh" % random.getrandbits(64)
+        self.write_file(path, batch.script(
+            [("sudo " if sudo else "") + command
+             for command, sudo, _ in pending], path))
+        rx = self._in_shell_cmd(batch.run_command(path))
+
+        results = batch.parse(rx)
+        for (command, _, output), (status, lines) in zip(pending, results):
+            output.set(lines)
+            if status != 0:
+                raise CommandFailed(command, str(status), lines)
+        if len(results) < len(pending):
+            # The script stopped without saying why
+            raise CommandFailed(pending[len(results)][0], "unknown", rx)
+
     def wait_for_prompt(self, expect_response={}):
         """Don't run a command, just wait for a prompt"""
         return self._in_shell_cmd(None, sudo=False,
@@ -610,7 +1015,34 @@ class CISlave(object):
         """
         logging.info("cmd: %s #%s" % (command, comment))
 
-        return self._cmd(command, sudo=sudo)
+        return self._cmd(command, sudo=sudo, defer=True)
+
+    def query(self, command, comment, sudo=False, stable=False):
+        """Run a command that only reads the slave's state, like cmd
+
+        The output is kept and given back when the same command is run in
+        the same directory, until a command that could change the slave is
+        run or a file is sent to it. With stable, the output is kept for
+        the rest of the run: use it for answers nothing the job does will
+        change. Only use query for commands that change nothing.
+        """
+        self.flush()
+        key = (command, sudo, self.shell_directory)
+        generation, output = self.query_cache.get(key, stable)
+        if output is not None:
+            logging.info("query: %s #%s (cached, %d hits)" % (
+                command, comment, self.query_cache.hits[key]))
+            return output
+
+        logging.info("query: %s #%s" % (command, comment))
+        output = self._cmd(command, sudo=sudo, mutating=False)
+        self.query_cache.put(key, generation, output, stable)
+        return output
+
+    def _changing_files(self):
+        """Called before files on the slave are changed by a transfer"""
+        self.flush()
+        self.query_cache.changed()
 
     def boot(self):
         # TODO: Command not implemented
@@ -621,7 +1053,7 @@ class CISlave(object):
         logging.info("disconnect")
 
     def checkout(self, vcs_type, url, branch=None, filename=None, depth=None,
-                 name=""):
+                 name="", jobs=None):
         """Check out from VCS. Update if checkout already exists.
 
         Check out from the given URL. If a directory with the same name
@@ -629,9 +1061,17 @@ class CISlave(object):
         updating we check that the directory really is a checkout of the
         same repository. This seems to work apart from Bazaar branches where
         the repo URL is translated on-server.
+
+        Returns a Checkout recording the revisions that were checked out.
+
+        For repo, jobs is the number of projects to sync in parallel. It
+        defaults to the number of CPUs on the slave.
         """
         logging.info("checkout: %s, %s, %s, %s" %
                      (vcs_type, url, branch, filename))
+        self.checked_out.append(url)
+
+        output = []
 
         if vcs_type == "repo":
             self._cmd("pwd")
@@ -649,6 +1089,20 @@ class CISlave(object):
                 else:
                     raise
 
+            if jobs is None:
+                jobs = self.cpu_count()
+
+            start_time = time.time()
+            output = self._cmd(RX_BYTES)
+
+            reference = ""
+            if self.repo_mirror_dir:
+                # Absolute, as the shell doesn't expand ~ in --reference=~/
+                mirror = os.path.join(self.expand_path(self.repo_mirror_dir),
+                                      hashlib.sha1(url).hexdigest())
+                self._update_repo_mirror(mirror, url, branch, filename, jobs)
+                reference = "--reference=%s " % mirror
+
             # Check if repo has already been init'd
             is_branch_of_url = False
             if self.isdir(".repo/manifests"):
@@ -660,6 +1114,8 @@ class CISlave(object):
                         is_branch_of_url = True
                         break
 
+                self.chdir("../..")
+
             # If repo doesn't exist, init it.
             if not is_branch_of_url:
                 cmd_string = "~/bin/repo init -u %s " % url
@@ -667,10 +1123,19 @@ class CISlave(object):
                     cmd_string += "-b %s " % branch
                 if filename:
                     cmd_string += "-m %s " % filename
-                self._cmd(cmd_string)
+                self._cmd(cmd_string + reference)
 
-            # Pull files from git repositories that repo points to.
-            self._cmd("~/bin/repo sync")
+            # Pull files from git repositories that repo points to, only
+            # fetching the branches the manifest asks for. In the same round
+            # trip, report the revision of every project and bytes received.
+            output += self._cmd(
+                "~/bin/repo sync -j%d --current-branch && "
+                "~/bin/repo forall -c '%s' && %s" %
+                (jobs, GIT_REVISION % "$REPO_PATH", RX_BYTES))
+
+            sync_seconds = time.time() - start_time
+            rx_bytes = [int(m.group(1)) for m in
+                        map(self.rx_bytes_search.search, output) if m]
 
         elif vcs_type == "git":
             arg_string = ""
@@ -698,12 +1163,14 @@ class CISlave(object):
                 if is_branch_of_url:
                     self._cmd("git stash")
                     self._cmd("git reset --hard")
-                    self._cmd("git pull")
+                    output = self._cmd("git pull && " + GIT_REVISION % ".")
 
                 self.chdir("..")
 
             if not is_branch_of_url:
-                self._cmd("git clone %s %s" % (arg_string, url))
+                output = self._cmd("git clone %s %s && (cd %s && %s)" %
+                                   (arg_string, url, dirname,
+                                    GIT_REVISION % "."))
 
         elif vcs_type == "bzr":
             # If already checked out, update, else, clone
@@ -730,7 +1197,7 @@ class CISlave(object):
                             break
 
                 if is_branch_of_url:
-                    self._cmd("bzr update")
+                    output = self._cmd("bzr update && " + BZR_REVISION)
 
                 self.chdir("..")
 
@@ -739,9 +1206,127 @@ class CISlave(object):
                     self._cmd("rm -rf " + dirname)
 
             if not is_branch_of_url:
-                self._cmd("bzr checkout --quiet %s %s" % (url, name))
+                output = self._cmd(
+                    "bzr checkout --quiet %s %s && (cd %s && %s)" %
+                    (url, name, dirname, BZR_REVISION))
+
+        checkout = self._checkout_info(vcs_type, url, branch, output)
+
+        if vcs_type == "repo":
+            checkout.sync_seconds = sync_seconds
+            if len(rx_bytes) == 2:
+                checkout.bytes_transferred = rx_bytes[1] - rx_bytes[0]
+            logging.info("checkout: repo sync took %.1fs, %s bytes received" %
+                         (checkout.sync_seconds, checkout.bytes_transferred))
+
+        return checkout
 
-        return Checkout()
+    def expand_path(self, path):
+        """path with a leading ~ replaced by the home directory on the slave
+        """
+        if not path.startswith("~"):
+            return path
+        home = self.query("echo $HOME", "find the home directory",
+                          stable=True)[0]
+        return home + path[1:]
+
+    def _update_repo_mirror(self, mirror, url, branch, filename, jobs):
+        """Create or update the repo mirror of the projects in a manifest"""
+        init = "~/bin/repo init --mirror -u %s " % url
+        if branch:
+            init += "-b %s " % branch
+        if filename:
+            init += "-m %s " % filename
+
+        # Run in a sub-shell so we stay in the current directory
+        self._cmd("(mkdir -p %s && cd %s && (test -d .repo || %s) && "
+                  "~/bin/repo sync -j%d)" % (mirror, mirror, init, jobs))
+
+    def _checkout_info(self, vcs_type, url, branch, output):
+        """Build a Checkout from the revision lines in checkout output"""
+        revisions = {}
+        dirty = False
+        for line in output:
+            revision_search = self.revision_search.search(line)
+            if revision_search:
+                path, revision, changes = revision_search.groups()
+                revisions[path] = revision
+                if int(changes):
+                    dirty = True
+
+        checkout = Checkout(vcs_type, url, branch, revisions, dirty)
+        logging.info("checkout: %s revision(s), dirty=%s, uid=%s" %
+                     (len(revisions), dirty, checkout.uid))
+        return checkout
+
+    def host_resources(self):
+        """(CPUs, memory in kB) of the slave, queried once.
+
+        Memory is None if it couldn't be found.
+        """
+        if self.resources is None:
+            self.resources = (1, None)
+            rx = self.query('echo "ci-host: $(nproc) '
+                            '$(awk \'/^MemTotal:/ {print $2}\' '
+                            '/proc/meminfo)"', "CPUs and memory")
+            for line in rx:
+                host_search = re.search(r"^ci-host: (\d+) (\d+)?$", line)
+                if host_search:
+                    memory = host_search.group(2)
+                    self.resources = (int(host_search.group(1)),
+                                      memory and int(memory))
+        return self.resources
+
+    def cpu_count(self):
+        """Number of CPUs on the slave (queried once)"""
+        return self.host_resources()[0]
+
+    def host_name(self):
+        """Name of the machine, as given in the slave's configuration"""
+        config = getattr(self, "config", {})
+        if "reserved" in config:
+            return config["reserved"]["hostname"]
+        return "unknown"
+
+    def _build_jobs(self, target, kind="full"):
+        """Choose -j for a build when the caller didn't
+
+        Start with one job per CPU, limited so each job has memory_per_job
+        kB. With a jobs_tuner, also try half and one and a half times that
+        on this host, target and kind of build, then use the fastest.
+        Targets that only configure or clean (see UNTUNED_TARGETS) aren't
+        tuned.
+        """
+        cpus, memory = self.host_resources()
+        jobs = cpus
+        if memory:
+            jobs = min(jobs, memory / self.memory_per_job)
+        jobs = max(1, jobs)
+
+        if(not self.jobs_tuner or
+           [part for part in re.split(r"[\s+]+", target)
+            if UNTUNED_TARGETS.search(part)]):
+            return jobs, "auto"
+
+        candidates = sorted(set([max(1, jobs / 2), jobs, jobs + jobs / 2]))
+        if memory:
+            candidates = [candidate for candidate in candidates if
+                          candidate == 1 or
+                          candidate * self.memory_per_job <= memory]
+        return self.jobs_tuner.choose(self.host_name(), target, jobs,
+                                      candidates, kind), "tuned"
+
+    def _add_make_jobs(self, build_command, jobs, load):
+        """Add -j<jobs> -l<load> after the first make in build_command"""
+        if re.search(r"(^|\s)(-j\s*\d*|--jobs)(\s|=|$)", build_command):
+            logging.info("build: command sets its own jobs, leaving it alone")
+            return build_command
+
+        make = re.compile(r"(^|[\s;|&(])make(?=\s|$)")
+        if not make.search(build_command):
+            return build_command
+        return make.sub(r"\1make -j%d -l%d" % (jobs, load), build_command,
+                        count=1)
 
     def install_deps(self, packages):
         """Generic interface to the system package manager.
@@ -751,72 +1336,82 @@ class CISlave(object):
         """
         logging.info("install_deps: %s" % (" ".join(packages)))
 
-        install_packages = []
-        for package in packages:
-            rx = self._in_shell_cmd("dpkg -l %s" % package)
-            for line in rx:
-                if re.search("no packages found matching", line,
-                             re.IGNORECASE):
-                    install_packages.append(package)
-        if len(install_packages):
-            self._cmd("apt-get update --fix-missing", sudo=True)
-            self._cmd("apt-get -yq install %s" % " ".join(install_packages),
-                      sudo=True)
+        with self.package_lock:
+            install_packages = []
+            for package in packages:
+                rx = self._in_shell_cmd("dpkg -l %s" % package)
+                for line in rx:
+                    if re.search("no packages found matching", line,
+                                 re.IGNORECASE):
+                        install_packages.append(package)
+            if len(install_packages):
+                self._cmd("apt-get update --fix-missing", sudo=True)
+                self._cmd("apt-get -yq install %s" %
+                          " ".join(install_packages), sudo=True)
 
     def use(self, name, tags):
         """Use the output of another job as an input to this job
 
-        TODO: Currently this is quite the hack and it should use a database
-        rather than fixed paths. Suggest JSON in a known web accessible
-        location. Should also support user supplied data.
+        The artifact with name and all of tags is looked up in
+        self.artifact_index, downloaded and checked against its sha256
+        into a cache on the slave, extracted there once and linked into the
+        current directory under the name the index gives it.
         """
         logging.info("use: %s, %s" % (name, " ".join(tags)))
 
-        # This is a massive hack and really doesn't work for anything other
-        # than the intial investigation phase
-        if name == "android-toolchain":
-            self._cmd(
-                "wget -nc -nv --no-check-certificate "
-                "http://android-build.linaro.org/download/"
-                "linaro-android_toolchain-4.7-bzr/lastSuccessful/archive/"
-                "build/out/"
-                "android-toolchain-eabi-4.7-daily-linux-x86.tar.bz2")
-            self._cmd("tar -jxvf android-toolchain-eabi-*")
-
-        if name == "linaro-gnu-toolchain":
-            rx = self._cmd("find -type d -name toolchain")
-            if "./toolchain" not in rx:
-                # Don't bother re-downloading the toolchain
-                self._cmd("wget -nc -nv --no-check-certificate "
-                          "https://releases.linaro.org/13.03/components/"
-                          "toolchain/binaries/gcc-linaro-arm-linux-gnueabihf-"
-                          "4.7-2013.03-20130313_linux.tar.bz2")
-                self.mkdir("toolchain")
-                self._cmd("tar -C \"toolchain\"  --strip-components 1 -xf "
-                          "gcc-linaro-arm-linux-gnueabihf-*")
+        artifact = self.artifact_index.find(name, tags)
+        start_time = time.time()
+        self.artifact_store.fetch(self, artifact)
+        logging.info("use: %s ready as %s in %.1fs" %
+                     (artifact.url, artifact.directory,
+                      time.time() - start_time))
 
     def build(self,
               target="make",
               build_command="make",
-              jobs=1,
+              jobs=None,
               cached=False,
               source_uid=None,
               env="",
-              expect_response={}):
+              expect_response={},
+              outputs=None,
+              toolchain=None,
+              ccache=False,
+              ccache_size="10G",
+              kind="full"):
         """Call a build command, such as "make"
         Theory of wrapping builds is to make them more easily shared - if the
         same source is used, the same output will be produced, so if we
-        publish a build, this command should be able to skip a lengthy make
-        step with a shorter download. (TODO)
+        have already stored the output of a build, this command can skip a
+        lengthy make step and restore the stored files instead.
 
          * build_command: Command to run
-         * target: target to pass to build command
-         * jobs: How many CPUs wide to run the make job
+         * target: target to pass to build command. Also names the build
+                   when remembering how many jobs were fastest.
+         * jobs: How many CPUs wide to run the make job. By default this
+                 is chosen from the slave's CPUs and memory, and tuned over
+                 time by self.jobs_tuner. make is also given a load average
+                 limit of the number of CPUs.
          * cached: If we have already run this build on this source, use
                    cached result if available.
          * source_uid: UID of source checkout (for example VCS URL+rev)
          * env: environment string for command (?? do we need this or just make
                 it part of build command??)
+         * outputs: Files, directories or globs (relative to the current
+                    directory) that the build produces. Needed for cached.
+         * toolchain: Path prefix of the compiler, for example
+                      "toolchain/bin/arm-linux-gnueabihf-". Identifies the
+                      toolchain in the cache key.
+         * ccache: Compile through ccache, installing it if needed. The
+                   cache directory is per toolchain with a size limit of
+                   ccache_size. Hit rate and time saved are logged.
+         * kind: What sort of build this is, for example "full" or
+                 "incremental". Tuning jobs only compares the times of
+                 builds of the same kind.
+
+        The cache key is made from the source UID, build command, target,
+        environment and toolchain identity. Outputs are stored in
+        self.build_cache, which is on the slave unless replaced.
         """
         logging.info("build:\n %s\n %s\n jobs=%s\n cached=%s\n"
                      " source_uuid=%s\n env=%s" %
@@ -827,26 +1422,185 @@ class CISlave(object):
                       source_uid,
                       env))
 
-        self._cmd(build_command, expect_response=expect_response)
+        key = None
+        if cached:
+            if source_uid and outputs:
+                key = build_key(source_uid, build_command, target, env,
+                                self.toolchain_id(toolchain))
+            else:
+                logging.info("build: not cached, need source_uid and outputs")
+
+        if key and self.build_cache.restore(self, key):
+            logging.info("build: restored %s from cache (key %s)" %
+                         (" ".join(outputs), key))
+            self.build_cache.log_stats()
+            return
+
+        if jobs is None:
+            jobs, how = self._build_jobs(target, kind)
+        else:
+            how = "requested"
+        load = self.cpu_count()
+        build_command = self._add_make_jobs(build_command, jobs, load)
+        logging.info("build: jobs=%d (%s), load limit %d" % (jobs, how, load))
+
+        if env:
+            build_command = env + " " + build_command
+
+        if ccache:
+            ccache_dir = self._ccache_dir(toolchain, ccache_size)
+            build_command = self._ccache_wrap(build_command, toolchain,
+                                              ccache_dir)
+
+        start_time = time.time()
+        output = self._cmd(build_command, expect_response=expect_response)
+        build_seconds = time.time() - start_time
+
+        if ccache:
+            self._log_ccache_stats(output, build_seconds)
+
+        if how == "tuned":
+            self.jobs_tuner.record(self.host_name(), target, jobs,
+                                   build_seconds, kind)
+
+        if key:
+            self.build_cache.store(self, key, outputs)
+            self.build_cache.log_stats()
+
+    def toolchain_id(self, toolchain=None):
+        """Identify a toolchain by the hash of its C compiler
+
+        toolchain is the compiler's path prefix (None for the system gcc).
+        """
+        compiler = (toolchain or "") + "gcc"
+        if compiler in self.toolchain_ids:
+            return self.toolchain_ids[compiler]
+        rx = self._in_shell_cmd(
+            'echo "ci-toolchain: $(sha256sum < "$(command -v %s)" | '
+            'cut -d" " -f1)"' % compiler, quiet=True, mutating=False)
+        for line in rx:
+            toolchain_search = re.search(r"^ci-toolchain: ([0-9a-f]{64})$",
+                                         line)
+            if toolchain_search:
+                self.toolchain_ids[compiler] = toolchain_search.group(1)
+                return self.toolchain_ids[compiler]
+
+        logging.warning("build: can't hash %s, using its name in the cache key"
+                        % compiler)
+        return compiler
+
+    def _ccache_dir(self, toolchain, size):
+        """Set up (once) a ccache directory for toolchain on this slave"""
+        ccache_dir = os.path.join(self.ccache_root,
+                                  self.toolchain_id(toolchain)[:16])
+        if ccache_dir not in self.ccache_dirs:
+            if not self.ccache_dirs:
+                self.install_deps(["ccache"])
+            self._cmd("CCACHE_DIR=%s ccache -M %s" % (ccache_dir, size))
+            self.ccache_dirs.append(ccache_dir)
+        return ccache_dir
+
+    def _ccache_wrap(self, build_command, toolchain, ccache_dir):
+        """Make build_command compile through ccache
+
+        Cross builds that pass CROSS_COMPILE get "ccache " put in front of
+        the prefix, Android builds get USE_CCACHE=1 and anything else gets
+        CC set to ccache and the toolchain's gcc. The command is run in a
+        sub-shell that zeroes the ccache statistics first and prints them
+        after, keeping the command's exit status.
+        """
+        cross_compile = re.compile(r"""CROSS_COMPILE=(["']?)""")
+        if cross_compile.search(build_command):
+            build_command = cross_compile.sub(r"CROSS_COMPILE=\1ccache ",
+                                              build_command, count=1)
+        elif "TARGET_TOOLS_PREFIX=" in build_command:
+            build_command = "USE_CCACHE=1 " + build_command
+        else:
+            build_command = 'CC="ccache %sgcc" %s' % (toolchain or "",
+                                                      build_command)
+
+        return ("(export CCACHE_DIR=%s; ccache -z > /dev/null; %s; r=$?; "
+                "ccache -s; exit $r)" % (ccache_dir, build_command))
+
+    def _log_ccache_stats(self, output, build_seconds):
+        """Log hit rate and estimated time saved from ccache -s output
+
+        Each hit is assumed to save as long as an average miss took, which
+        is the build time divided by the number of misses. This over
+        estimates a little because the build time includes linking.
+        """
+        hits = 0
+        misses = 0
+        for line in output:
+            if re.search(r"^(Local|Remote) storage:", line):
+                # ccache 4 repeats the totals per storage backend
+                break
+
+            # ccache 3 reports "cache hit (direct) 10", ccache 4 "Hits: 10"
+            search = re.search(r"^\s*(cache hit \(\w+\)|Hits:)\s+(\d+)",
+                               line)
+            if search:
+                hits += int(search.group(2))
+            search = re.search(r"^\s*(cache miss|Misses:)\s+(\d+)", line)
+            if search:
+                misses += int(search.group(2))
+
+        if hits + misses == 0:
+            logging.info("ccache: no compiler calls were cached")
+            return
+
+        saved = ""
+        if misses:
+            saved = ", about %ds saved" % (hits * build_seconds / misses)
+        logging.info("ccache: %d%% hit rate (%d hits, %d misses)%s" %
+                     (100 * hits / (hits + misses), hits, misses, saved))
 
     def in_directory(self, directory, sudo=False):
-        self._cmd("mkdir -p " + directory, sudo=sudo)
-        self._cmd("cd " + directory)
+        self._cmd("mkdir -p " + directory, sudo=sudo, defer=True)
+        self.chdir(directory)
 
     def mkdir(self, directory, sudo=False):
-        self._cmd("mkdir -p " + directory, sudo=sudo)
+        self._cmd("mkdir -p " + directory, sudo=sudo, defer=True)
 
     def chdir(self, directory):
-        self._cmd("cd " + directory)
+        self._cmd("cd " + directory, defer=True, mutating=False)
+        self.shell_directory = change_directory(self.shell_directory,
+                                                directory)
 
     def copy(self, source, dest, sudo=False):
-        self._cmd("cp %s %s" % (source, dest), sudo=sudo)
+        self._cmd("cp %s %s" % (source, dest), sudo=sudo, defer=True)
 
     def move(self, source, dest, sudo=False):
-        self._cmd("mv %s %s" % (source, dest), sudo=sudo)
+        self._cmd("mv %s %s" % (source, dest), sudo=sudo, defer=True)
 
     def ls(self, target="", sudo=False):
-        return self._cmd("ls %s" % (target), sudo=sudo)
+        return self.query("ls %s" % (target), "list files", sudo=sudo)
+
+    def stat_many(self, paths, base_dir=".", sha256=False, recursive=False,
+                  jobs=4):
+        """Describe many paths on the slave in one round trip
+
+        Returns {path: FileStat} for the paths (relative to base_dir) that
+        exist. With sha256, regular files are hashed, jobs at a time. With
+        recursive, everything under directories is included too.
+        """
+        return dict((stat.path, stat) for stat in remote_fs.parse_stats(
+            self.query(remote_fs.stat_command(
+                paths, base_dir=base_dir, sha256=sha256,
+                recursive=recursive, jobs=jobs), "describe files")))
+
+    def glob(self, patterns, base_dir=".", sha256=False, recursive=False,
+             jobs=4):
+        """Return [FileStat] for what shell glob patterns match on the slave
+
+        patterns is a pattern or a list of them, relative to base_dir. The
+        other arguments are as for stat_many. Sorted by path.
+        """
+        if isinstance(patterns, basestring):
+            patterns = [patterns]
+        return remote_fs.parse_stats(self.query(remote_fs.glob_command(
+            patterns, base_dir=base_dir, sha256=sha256, recursive=recursive,
+            jobs=jobs), "find files"))
 
     def set_disk_image(self, image):
         self.disk_image = image
@@ -855,28 +1609,193 @@ class CISlave(object):
         self.kernel = kernel
 
     def append_to_file(self, string, file_name):
-        self._cmd('echo "%s" >> %s' % (string, file_name))
+        self._cmd('echo "%s" >> %s' % (string, file_name), defer=True)
 
     def cwd(self):
-        return self._cmd("pwd")[0]
+        return self.query("pwd", "find the current directory")[0]
 
     def set_env(self, name, value):
-        self._cmd("export %s='%s'" % (name, value))
-
-    def publish(self, base_dir, glob_list, destination, license_name):
-        # TODO: Command not implemented
-        pass
+        self._cmd("export %s='%s'" % (name, value), defer=True)
+
+    def publish(self, base_dir, glob_list, destination, server_config,
+                license_name=None, jobs=4, retries=3):
+        """Publish files on the slave to a linaro-license-protection server
+
+        Every file in base_dir matching a glob in glob_list is uploaded to
+        destination (a path on the server, as for publish_file), keeping
+        its path relative to base_dir. Uploads run jobs at a time over
+        kept-alive connections and transient failures are retried up to
+        retries times, backing off between tries.
+
+        If server_config["dedup"] is set, the server is asked which files'
+        content it already has (by sha256) and those are linked on the
+        server instead of being uploaded again.
+
+        Returns the manifest: a list of dicts with the path, size, sha256,
+        url and seconds of each file, whether it was linked and the bytes
+        that saved. Raises CommandFailed, after every upload has been
+        tried, if any failed.
+        """
+        logging.info("publish: %s from %s to %s" %
+                     (" ".join(glob_list), base_dir, destination))
+        manifest = [{"path": stat.path, "size": stat.size,
+                     "sha256": stat.sha256}
+                    for stat in self.glob(glob_list, base_dir, sha256=True,
+                                          jobs=jobs)
+                    if stat.type == "file"]
+        if not manifest:
+            logging.info("publish: no files match")
+            return manifest
+
+        start_time = time.time()
+        for entry in manifest:
+            entry["linked"] = False
+        if server_config.get("dedup"):
+            existing = publish.parse_exists(self._in_shell_cmd(
+                publish.exists_command(manifest, server_config), quiet=True))
+            for entry in manifest:
+                entry["linked"] = entry["sha256"] in existing
+
+        statuses = self._publish_upload(base_dir, manifest, server_config,
+                                        destination, jobs, retries,
+                                        license_name)
+        # Content can go from the server between asking and linking
+        relink = [entry for entry in manifest
+                  if entry["linked"] and statuses[entry["path"]] // 100 != 2]
+        for entry in relink:
+            logging.info("publish: can't link %s, uploading it" %
+                         entry["path"])
+            entry["linked"] = False
+        if relink:
+            statuses.update(self._publish_upload(
+                base_dir, relink, server_config, destination, jobs, retries,
+                license_name))
+        seconds = time.time() - start_time
+
+        failed = []
+        for entry in manifest:
+            entry["saved"] = entry["size"] if entry["linked"] else 0
+            status = statuses[entry["path"]]
+            if status // 100 == 2:
+                logging.info("publish: %(path)s %(size)d bytes "
+                             "sha256 %(sha256)s in %(seconds).2fs" % entry +
+                             (" (linked)" if entry["linked"] else ""))
+            else:
+                logging.error("publish: %s failed (HTTP status %s)" %
+                              (entry["path"], status))
+                failed.append(entry["path"])
+
+        logging.info("publish: %d files, %d bytes in %.1fs, %d bytes saved "
+                     "by linking" %
+                     (len(manifest), sum(entry["size"] for entry in manifest),
+                      seconds, sum(entry["saved"] for entry in manifest)))
+        if failed:
+            raise CommandFailed("publish", "1",
+                                ["failed: " + path for path in failed])
+        return manifest
+
+    def _publish_upload(self, base_dir, entries, server_config, destination,
+                        jobs, retries, license_name):
+        """Upload or link entries, return {path: HTTP status}"""
+        cmd = publish.upload_command(base_dir, entries, server_config,
+                                     destination, jobs, retries, license_name)
+        # The key is in the command, so don't log it
+        uploads = publish.parse_uploads(self._in_shell_cmd(cmd, quiet=True))
+
+        statuses = {}
+        for entry in entries:
+            if entry["linked"]:
+                url = publish.link_url(server_config, destination,
+                                       entry["path"])
+            else:
+                url = publish.upload_url(server_config, destination,
+                                         entry["path"])
+            entry["url"] = publish.upload_url(server_config, destination,
+                                              entry["path"])
+            statuses[entry["path"]], entry["seconds"] = uploads.get(
+                url, (0, None))
+        return statuses
 
     def write_file(self, path, contents):
+        self._changing_files()
+        if self.transfer:
+            self.transfer.write(path, contents)
+            return
+
         f = self.sftp.open(path, "w")
         f.write(contents)
         f.close()
 
     def file_open(self, path, mode="r"):
+        if mode.startswith("r") and "+" not in mode:
+            self.flush()
+        else:
+            self._changing_files()
         return self.sftp.open(path, mode)
 
     def put_file(self, local_path, remote_path):
-        self.sftp.put(local_path, remote_path)
+        """Copy local_path to remote_path on the slave
+
+        Skipped if remote_path is unchanged; see TransferEngine.
+        """
+        self._changing_files()
+        if self.transfer:
+            self.transfer.put(local_path, remote_path)
+        else:
+            self.sftp.put(local_path, remote_path)
+
+    def get_file(self, remote_path, local_path):
+        """Copy remote_path on the slave to local_path"""
+        self.flush()
+        if self.transfer:
+            self.transfer.get(remote_path, local_path)
+        else:
+            self.sftp.get(remote_path, local_path)
+
+    def put_files(self, pairs):
+        """Copy each (local_path, remote_path) in pairs to the slave"""
+        self._changing_files()
+        if self.transfer:
+            self.transfer.put_files(pairs)
+        else:
+            for local_path, remote_path in pairs:
+                self.sftp.put(local_path, remote_path)
+
+    def get_files(self, pairs):
+        """Copy each (remote_path, local_path) in pairs from the slave"""
+        self.flush()
+        if self.transfer:
+            self.transfer.get_files(pairs)
+        else:
+            for remote_path, local_path in pairs:
+                self.sftp.get(remote_path, local_path)
+
+    def sync_dir(self, local, remote, direction="push", delete=False,
+                 exclude=()):
+        """Make one directory tree a copy of another, like rsync
+
+        direction is "push" to copy local to remote on the slave, or "pull"
+        to copy remote to local. Files with the same size and modification
+        time are skipped and changed files send only the blocks that
+        differ, or are copied whole on slaves without SSH. If delete is
+        True, files missing from the source are deleted from the
+        destination. exclude is a list of glob patterns matched against
+        names and relative paths; excluded files are neither copied nor
+        deleted.
+
+        Returns a SyncResult saying what was transferred.
+        """
+        self._changing_files()
+        if self.transfer:
+            sync = DirectorySync(self.transfer)
+        elif isinstance(self.sftp, LocalFiles):
+            sync = LocalDirectorySync(self.sftp)
+        elif self.sftp is not None:
+            sync = SlaveDirectorySync(self)
+        else:
+            raise IOError("sync_dir: the slave has no way to copy files")
+
+        return sync.sync(local, remote, direction, delete, exclude)
 
     def publish_file(self, local_path, remote_path, server_config):
         """Publish a file from the current slave to the specified server"""
@@ -894,13 +1813,13 @@ class CISlave(object):
 
     def isdir(self, path):
         try:
-            self._cmd("test -d " + path)
+            self.query("test -d " + path, "is it a directory")
         except CommandFailed:
             return False
         return True
 
     def rm(self, path):
-        return self._cmd("rm " + path)
+        return self._cmd("rm " + path, defer=True)
 
 
 class x86_64(CISlave):
@@ -916,6 +1835,18 @@ class x86_64(CISlave):
 
     def get_machine(self):
         self.prompt = r"ci_lava_target_machine \#: "
+        if isinstance(self.config, (list, tuple)):
+            # A list of requirements, like ["cpus 4", "memory 8GB"]: lease
+            # a host that meets them from the slave pool.
+            self.lease = (self.slave_pool or SlavePool()).lease(self.config)
+            self.lease.keep_alive()
+            atexit.register(self._release_lease)
+            self.config = {"reserved": {"hostname": self.lease.hostname,
+                                        "username": self.lease.username}}
+
+        if self.shell_pool is not None and self.shell_pool.lease(self):
+            return
+
         if "reserved" in self.config:
             if self.config["reserved"]["hostname"] == "localhost":
                 # Special case: We don't get an SSH connection to localhost,
@@ -926,6 +1857,33 @@ class x86_64(CISlave):
             else:
                 self.shell = SSHShell(self.config, self.prompt)
                 self.sftp = self.shell.sftp  # Yea, ugly hack for now.
+                self.transfer = self.shell.transfer
+
+        if self.shell_pool is not None:
+            self.shell_pool.add(self)
+
+    def _release_lease(self):
+        """Give the leased host back, noting what was checked out on it"""
+        self.lease.release(self.checked_out)
+
+    def new_session(self, screen_name):
+        """Connect to the same machine again, with a shell of its own.
+
+        screen_name names the new connection's GNU Screen session so it
+        doesn't take over this one's.
+        """
+        session = x86_64(dict(self.config, **{"screen name": screen_name}))
+        # The same files, so the same answers
+        session.query_cache = self.query_cache
+        session.package_lock = self.package_lock
+        # and what is known about the machine, including what the job has
+        # done there, shared rather than found out again
+        session.machine = self.machine
+        session.sudo_lock = self.sudo_lock
+        session.checked_out = self.checked_out
+        session.toolchain_ids = self.toolchain_ids
+        session.ccache_dirs = self.ccache_dirs
+        return session
 
 
 class Snowball(CISlave):
@@ -946,8 +1904,91 @@ class Panda(CISlave):
     pass
 
 
+class LazyValue(object):
+    """A configuration value only worked out when something uses it.
+
+    function is called with no arguments the first time the value is
+    needed, and the result is kept for the rest of the run. If cache_key is
+    given, the result is also kept in cache_dir and re-used by later runs
+    for ttl seconds.
+
+    Put in a ConfigDict, looking the key up gives the value. Formatting a
+    LazyValue, as "{key}".format(**config) does, resolves it too.
+    """
+    def __init__(self, function, cache_key=None, ttl=3600,
+                 cache_dir="~/.cache/ci-runtime/config"):
+        self.function = function
+        self.cache_key = cache_key
+        self.ttl = ttl
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.resolved = False
+        self.value = None
+
+    def _cache_path(self):
+        return os.path.join(self.cache_dir,
+                            hashlib.sha1(self.cache_key).hexdigest() + ".json")
+
+    def get(self):
+        if self.resolved:
+            return self.value
+
+        if self.cache_key is not None:
+            cache_path = self._cache_path()
+            if(os.path.isfile(cache_path) and
+               time.time() - os.path.getmtime(cache_path) < self.ttl):
+                with open(cache_path) as f:
+                    self.value = json.load(f)["value"]
+                self.resolved = True
+                return self.value
+
+        self.value = self.function()
+        self.resolved = True
+
+        if self.cache_key is not None:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with open(cache_path + ".tmp", "w") as f:
+                json.dump({"key": self.cache_key, "value": self.value}, f)
+            os.rename(cache_path + ".tmp", cache_path)
+        return self.value
+
+    def __str__(self):
+        return str(self.get())
+
+    def __format__(self, format_spec):
+        return format(self.get(), format_spec)
+
+
+class ConfigDict(dict):
+    """A dict of job configuration that resolves LazyValues when read.
+
+    Nested dicts are made ConfigDicts too, so config["env"]["os image"]
+    only does the work behind "os image" when that line runs.
+    """
+    def __init__(self, *args, **kwargs):
+        super(ConfigDict, self).__init__(*args, **kwargs)
+        for key, value in self.items():
+            if type(value) is dict:
+                dict.__setitem__(self, key, ConfigDict(value))
+
+    def __getitem__(self, key):
+        value = super(ConfigDict, self).__getitem__(key)
+        if isinstance(value, LazyValue):
+            value = value.get()
+        return value
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+
 class LinaroCIJob(object):
     """All you need to run commands on a slave"""
+    # Queued runs of jobs with higher priorities start first, see
+    # scheduler.Scheduler
+    priority = 0
+
     def setup(self):
         pass
 
@@ -957,6 +1998,22 @@ class LinaroCIJob(object):
     def run(self):
         pass
 
+    def run_steps(self, targets=None, jobs=4):
+        """Run the job's steps, up to jobs at a time, in dependency order.
+
+        Steps are methods decorated with @step(depends=[...]). Each starts
+        once the steps it depends on have finished; targets limits the run
+        to those steps and what they depend on. Steps running at the same
+        time should each have their own session on a slave, see
+        SlaveSessions.
+        """
+        return StepGraph(self).run(targets, jobs)
+
+    def setup_variant(self, name):
+        """Called in a matrix run (see matrix.Matrix) once the shared steps
+        have run, so a variant can keep its files apart from the others"""
+        pass
+
     def cmd(self):
         pass
 
@@ -982,6 +2039,9 @@ def filter_None_out(a_list):
 
 
 class CIJobRuntime(object):
+    # Where checkpoints of runs are kept, for --resume
+    checkpoint_dir = "~/.cache/ci-runtime/checkpoints"
+
     def __init__(self, args):
         """ Do the first thing that works...
 
@@ -1003,13 +2063,25 @@ class CIJobRuntime(object):
 
         All other parameters are passed to <class> __init__.
 
-        Run each function on stack/"run" in turn.
+        Run each function on stack/"run" in turn. Steps (see step) that
+        complete are recorded in a checkpoint. If --resume is one of the
+        parameters, steps completed by the last run of this job with the
+        same source and parameters are skipped and the state they left the
+        job in is restored.
+
+        --matrix=<job>,<job>,... runs the steps of several jobs from the
+        module at once, see matrix.Matrix. The first job is the default.
         """
         logging.basicConfig(format='%(message)s', level=logging.INFO)
+        resume = "--resume" in args
+        matrix = [arg[len("--matrix="):].split(",") for arg in args
+                  if arg.startswith("--matrix=")]
+        args = [arg for arg in args
+                if arg != "--resume" and not arg.startswith("--matrix=")]
         self.parameters = []
         self.functions = []
         self.file_name = "CIJob"
-        self.job_name = "DefaultJob"
+        self.job_name = matrix[0][0] if matrix else "DefaultJob"
 
         state = "file_name"
         module = None
@@ -1093,5 +2165,55 @@ class CIJobRuntime(object):
             exit(1)
 
         getattr(self.job, "configure")(self.parameters)
+        if matrix:
+            self._run_matrix(module, matrix[0], resume)
+            return
+
+        self.checkpoint = self._checkpoint(module, resume)
+        self.job._checkpoint = self.checkpoint
         for function in self.functions:
             function()
+        self.checkpoint.finish()
+
+    def _run_matrix(self, module, names, resume):
+        """Run the steps of the named jobs as a matrix, see matrix.Matrix"""
+        variants = [(self.job_name, self.job)]
+        for name in names:
+            if name == self.job_name:
+                continue
+            job = getattr(module, name, None)
+            if job is None:
+                logging.error("ERROR: Job not found. Tried %s", name)
+                exit(1)
+            job = job()
+            job.configure(self.parameters)
+            variants.append((name, job))
+
+        checkpoints = []
+        for name, job in variants:
+            job._checkpoint = self._checkpoint(module, resume,
+                                               name + ".matrix")
+            checkpoints.append(job._checkpoint)
+
+        results = Matrix(variants).run()
+        failed = [name for name, _ in variants
+                  if results[name]["error"] is not None]
+        if failed:
+            logging.error("ERROR: %s failed", ", ".join(failed))
+            exit(1)
+        for checkpoint in checkpoints:
+            checkpoint.finish()
+
+    def _checkpoint(self, module, resume, job_name=None):
+        """Checkpoint for this job, keyed on its source and parameters"""
+        job_name = job_name or self.job_name
+        identity = json.dumps([self.file_name, job_name, self.parameters])
+        key = hashlib.sha1(identity)
+        source_path = inspect.getsourcefile(module)
+        if source_path:
+            with open(source_path) as f:
+                key.update(f.read())
+
+        path = os.path.join(self.checkpoint_dir, "%s.%s.%s.json" % (
+            self.file_name, job_name, hashlib.sha1(identity).hexdigest()[:12]))
+        return Checkpoint(path, key.hexdigest(), resume)
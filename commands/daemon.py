@@ -0,0 +1,342 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+"""A long running lrn that keeps slave connections warm between jobs.
+
+lrn --daemon starts it. Other lrn runs send their job to it over a Unix
+socket and print the output it streams back, so they skip connecting to
+the slave, starting screen, setting up the shell and finding out about
+sudo. Without a daemon lrn runs the job itself, as before.
+
+The client side only uses the standard library so lrn starts quickly.
+"""
+
+import errno
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+SOCKET_PATH = "~/.cache/ci-runtime/lrn.sock"
+
+
+class ShellPool(object):
+    """Connections to slaves, kept ready between jobs.
+
+    x86_64 slaves created while a job runs lease a connection to their host
+    (and screen session) if one is idle, else add the one they make. The
+    connection is the slave's shell along with the attributes that go with
+    it, including the sudo password and host resources. Each job gets a
+    fresh bash inside the pooled shell (see BashShell.start_session) so
+    what one job changes doesn't leak into the next. Connections idle for
+    longer than idle_timeout seconds are closed.
+    """
+    fields = ["shell", "sftp", "transfer", "sudo_password", "resources"]
+
+    def __init__(self, idle_timeout=30 * 60):
+        self.idle_timeout = idle_timeout
+        # key -> [(time released, fields)]
+        self.idle = {}
+        # [(key, slave)] for the job running now
+        self.leased = []
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(slave):
+        reserved = slave.config.get("reserved", {})
+        return (reserved.get("hostname"), reserved.get("username"),
+                slave.config.get("screen name", "ci-runtime"))
+
+    def lease(self, slave):
+        """Give slave an idle connection. Returns False if there isn't one"""
+        key = self.key(slave)
+        while True:
+            with self.lock:
+                if not self.idle.get(key):
+                    return False
+                released, fields = self.idle[key].pop()
+
+            try:
+                fields["shell"].start_session()
+            except Exception:
+                logging.info("daemon: connection to %s went away" % key[0])
+                self._close(fields["shell"])
+                continue
+
+            for name, value in fields.items():
+                setattr(slave, name, value)
+            with self.lock:
+                self.leased.append((key, slave))
+            return True
+
+    def add(self, slave):
+        """Keep slave's new connection for later jobs"""
+        if slave.shell is None:
+            return
+        slave.shell.start_session()
+        with self.lock:
+            self.leased.append((self.key(slave), slave))
+
+    def release_all(self):
+        """Take back the connections leased to the job that has finished"""
+        with self.lock:
+            leased, self.leased = self.leased, []
+
+        for key, slave in leased:
+            if getattr(slave, "lease", None):
+                # The daemon doesn't exit after a job, which is when the
+                # slave would give back a host leased from a SlavePool
+                slave._release_lease()
+            try:
+                slave.shell.end_session()
+            except Exception:
+                logging.info("daemon: connection to %s went away" % key[0])
+                self._close(slave.shell)
+                continue
+            fields = dict((name, getattr(slave, name, None))
+                          for name in self.fields)
+            with self.lock:
+                self.idle.setdefault(key, []).append((time.time(), fields))
+        self.expire()
+
+    def expire(self):
+        """Close connections that have been idle for too long"""
+        now = time.time()
+        expired = []
+        with self.lock:
+            for key, entries in self.idle.items():
+                for entry in list(entries):
+                    if now - entry[0] > self.idle_timeout:
+                        entries.remove(entry)
+                        expired.append(entry[1]["shell"])
+        for shell in expired:
+            self._close(shell)
+
+    def _close(self, shell):
+        try:
+            shell.terminate()
+        except Exception:
+            pass
+
+
+class JobOutput(object):
+    """File-like object streaming what a job writes back to its client"""
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def send(self, message):
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self.connection.sendall(json.dumps(message) + "\n")
+            except socket.error:
+                # The client has gone; the job carries on regardless
+                self.closed = True
+
+    def write(self, data):
+        if data:
+            self.send({"output": data})
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        pass
+
+
+class Daemon(object):
+    """Runs jobs sent by lrn clients, one at a time, with warm connections.
+
+    Jobs run in this process with the client's directory, environment and
+    sys.path, and with this process's copy of commands. Their logging and
+    stdout go back to the client, but nothing goes the other way, so a job
+    that needs a sudo password fails. Modules a job imports from outside the
+    Python installation are forgotten afterwards so edits to a job file
+    are picked up by its next run.
+    """
+    def __init__(self, socket_path=SOCKET_PATH, pool=None, poll_interval=60):
+        self.socket_path = os.path.expanduser(socket_path)
+        self.pool = pool or ShellPool()
+        self.poll_interval = poll_interval
+        self.job_lock = threading.Lock()
+        self.running = False
+
+    def _listen(self):
+        directory = os.path.dirname(self.socket_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, 0700)
+
+        if os.path.exists(self.socket_path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.socket_path)
+            except socket.error:
+                # Left behind by a daemon that didn't shut down cleanly
+                os.remove(self.socket_path)
+            else:
+                probe.close()
+                raise RuntimeError("an lrn daemon is already running on %s" %
+                                   self.socket_path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Anyone who can connect can run code as us, so the socket is only
+        # ever accessible to us
+        umask = os.umask(0077)
+        try:
+            server.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        server.listen(5)
+        server.settimeout(self.poll_interval)
+        return server
+
+    def serve(self):
+        """Accept jobs until stop is called or the process is interrupted"""
+        from commands import CISlave
+        CISlave.shell_pool = self.pool
+        # Jobs' prompts would go to the daemon's terminal, not the client's
+        CISlave.interactive = False
+        server = self._listen()
+        self.running = True
+        logging.info("daemon: listening on %s" % self.socket_path)
+        try:
+            while self.running:
+                try:
+                    connection, _ = server.accept()
+                except socket.timeout:
+                    self.pool.expire()
+                    continue
+                thread = threading.Thread(target=self._handle,
+                                          args=(connection,))
+                thread.daemon = True
+                thread.start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+            os.remove(self.socket_path)
+            CISlave.shell_pool = None
+            CISlave.interactive = True
+
+    def stop(self):
+        self.running = False
+
+    def _handle(self, connection):
+        try:
+            request = json.loads(connection.makefile().readline())
+            output = JobOutput(connection)
+            with self.job_lock:
+                try:
+                    code = self.run_job(request, output)
+                    output.send({"exit": code})
+                finally:
+                    # After the client has its exit code, so it doesn't
+                    # wait for this
+                    self.pool.release_all()
+        except Exception:
+            logging.exception("daemon: couldn't handle request")
+        finally:
+            connection.close()
+
+    def run_job(self, request, output):
+        """Run the job in request, sending its output to output.
+
+        Returns the exit code lrn would have had.
+        """
+        from commands import CIJobRuntime
+
+        saved_cwd = os.getcwd()
+        saved_path = list(sys.path)
+        saved_environ = dict(os.environ)
+        saved_modules = set(sys.modules)
+        saved_stdout, saved_stderr = sys.stdout, sys.stderr
+        root = logging.getLogger()
+        saved_handlers, saved_level = list(root.handlers), root.level
+
+        handler = logging.StreamHandler(output)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        root.handlers = [handler]
+        root.setLevel(logging.INFO)
+        sys.stdout = sys.stderr = output
+        code = 0
+        try:
+            os.chdir(request["cwd"])
+            sys.path[:] = request["path"] + [path for path in saved_path
+                                             if path not in request["path"]]
+            os.environ.clear()
+            os.environ.update(request["env"])
+
+            CIJobRuntime(request["args"])
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                code = e.code or 0
+            else:
+                output.write("%s\n" % e.code)
+                code = 1
+        except Exception:
+            traceback.print_exc(file=output)
+            code = 1
+        finally:
+            sys.stdout, sys.stderr = saved_stdout, saved_stderr
+            root.handlers = saved_handlers
+            root.setLevel(saved_level)
+            os.environ.clear()
+            os.environ.update(saved_environ)
+            sys.path[:] = saved_path
+            os.chdir(saved_cwd)
+            self._forget_modules(saved_modules)
+        return code
+
+    def _forget_modules(self, keep):
+        installed = tuple(os.path.realpath(prefix) + os.sep
+                          for prefix in set([sys.prefix, sys.exec_prefix]))
+        for name in set(sys.modules) - keep:
+            module = sys.modules[name]
+            path = getattr(module, "__file__", None)
+            if(path is None or name.startswith("commands.") or
+               os.path.realpath(path).startswith(installed)):
+                continue
+            del sys.modules[name]
+
+
+def submit(args, socket_path=SOCKET_PATH, output=None):
+    """Run a job on the lrn daemon, writing what it outputs to output.
+
+    Returns the job's exit code, or None if no daemon is running.
+    """
+    output = output or sys.stdout
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(os.path.expanduser(socket_path))
+    except socket.error as e:
+        if e.errno in [errno.ENOENT, errno.ECONNREFUSED]:
+            return None
+        raise
+
+    try:
+        connection.sendall(json.dumps({
+            "args": args,
+            "cwd": os.getcwd(),
+            "path": [os.path.abspath(path) for path in sys.path],
+            "env": dict(os.environ),
+        }) + "\n")
+        for line in connection.makefile():
+            message = json.loads(line)
+            if "output" in message:
+                output.write(message["output"].encode("utf-8"))
+                output.flush()
+            elif "exit" in message:
+                return message["exit"]
+    finally:
+        connection.close()
+
+    # The daemon went away mid job
+    return 1
@@ -0,0 +1,161 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import ctypes
+import ctypes.util
+import errno
+import mmap
+import os
+import shutil
+import stat
+import sys
+
+
+# Files at least this big are read through mmap by LocalFiles.open
+MMAP_SIZE = 1024 ** 2
+
+
+def _libc_sendfile():
+    """sendfile(2) for Pythons without os.sendfile, None if unavailable"""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        function = libc.sendfile64
+    except (OSError, AttributeError):
+        return None
+    function.restype = ctypes.c_ssize_t
+    function.argtypes = [ctypes.c_int, ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+
+    def sendfile(out_fd, in_fd, offset, count):
+        sent = function(out_fd, in_fd, ctypes.byref(ctypes.c_int64(offset)),
+                        count)
+        if sent < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        return sent
+    return sendfile
+
+sendfile = getattr(os, "sendfile", None) or _libc_sendfile()
+
+
+def copy_file(source, dest):
+    """Copy source to dest, inside the kernel if it can.
+
+    Uses sendfile, so the data goes from page cache to page cache without
+    being copied through this process. Falls back to reading and writing
+    where sendfile isn't available or doesn't support the files.
+    """
+    with open(source, "rb") as source_file:
+        with open(dest, "wb") as dest_file:
+            size = os.fstat(source_file.fileno()).st_size
+            offset = 0
+            try:
+                while sendfile and offset < size:
+                    sent = sendfile(dest_file.fileno(), source_file.fileno(),
+                                    offset, size - offset)
+                    if not sent:
+                        break
+                    offset += sent
+            except OSError as e:
+                if e.errno not in [errno.EINVAL, errno.ENOSYS]:
+                    raise
+
+            source_file.seek(offset)
+            dest_file.seek(offset)
+            shutil.copyfileobj(source_file, dest_file, 1024 ** 2)
+
+
+class MappedFile(object):
+    """Read only file object backed by mmap.
+
+    Reads are served straight from the page cache rather than copied
+    through a read buffer. Supports read, readline, iteration, seek and
+    tell, which is what callers of file_open use.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.name = path
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.map.size() - self.map.tell()
+        return self.map.read(size)
+
+    def readline(self):
+        return self.map.readline()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.map.seek(offset, whence)
+
+    def tell(self):
+        return self.map.tell()
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+    def close(self):
+        self.map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class LocalFiles(object):
+    """File operations on the local machine, for slaves that are localhost.
+
+    Has the parts of paramiko's SFTPClient that CISlave uses, done with
+    native file I/O. As with SFTP, relative paths are relative to root: the
+    directory the local shell started in. put and get are skipped if the
+    destination has the same size and modification time as the source,
+    like TransferEngine's default check.
+    """
+    def __init__(self, root=None):
+        self.root = root or os.getcwd()
+
+    def _path(self, path):
+        return os.path.join(self.root, os.path.expanduser(path))
+
+    def _copy(self, source, dest):
+        source_stat = os.stat(source)
+        if os.path.isfile(dest):
+            dest_stat = os.stat(dest)
+            if(dest_stat.st_size == source_stat.st_size and
+               int(dest_stat.st_mtime) == int(source_stat.st_mtime)):
+                return
+
+        part_path = dest + ".ci-part"
+        copy_file(source, part_path)
+        os.chmod(part_path, stat.S_IMODE(source_stat.st_mode))
+        os.utime(part_path, (source_stat.st_atime, source_stat.st_mtime))
+        os.rename(part_path, dest)
+
+    def open(self, path, mode="r"):
+        path = self._path(path)
+        if mode in ["r", "rb"]:
+            try:
+                if os.path.getsize(path) >= MMAP_SIZE:
+                    return MappedFile(path)
+            except OSError:
+                pass
+        return open(path, mode)
+
+    def put(self, local_path, remote_path):
+        self._copy(local_path, self._path(remote_path))
+
+    def get(self, remote_path, local_path):
+        self._copy(self._path(remote_path), local_path)
+
+    def stat(self, path):
+        return os.stat(self._path(path))
+
+    def chmod(self, path, mode):
+        os.chmod(self._path(path), mode)
+
+    def remove(self, path):
+        os.remove(self._path(path))
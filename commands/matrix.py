@@ -0,0 +1,125 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import logging
+import threading
+import time
+
+from checkpoint import restore, snapshot
+from steps import StepGraph
+
+
+def share_state(source, target):
+    """Give target the state source's steps built up, except its config.
+
+    Attributes that can be saved in a checkpoint are copied, so variants
+    don't change each other's; others, such as slaves, are shared.
+    """
+    state = snapshot(source)
+    state.pop("config", None)
+    restore(target, state)
+    for name, value in vars(source).items():
+        if not name.startswith("_") and name != "config" and name not in state:
+            setattr(target, name, value)
+
+
+class Matrix(object):
+    """One job's steps run over several configurations at once.
+
+    variants is a list of (name, job) pairs: jobs of classes with the same
+    steps, each configured for one variant, such as a kernel build for each
+    board. Steps marked @step(shared=True) run once, on the first variant,
+    which is also the only one set up; the state they leave is then shared
+    out and each job's setup_variant is called, so it can use its own
+    directories. The variants' other steps run at the same time. Shared
+    steps that depend on variant steps, like tidying up after the builds,
+    run once every variant has finished.
+
+    A variant failing doesn't stop the others. run returns, and logs side
+    by side, how long each variant's steps took and how each one ended.
+    """
+    def __init__(self, variants):
+        self.variants = variants
+        self.lead = variants[0][1]
+        self.graph = StepGraph(self.lead)
+        for name, job in variants[1:]:
+            if StepGraph(job).depends != self.graph.depends:
+                raise ValueError("%s doesn't have the same steps as %s" %
+                                 (name, variants[0][0]))
+
+        shared = self.graph.shared
+        order = self.graph.order()
+        # Shared steps that only depend on shared steps run first
+        self.before = [name for name in order if name in shared and
+                       set(self.graph.order([name])) <= shared]
+        self.after = [name for name in order
+                      if name in shared and name not in self.before]
+        self.unshared = [name for name in order if name not in shared]
+        for name in self.unshared:
+            for depend in self.graph.order([name]):
+                if depend in self.after:
+                    raise ValueError("%s depends on %s, which runs after "
+                                     "every variant" % (name, depend))
+
+    def run(self, jobs=4):
+        self.lead.setup()
+        self.graph.run(self.before, jobs)
+
+        for name, job in self.variants:
+            if job is not self.lead:
+                share_state(self.lead, job)
+            job.setup_variant(name)
+
+        results = {}
+
+        def run_variant(name, job):
+            graph = StepGraph(job)
+            start = time.time()
+            try:
+                graph.run(self.unshared, jobs, done=self.before)
+                error = None
+            except Exception as e:
+                logging.exception("matrix: %s failed" % name)
+                error = e
+            results[name] = {"times": graph.times, "error": error,
+                             "took": time.time() - start}
+
+        threads = [threading.Thread(target=run_variant, args=variant,
+                                    name="variant %s" % variant[0])
+                   for variant in self.variants]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self.after:
+            self.graph.run(self.after, jobs, done=set(self.graph.order()) -
+                           set(self.after))
+        self.report(results)
+        return results
+
+    def report(self, results):
+        """Log each variant's step times and result side by side"""
+        names = [name for name, _ in self.variants]
+        rows = [["step"] + names]
+        for step in self.unshared:
+            row = [step]
+            for name in names:
+                times = results[name]["times"]
+                if step in times:
+                    row.append("%.0fs" % (times[step][1] - times[step][0]))
+                else:
+                    row.append("-")
+            rows.append(row)
+        rows.append(["took"] + ["%.0fs" % results[name]["took"]
+                                for name in names])
+        rows.append(["result"] + [
+            "ok" if results[name]["error"] is None else
+            "failed: %s" % type(results[name]["error"]).__name__
+            for name in names])
+
+        widths = [max(len(row[column]) for row in rows)
+                  for column in range(len(rows[0]))]
+        for row in rows:
+            cells = [cell.ljust(width) for cell, width in zip(row, widths)]
+            logging.info("matrix: " + "  ".join(cells).rstrip())
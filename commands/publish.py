@@ -0,0 +1,120 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import os
+import pipes
+import re
+import urllib
+
+
+# curl prints these after each upload or content query
+WRITE_OUT = r"ci-publish: %{http_code} %{time_total} %{url_effective}\n"
+EXISTS_WRITE_OUT = r"ci-publish-exists: %{http_code} %{url_effective}\n"
+
+upload_search = re.compile(r"^ci-publish: (\d{3}) ([\d.,]+) (\S+)$")
+exists_search = re.compile(r"^ci-publish-exists: (\d{3}) \S+/([0-9a-f]{64})$")
+
+
+def _host(server_config):
+    host = server_config["hostname"]
+    if not re.search(r"^\w+://", host):
+        host = "http://" + host
+    return host
+
+
+def upload_url(server_config, destination, path):
+    return "%s/%s" % (_host(server_config),
+                      urllib.quote(os.path.join(destination, path)))
+
+
+def content_url(server_config, sha256):
+    """URL that answers a HEAD with 200 if the server has this content"""
+    return "%s/api/content/%s" % (_host(server_config), sha256)
+
+
+def link_url(server_config, destination, path):
+    """URL to POST to, to publish content the server has under a path"""
+    return "%s/api/link/%s" % (_host(server_config),
+                               urllib.quote(os.path.join(destination, path)))
+
+
+def exists_command(files, server_config):
+    """Shell command asking the server which of files it already has
+
+    One curl process sends a HEAD per distinct sha256 over one connection.
+    """
+    queries = ["-sS -o /dev/null -I -w '%s' %s" %
+               (EXISTS_WRITE_OUT,
+                pipes.quote(content_url(server_config, sha256)))
+               for sha256 in sorted(set(entry["sha256"] for entry in files))]
+    return "curl " + " --next ".join(queries)
+
+
+def parse_exists(output):
+    """Return the set of sha256 the server said it has"""
+    existing = set()
+    for line in output:
+        search = exists_search.search(line)
+        if search and search.group(1) == "200":
+            existing.add(search.group(2))
+    return existing
+
+
+def group_files(files, jobs):
+    """Split files into at most jobs groups of similar total size"""
+    groups = [[] for _ in range(min(jobs, len(files)))]
+    sizes = [0] * len(groups)
+    for entry in sorted(files, key=lambda entry: -entry["size"]):
+        smallest = sizes.index(min(sizes))
+        groups[smallest].append(entry)
+        sizes[smallest] += entry["size"]
+    return groups
+
+
+def upload_command(base_dir, files, server_config, destination, jobs=4,
+                   retries=3, license_name=None):
+    """Shell command uploading files to a linaro-license-protection server
+
+    The paths in files are relative to base_dir. Files are split into jobs
+    groups uploaded concurrently. Each group is one curl process that
+    chains its uploads with --next, so they share a kept-alive connection.
+    Transient failures, including refused connections, are retried up to
+    retries times, with the wait doubling each time. Entries with "linked"
+    set are published by asking the server to link the content it already
+    has rather than uploading.
+    """
+    fields = []
+    if server_config.get("key"):
+        fields.append("-F key=%s" % pipes.quote(server_config["key"]))
+    if license_name:
+        fields.append("-F license=%s" % pipes.quote(license_name))
+
+    processes = []
+    for group in group_files(files, jobs):
+        uploads = []
+        for entry in group:
+            if entry.get("linked"):
+                data = "-F sha256=%s" % entry["sha256"]
+                url = link_url(server_config, destination, entry["path"])
+            else:
+                data = "-F file=@%s" % pipes.quote(entry["path"])
+                url = upload_url(server_config, destination, entry["path"])
+            uploads.append(" ".join(
+                ["-sS -o /dev/null --retry %d --retry-connrefused" % retries,
+                 "-w '%s'" % WRITE_OUT, data] + fields +
+                [pipes.quote(url)]))
+        processes.append("curl " + " --next ".join(uploads) + " &")
+
+    return "(cd %s || exit 1; %s wait)" % (base_dir, " ".join(processes))
+
+
+def parse_uploads(output):
+    """Return {url: (http status, seconds)} from upload_command's output"""
+    uploads = {}
+    for line in output:
+        search = upload_search.search(line)
+        if search:
+            uploads[search.group(3)] = (int(search.group(1)),
+                                        float(search.group(2).replace(",",
+                                                                      ".")))
+    return uploads
@@ -0,0 +1,59 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import os
+import threading
+
+
+def change_directory(directory, path):
+    """Where cd path goes from directory, as a key for QueryCache
+
+    Paths are joined as text, without resolving "..", so the same key is
+    never given to two different directories.
+    """
+    if path.startswith("/") or path.startswith("~"):
+        return path
+    return os.path.join(directory, path)
+
+
+class QueryCache(object):
+    """Output of commands that only read a slave's state (see
+    CISlave.query), kept until something changes that state.
+
+    generation counts the commands and file transfers that could have
+    changed the slave. Each of those calls changed, which forgets every
+    answer except those marked stable: answers that nothing the job runs
+    will change, like the version of the source it checked out. Sessions on
+    the same machine share one cache, as they share its files.
+    """
+    def __init__(self):
+        self.generation = 0
+        self.lock = threading.Lock()
+        self._answers = {}
+        self._stable = {}
+        # Times each query was answered from the cache
+        self.hits = {}
+
+    def changed(self):
+        with self.lock:
+            self.generation += 1
+            self._answers = {}
+
+    def get(self, key, stable=False):
+        """(generation, cached output or None) for key"""
+        with self.lock:
+            answers = self._stable if stable else self._answers
+            output = answers.get(key)
+            if output is not None:
+                self.hits[key] = self.hits.get(key, 0) + 1
+                output = list(output)
+            return self.generation, output
+
+    def put(self, key, generation, output, stable=False):
+        """Keep output for key, unless the slave has changed since
+        generation, when the query started"""
+        with self.lock:
+            if generation != self.generation:
+                return
+            answers = self._stable if stable else self._answers
+            answers[key] = list(output)
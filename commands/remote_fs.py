@@ -0,0 +1,100 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import pipes
+import re
+
+
+# Shell run on the slave to print "ci-stat: <type> <size> <mtime> <mode>
+# <path>" for each of a list of paths (shell words, so globs are expanded)
+# relative to a directory. Paths that don't exist are left out. Symbolic
+# links given as paths are followed; ones found in a tree walk are not.
+QUERY = (
+    '(cd %(base_dir)s || exit 1; shopt -s nullglob; set -- %(words)s; '
+    'test $# -gt 0 || exit 0; '
+    'find -H "$@"%(depth)s -printf "ci-stat: %%y %%s %%T@ %%m %%p\\n" '
+    '2>/dev/null; %(sha256)sexit 0)')
+
+# Appended to QUERY to print "ci-sha256: <sha256>  <path>" for every regular
+# file, hashing several at once.
+SHA256 = ('find -H "$@"%(depth)s -type f -print0 2>/dev/null | '
+          'xargs -0 -r -P %(jobs)d -n 8 sha256sum | '
+          'sed "s/^/ci-sha256: /"; ')
+
+TYPES = {"f": "file", "d": "directory", "l": "symlink"}
+
+stat_search = re.compile(r"^ci-stat: (\w) (\d+) ([\d.]+) ([0-7]+) (.+)$")
+sha256_search = re.compile(r"^ci-sha256: ([0-9a-f]{64})  (.+)$")
+
+
+class FileStat(object):
+    """What a file on a slave is.
+
+    type is "file", "directory", "symlink" (only for links that aren't
+    followed, or are broken) or "other". mtime is in seconds since the epoch
+    and mode holds the permission bits. sha256 is only filled in for regular
+    files, and only if it was asked for.
+    """
+    def __init__(self, path, type, size, mtime, mode, sha256=None):
+        self.path = path
+        self.type = type
+        self.size = size
+        self.mtime = mtime
+        self.mode = mode
+        self.sha256 = sha256
+
+    def __repr__(self):
+        return "FileStat(%r, %r, %d)" % (self.path, self.type, self.size)
+
+    def __eq__(self, other):
+        return (isinstance(other, FileStat) and
+                self.__dict__ == other.__dict__)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+def query_command(words, base_dir=".", sha256=False, recursive=False,
+                  jobs=4):
+    """Shell command describing every path words expands to in one go
+
+    words are shell words, so quote anything that isn't a glob. With
+    recursive, the trees under directories are described too.
+    """
+    depth = "" if recursive else " -maxdepth 0"
+    return QUERY % {"base_dir": base_dir,
+                    "words": " ".join(words),
+                    "depth": depth,
+                    "sha256": SHA256 % {"depth": depth, "jobs": jobs}
+                    if sha256 else ""}
+
+
+def stat_command(paths, **kwargs):
+    """query_command for paths taken literally"""
+    return query_command([pipes.quote(path) for path in paths], **kwargs)
+
+
+def glob_command(patterns, **kwargs):
+    """query_command for glob patterns. Patterns can't contain spaces."""
+    return query_command(patterns, **kwargs)
+
+
+def parse_stats(output):
+    """Return [FileStat] from the output of query_command, in path order"""
+    stats = {}
+    sha256s = {}
+    for line in output:
+        search = stat_search.search(line)
+        if search:
+            kind, size, mtime, mode, path = search.groups()
+            stats[path] = FileStat(path, TYPES.get(kind, "other"), int(size),
+                                   float(mtime), int(mode, 8))
+            continue
+        search = sha256_search.search(line)
+        if search:
+            sha256s[search.group(2)] = search.group(1)
+
+    for path, sha256 in sha256s.items():
+        if path in stats:
+            stats[path].sha256 = sha256
+    return [stats[path] for path in sorted(stats)]
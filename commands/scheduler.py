@@ -0,0 +1,347 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+"""Run jobs when their triggers say, a few at a time.
+
+Jobs say when they should run with LinaroCIJob.set_triggers. Triggers
+understood here:
+    "daily HH:MM"       every day at that time (local time)
+    "on merge request"  when a merge request file names the job
+
+lrn --schedule <schedule file> runs a Scheduler described by a JSON file:
+    {
+        "modules": ["kernel-ci"],
+        "parameters": {"KernelBuild_linux_panda": ["10.0.0.5", ...]},
+        "priorities": {"KernelBuild_linux_panda": 10},
+        "workers": 4,
+        "slave limit": 1,
+        "slave limits": {"10.0.0.5": 2}
+    }
+Every job class in modules that has triggers once configured with its
+parameters is scheduled.
+"""
+
+import datetime
+import heapq
+import importlib
+import inspect
+import itertools
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+LRN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), "lrn")
+
+
+class Trigger(object):
+    """When a job should run, parsed from a set_triggers string"""
+    def __init__(self, text):
+        self.text = text
+        daily = re.search(r"^daily (\d\d?):(\d\d)$", text)
+        if daily:
+            self.kind = "daily"
+            self.hour, self.minute = int(daily.group(1)), int(daily.group(2))
+            if self.hour > 23 or self.minute > 59:
+                raise ValueError("bad time in trigger %r" % text)
+        elif text == "on merge request":
+            self.kind = "merge request"
+        else:
+            raise ValueError("unknown trigger %r" % text)
+
+    def next_time(self, after):
+        """First time after the datetime after that a daily trigger fires"""
+        fire = after.replace(hour=self.hour, minute=self.minute, second=0,
+                             microsecond=0)
+        if fire <= after:
+            fire += datetime.timedelta(days=1)
+        return fire
+
+
+class ScheduledJob(object):
+    """A job the scheduler runs, with what it needs to start one"""
+    def __init__(self, file_name, job_name, parameters=(), triggers=(),
+                 priority=0, slave=None):
+        self.file_name = file_name
+        self.job_name = job_name
+        self.parameters = list(parameters)
+        self.triggers = [Trigger(trigger) for trigger in triggers]
+        self.priority = priority
+        self.slave = slave
+        self.next_times = {}
+
+    def command(self):
+        # --no-daemon: an lrn daemon would run the jobs one at a time
+        return ([sys.executable, LRN, "--no-daemon", self.file_name,
+                 self.job_name] + self.parameters)
+
+
+class Run(object):
+    """One run of a job: why it was queued, and when it waited and ran"""
+    def __init__(self, job, reason):
+        self.job = job
+        self.reason = reason
+        self.queued = time.time()
+        self.started = None
+        self.finished = None
+        self.returncode = None
+
+    def wait(self):
+        return (self.started or time.time()) - self.queued
+
+
+def discover(module_names, parameters={}, priorities={}):
+    """Find the job classes in modules that have triggers.
+
+    Each class is created and configured with its entry in parameters (a
+    list of command line parameters, as lrn would pass) to find its
+    triggers and the slave it runs on. Classes that can't be configured are
+    left out.
+    """
+    from commands import LinaroCIJob
+    jobs = []
+    for module_name in module_names:
+        module = importlib.import_module(module_name)
+        for name, cls in sorted(vars(module).items()):
+            if(not inspect.isclass(cls) or
+               not issubclass(cls, LinaroCIJob) or
+               cls.__module__ != module.__name__):
+                continue
+
+            job = cls()
+            try:
+                job.configure(list(parameters.get(name, [])))
+            except (Exception, SystemExit) as e:
+                logging.info("scheduler: skipping %s, can't configure it: "
+                             "%s" % (name, e))
+                continue
+
+            triggers = getattr(job, "triggers", None)
+            if not triggers:
+                continue
+            jobs.append(ScheduledJob(module_name, name,
+                                     parameters.get(name, []), triggers,
+                                     priorities.get(name, job.priority),
+                                     job_slave(job)))
+    return jobs
+
+
+def job_slave(job):
+    """The host a configured job runs on, None if it doesn't say"""
+    config = getattr(job, "config", None) or {}
+    try:
+        return config["target machine"]["reserved"]["hostname"]
+    except (KeyError, TypeError):
+        return None
+
+
+class Scheduler(object):
+    """Queues runs of jobs as their triggers fire and runs them.
+
+    Up to workers runs happen at once, and no more than slave_limit (or the
+    slave's entry in slave_limits) on any one slave. Queued runs start
+    highest priority first, then in the order they were queued; a run that
+    is waiting for a busy slave doesn't hold up runs for other slaves. A
+    job already waiting in the queue isn't queued again.
+
+    A merge request is a file put in merge_request_dir holding the name of
+    a job with an "on merge request" trigger; write it elsewhere and move
+    it in so it isn't read half written. The file is removed once the run
+    is queued.
+
+    Each run's output goes to log_dir, and a line of JSON recording how
+    long it waited and ran is added to log_dir/runs.json.
+    """
+    def __init__(self, jobs, workers=4, slave_limit=1, slave_limits={},
+                 merge_request_dir="~/.cache/ci-runtime/merge-requests",
+                 log_dir="~/.cache/ci-runtime/scheduler"):
+        self.jobs = dict((job.job_name, job) for job in jobs)
+        self.workers = workers
+        self.slave_limit = slave_limit
+        self.slave_limits = slave_limits
+        self.merge_request_dir = os.path.expanduser(merge_request_dir)
+        self.log_dir = os.path.expanduser(log_dir)
+
+        self.queue = []
+        self.sequence = itertools.count()
+        self.running = []
+        self.history = []
+        self.condition = threading.Condition()
+        self.threads = []
+        self.stopping = False
+
+        now = datetime.datetime.now()
+        for job in self.jobs.values():
+            for trigger in job.triggers:
+                if trigger.kind == "daily":
+                    job.next_times[trigger] = trigger.next_time(now)
+
+    @classmethod
+    def from_file(cls, path):
+        """Scheduler for the jobs in a schedule file, see the module doc"""
+        with open(path) as f:
+            config = json.load(f)
+        jobs = discover(config["modules"], config.get("parameters", {}),
+                        config.get("priorities", {}))
+        return cls(jobs, config.get("workers", 4),
+                   config.get("slave limit", 1),
+                   config.get("slave limits", {}))
+
+    def enqueue(self, job, reason):
+        """Queue a run of job. Returns the Run, None if one was waiting"""
+        with self.condition:
+            for _, _, run in self.queue:
+                if run.job is job:
+                    return None
+            run = Run(job, reason)
+            heapq.heappush(self.queue,
+                           (-job.priority, next(self.sequence), run))
+            logging.info("scheduler: queued %s (%s)" % (job.job_name, reason))
+            self.condition.notify_all()
+            return run
+
+    def tick(self, now=None):
+        """Queue runs for triggers that have fired since the last tick"""
+        now = now or datetime.datetime.now()
+        for job in self.jobs.values():
+            for trigger, fire in job.next_times.items():
+                if fire <= now:
+                    self.enqueue(job, trigger.text)
+                    job.next_times[trigger] = trigger.next_time(now)
+        self._read_merge_requests()
+
+    def _read_merge_requests(self):
+        if not os.path.isdir(self.merge_request_dir):
+            return
+        for name in sorted(os.listdir(self.merge_request_dir)):
+            path = os.path.join(self.merge_request_dir, name)
+            with open(path) as f:
+                job_name = f.read().strip()
+            os.remove(path)
+
+            job = self.jobs.get(job_name)
+            if job and [trigger for trigger in job.triggers
+                        if trigger.kind == "merge request"]:
+                self.enqueue(job, "merge request %s" % name)
+            else:
+                logging.error("scheduler: merge request %s is for %r, which "
+                              "isn't run on merge requests" % (name, job_name))
+
+    def _slave_busy(self, slave):
+        if slave is None:
+            return False
+        limit = self.slave_limits.get(slave, self.slave_limit)
+        return len([run for run in self.running
+                    if run.job.slave == slave]) >= limit
+
+    def _next_run(self):
+        """Take the next run that can start, waiting for one if need be"""
+        with self.condition:
+            while not self.stopping:
+                for entry in sorted(self.queue):
+                    run = entry[2]
+                    if not self._slave_busy(run.job.slave):
+                        self.queue.remove(entry)
+                        heapq.heapify(self.queue)
+                        run.started = time.time()
+                        self.running.append(run)
+                        return run
+                self.condition.wait(1)
+            return None
+
+    def _worker(self):
+        while True:
+            run = self._next_run()
+            if run is None:
+                return
+            logging.info("scheduler: starting %s after %.0fs in the queue" %
+                         (run.job.job_name, run.wait()))
+            try:
+                run.returncode = self.execute(run)
+            except Exception:
+                logging.exception("scheduler: %s couldn't be started" %
+                                  run.job.job_name)
+                run.returncode = -1
+            run.finished = time.time()
+            logging.info("scheduler: %s finished with %d after %.0fs" %
+                         (run.job.job_name, run.returncode,
+                          run.finished - run.started))
+            self._record(run)
+            with self.condition:
+                self.running.remove(run)
+                self.history.append(run)
+                self.condition.notify_all()
+
+    def execute(self, run):
+        """Run a job, returning its exit code"""
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        log_path = os.path.join(self.log_dir, "%s.%d.log" % (
+            run.job.job_name, int(run.started)))
+        with open(log_path, "w") as log:
+            return subprocess.call(run.job.command(), stdout=log,
+                                   stderr=subprocess.STDOUT)
+
+    def _record(self, run):
+        if not os.path.isdir(self.log_dir):
+            os.makedirs(self.log_dir)
+        with open(os.path.join(self.log_dir, "runs.json"), "a") as f:
+            f.write(json.dumps({
+                "job": run.job.job_name, "reason": run.reason,
+                "slave": run.job.slave, "priority": run.job.priority,
+                "queued": run.queued, "wait": run.started - run.queued,
+                "duration": run.finished - run.started,
+                "returncode": run.returncode}) + "\n")
+
+    def metrics(self):
+        """Queue wait times and outcomes of finished runs, by job name"""
+        metrics = {}
+        with self.condition:
+            for run in self.history:
+                entry = metrics.setdefault(run.job.job_name, {
+                    "runs": 0, "failures": 0, "total wait": 0.0,
+                    "max wait": 0.0})
+                wait = run.started - run.queued
+                entry["runs"] += 1
+                entry["failures"] += run.returncode != 0
+                entry["total wait"] += wait
+                entry["max wait"] = max(entry["max wait"], wait)
+            waiting = [run.wait() for _, _, run in self.queue]
+        for entry in metrics.values():
+            entry["mean wait"] = entry.pop("total wait") / entry["runs"]
+        metrics["queue"] = {"waiting": len(waiting),
+                            "longest wait": max(waiting or [0])}
+        return metrics
+
+    def start(self):
+        """Start the worker threads"""
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker,
+                                      name="scheduler %d" % index)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Let running jobs finish, leaving queued ones unstarted"""
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    def run_forever(self, poll_interval=30):
+        logging.info("scheduler: scheduling %s" % ", ".join(
+            sorted(self.jobs)))
+        self.start()
+        try:
+            while True:
+                self.tick()
+                time.sleep(poll_interval)
+        except KeyboardInterrupt:
+            self.stop()
@@ -0,0 +1,256 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import atexit
+import fcntl
+import json
+import os
+import random
+import re
+import threading
+import time
+
+INVENTORY_PATH = "~/.config/ci-runtime/slaves.json"
+STATE_PATH = "~/.cache/ci-runtime/slave-pool.json"
+
+# How many repositories are remembered as checked out on each host
+WARM_REPOS = 50
+
+
+class NoSlaveAvailable(Exception):
+    """Exception: No slave in the pool meets the requirements right now"""
+
+
+def parse_size(text):
+    """Size in MB from "8GB", "512MB", "2T" and so on. Plain numbers are GB"""
+    search = re.search(r"^(\d+(?:\.\d+)?)\s*([KMGT]?)B?$", str(text).strip(),
+                       re.IGNORECASE)
+    if not search:
+        raise ValueError("can't understand size %r" % text)
+    scale = {"K": 1.0 / 1024, "M": 1, "": 1024, "G": 1024,
+             "T": 1024 ** 2}[search.group(2).upper()]
+    return int(float(search.group(1)) * scale)
+
+
+class Requirements(object):
+    """What a job needs from a machine, parsed from a request list.
+
+    Requests are strings like those in android-ci.py:
+        "machine type x86_64", "OS Ubuntu 12.04"   must be the same
+        "memory 8GB", "cpus 4"                     at least this much
+        "repo <url>"                               prefer hosts that have
+                                                   checked out url before
+    """
+    exact = ["machine type", "os"]
+    minimum = ["memory", "cpus"]
+
+    def __init__(self, requests):
+        self.values = {}
+        self.repos = []
+        for request in requests:
+            key, value = self._parse(request)
+            if key == "repo":
+                self.repos.append(value)
+            elif key == "memory":
+                self.values[key] = parse_size(value)
+            elif key == "cpus":
+                self.values[key] = int(value)
+            else:
+                self.values[key] = value
+
+    def _parse(self, request):
+        for key in self.exact + self.minimum + ["repo"]:
+            if request.lower().startswith(key + " "):
+                return key, request[len(key) + 1:].strip()
+        raise ValueError("unknown machine requirement %r" % request)
+
+    def met_by(self, host):
+        for key, value in self.values.items():
+            if key not in host:
+                return False
+            if key in self.exact:
+                if str(host[key]).lower() != value.lower():
+                    return False
+            elif key == "memory":
+                if parse_size(host[key]) < value:
+                    return False
+            elif int(host[key]) < value:
+                return False
+        return True
+
+
+class Lease(object):
+    """A host leased from a SlavePool until it is released or expires.
+
+    keep_alive renews the lease from a background thread, so it lasts as
+    long as the process holding it; if that process dies the lease expires
+    and the host goes back into the pool.
+    """
+    def __init__(self, pool, lease_id, host, entry):
+        self.pool = pool
+        self.id = lease_id
+        self.host = host
+        self.hostname = host["hostname"]
+        self.username = host.get("username")
+        self.holder = entry["holder"]
+        self.cpus = entry["cpus"]
+        self.expires = entry["expires"]
+        self.released = False
+
+    def renew(self):
+        self.expires = self.pool._renew(self)
+
+    def release(self, repos=()):
+        """Give the host back, noting repos as checked out on it"""
+        if not self.released:
+            self.released = True
+            self.pool._release(self, repos)
+
+    def keep_alive(self):
+        def renew():
+            while not self.released:
+                time.sleep(self.pool.ttl / 3.0)
+                if not self.released:
+                    self.renew()
+        thread = threading.Thread(target=renew, name="lease %s" % self.id)
+        thread.daemon = True
+        thread.start()
+        atexit.register(self.release)
+
+
+class SlavePool(object):
+    """Hosts listed in an inventory file, leased out to jobs that need them.
+
+    The inventory is JSON, a list of hosts with what they offer:
+        {"hosts": [{"hostname": "build1", "username": "ci",
+                    "machine type": "x86_64", "os": "Ubuntu 12.04",
+                    "memory": "16GB", "cpus": 8, "max leases": 2,
+                    "repos": ["git://..."]}]}
+    "max leases" is how many jobs can use a host at once (default 1) and
+    "repos" are repositories known to be checked out on it.
+
+    Leases are kept in a state file shared, under a lock, by every process
+    using the pool, so jobs started at the same time by the scheduler see
+    each other's. Among the hosts that meet a job's requirements and have
+    room, lease picks the one with most of the job's repos already checked
+    out, then the least loaded: the one whose live leases take up the
+    smallest share of its CPUs. Load is what the pool has leased, not
+    measured on the host, so work started outside the pool isn't seen.
+    """
+    def __init__(self, inventory_path=INVENTORY_PATH, state_path=STATE_PATH,
+                 ttl=10 * 60):
+        self.inventory_path = os.path.expanduser(inventory_path)
+        self.state_path = os.path.expanduser(state_path)
+        self.ttl = ttl
+
+    def hosts(self):
+        with open(self.inventory_path) as f:
+            return json.load(f)["hosts"]
+
+    def _locked(self, update):
+        """Call update(state) with the state file locked, saving changes"""
+        directory = os.path.dirname(self.state_path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(self.state_path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = {"leases": {}, "warm": {}}
+            if os.path.isfile(self.state_path):
+                with open(self.state_path) as f:
+                    state = json.load(f)
+
+            now = time.time()
+            for lease_id, lease in state["leases"].items():
+                if lease["expires"] < now:
+                    del state["leases"][lease_id]
+
+            result = update(state)
+            with open(self.state_path + ".tmp", "w") as f:
+                json.dump(state, f)
+            os.rename(self.state_path + ".tmp", self.state_path)
+            return result
+
+    def _choose(self, state, requirements, hosts):
+        leases = state["leases"].values()
+        candidates = []
+        for host in hosts:
+            if not requirements.met_by(host):
+                continue
+            held = [lease for lease in leases
+                    if lease["hostname"] == host["hostname"]]
+            if len(held) >= host.get("max leases", 1):
+                continue
+
+            warm = set(host.get("repos", []))
+            warm.update(state["warm"].get(host["hostname"], []))
+            cpus = float(host.get("cpus", 1))
+            load = sum(lease["cpus"] for lease in held) / cpus
+            candidates.append((-len(warm.intersection(requirements.repos)),
+                               load, host["hostname"], host))
+        if not candidates:
+            return None
+        return min(candidates)[3]
+
+    def lease(self, requests, holder=None, wait=30 * 60, poll_interval=5):
+        """Lease a host meeting requests (see Requirements).
+
+        Waits up to wait seconds for one to be free before raising
+        NoSlaveAvailable.
+        """
+        requirements = Requirements(requests)
+        hosts = self.hosts()
+        if not [host for host in hosts if requirements.met_by(host)]:
+            raise NoSlaveAvailable("no host in %s meets %s" % (
+                self.inventory_path, ", ".join(requests)))
+
+        def take(state):
+            host = self._choose(state, requirements, hosts)
+            if host is None:
+                return None
+            lease_id = "%x" % random.getrandbits(64)
+            state["leases"][lease_id] = {
+                "hostname": host["hostname"],
+                "holder": holder or "pid %d" % os.getpid(),
+                "cpus": requirements.values.get("cpus", 1),
+                "expires": time.time() + self.ttl}
+            return Lease(self, lease_id, host, state["leases"][lease_id])
+
+        give_up = time.time() + wait
+        while True:
+            lease = self._locked(take)
+            if lease:
+                return lease
+            if time.time() >= give_up:
+                raise NoSlaveAvailable("every host meeting %s is in use" %
+                                       ", ".join(requests))
+            time.sleep(poll_interval)
+
+    def _renew(self, lease):
+        def renew(state):
+            # Recreated if it expired, say while this machine was
+            # suspended, as the host is still in use
+            expires = time.time() + self.ttl
+            state["leases"][lease.id] = {
+                "hostname": lease.hostname, "holder": lease.holder,
+                "cpus": lease.cpus, "expires": expires}
+            return expires
+        return self._locked(renew)
+
+    def _release(self, lease, repos):
+        def release(state):
+            state["leases"].pop(lease.id, None)
+            warm = state["warm"].setdefault(lease.hostname, [])
+            for repo in repos:
+                if repo in warm:
+                    warm.remove(repo)
+                warm.append(repo)
+            del warm[:-WARM_REPOS]
+        self._locked(release)
+
+    def load(self):
+        """Live leases on each host in the inventory"""
+        def count(state):
+            return [lease["hostname"] for lease in state["leases"].values()]
+        held = self._locked(count)
+        return dict((host["hostname"], held.count(host["hostname"]))
+                    for host in self.hosts())
@@ -0,0 +1,228 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import logging
+import sys
+import threading
+import time
+
+
+class StepGraph(object):
+    """The steps of a job and the steps each one depends on.
+
+    Steps are the job's methods decorated with step; their depends lists
+    are the edges. run works through them with a few threads, starting each
+    step as soon as everything it depends on has finished, so steps that
+    don't depend on each other (fetching a hardware pack while the kernel
+    builds) overlap. Afterwards it logs the critical path: the chain of
+    dependent steps that set how long the run took.
+    """
+    def __init__(self, job):
+        self.job = job
+        self.depends = {}
+        self.shared = set()
+        # (start, end) of each step run by the last call to run
+        self.times = {}
+        for name in dir(type(job)):
+            function = getattr(type(job), name, None)
+            depends = getattr(function, "depends", None)
+            if depends is not None:
+                self.depends[name] = list(depends)
+                if getattr(function, "shared", False):
+                    self.shared.add(name)
+
+        for name, depends in self.depends.items():
+            for depend in depends:
+                if depend not in self.depends:
+                    raise ValueError("step %s depends on %s, which isn't a "
+                                     "step" % (name, depend))
+        self.order()
+
+    def order(self, targets=None):
+        """Steps needed for targets (all steps if None), dependencies first.
+
+        Raises ValueError if steps depend on each other in a loop.
+        """
+        order = []
+        visiting = []
+
+        def visit(name):
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError("steps depend on each other: %s" %
+                                 " -> ".join(visiting + [name]))
+            visiting.append(name)
+            for depend in self.depends[name]:
+                visit(depend)
+            visiting.pop()
+            order.append(name)
+
+        for name in sorted(self.depends if targets is None else targets):
+            if name not in self.depends:
+                raise ValueError("%s isn't a step" % name)
+            visit(name)
+        return order
+
+    def run(self, targets=None, jobs=4, done=()):
+        """Run targets and the steps they depend on, jobs at a time.
+
+        Steps in done are taken as already run. Steps a resumed run is
+        skipping are dealt with first, in order, so the job's restored
+        attributes are in place before anything runs. If a step fails no
+        more are started; once the running ones finish its exception is
+        raised. Returns the (start, end) time of each step.
+        """
+        order = [name for name in self.order(targets) if name not in done]
+        times = self.times = {}
+        complete = set(done)
+        checkpoint = getattr(self.job, "_checkpoint", None)
+        skip = checkpoint.skip if checkpoint else set()
+        for name in order:
+            if(name in skip and
+               all(depend in complete for depend in self.depends[name])):
+                start = time.time()
+                getattr(self.job, name)()
+                times[name] = (start, time.time())
+                complete.add(name)
+
+        waiting = [name for name in order if name not in times]
+        running = set()
+        failures = []
+        condition = threading.Condition()
+
+        def next_step():
+            """Pop a step that is ready to run, None once there are none"""
+            with condition:
+                while True:
+                    if failures or not waiting:
+                        return None
+                    for name in waiting:
+                        if all(depend in complete
+                               for depend in self.depends[name]):
+                            waiting.remove(name)
+                            running.add(name)
+                            return name
+                    condition.wait()
+
+        def worker():
+            try:
+                while True:
+                    name = next_step()
+                    if name is None:
+                        return
+                    start = time.time()
+                    try:
+                        getattr(self.job, name)()
+                    except Exception:
+                        with condition:
+                            failures.append(sys.exc_info())
+                            running.discard(name)
+                            condition.notify_all()
+                        return
+                    with condition:
+                        times[name] = (start, time.time())
+                        complete.add(name)
+                        running.discard(name)
+                        condition.notify_all()
+            finally:
+                release_sessions(self.job)
+
+        run_start = time.time()
+        threads = [threading.Thread(target=worker, name="step %d" % index)
+                   for index in range(min(jobs, len(waiting)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if failures:
+            exc_type, exc_value, exc_traceback = failures[0]
+            raise exc_type, exc_value, exc_traceback
+
+        self.log_critical_path(times, time.time() - run_start)
+        return times
+
+    def critical_path(self, times):
+        """The chain of dependent steps with the longest total time"""
+        total = {}
+        previous = {}
+        for name in self.order(times.keys()):
+            if name not in times:
+                continue
+            depends = [depend for depend in self.depends[name]
+                       if depend in total]
+            longest = max(depends, key=total.get) if depends else None
+            previous[name] = longest
+            total[name] = (times[name][1] - times[name][0] +
+                           (total[longest] if longest else 0))
+
+        if not total:
+            return []
+        name = max(total, key=total.get)
+        path = []
+        while name:
+            path.insert(0, name)
+            name = previous[name]
+        return path
+
+    def log_critical_path(self, times, wall_time):
+        path = self.critical_path(times)
+        if not path:
+            return
+        durations = dict((name, end - start)
+                         for name, (start, end) in times.items())
+        logging.info("steps: critical path %s" % ", ".join(
+            "%s %.1fs" % (name, durations[name]) for name in path))
+        logging.info("steps: critical path %.1fs, run took %.1fs, steps "
+                     "took %.1fs one after another" % (
+                         sum(durations[name] for name in path), wall_time,
+                         sum(durations.values())))
+
+
+class SlaveSessions(object):
+    """Stands in for a slave, giving each thread its own session on it.
+
+    Commands sent to one shell from two threads would interleave, so
+    threads other than the one that made this get a new session, from the
+    slave's new_session, the first time they use it. Sessions given back
+    with release are reused by the next thread that needs one.
+    """
+    def __init__(self, slave):
+        self._sessions = [slave]
+        self._free = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._local.slave = slave
+
+    def _slave(self):
+        slave = getattr(self._local, "slave", None)
+        if slave is None:
+            with self._lock:
+                if self._free:
+                    slave = self._free.pop()
+                else:
+                    name = "ci-runtime-%d" % len(self._sessions)
+                    slave = self._sessions[0].new_session(name)
+                    self._sessions.append(slave)
+            self._local.slave = slave
+        return slave
+
+    def release(self):
+        """Give this thread's session back for another thread to use"""
+        slave = getattr(self._local, "slave", None)
+        if slave is not None and slave is not self._sessions[0]:
+            self._local.slave = None
+            with self._lock:
+                self._free.append(slave)
+
+    def __getattr__(self, name):
+        return getattr(self._slave(), name)
+
+
+def release_sessions(job):
+    """Release the calling thread's sessions on the job's slaves"""
+    for value in vars(job).values():
+        if isinstance(value, SlaveSessions):
+            value.release()
@@ -0,0 +1,587 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+"""rsync style delta transfer of directory trees.
+
+The same file is run on the slave as a helper (python sync.py <command>),
+so everything it needs when run as a script is in the standard library
+and works with either Python 2 or 3. The helper reads and writes the
+binary formats below on stdin and stdout.
+
+A signature is a big endian uint32 block size followed by one uint32 weak
+(rolling) checksum and 16 byte MD5 per block of the file. A delta is a
+list of operations: "C" + uint32 block number copies a block of the
+basis file, "D" + uint32 length + data inserts literal data and "E" ends
+the delta.
+"""
+
+import fnmatch
+import hashlib
+import io
+import json
+import logging
+import operator
+import os
+import shutil
+import stat
+import struct
+import sys
+import threading
+
+BLOCK_SIZE = 2048
+
+# Files smaller than this are sent whole, and so are files bigger than
+# DELTA_MAX_SIZE: finding what changed in them takes longer than sending
+# them. A delta is also given up on if nothing in the first DELTA_GIVE_UP
+# bytes of a file matches the old copy.
+DELTA_MIN_SIZE = 64 * 1024
+DELTA_MAX_SIZE = 64 * 1024 ** 2
+DELTA_GIVE_UP = 1024 ** 2
+
+# Bytes delta reads from a file at a time
+READ_SIZE = 1024 ** 2
+
+
+def weak_checksum(data):
+    data = bytearray(data)
+    length = len(data)
+    a = sum(data)
+    b = sum(map(operator.mul, range(length, 0, -1), data))
+    return a & 0xffff, b & 0xffff
+
+
+def signature(f, block_size=BLOCK_SIZE):
+    """Return the signature of file object f"""
+    parts = [struct.pack(">I", block_size)]
+    while True:
+        block = f.read(block_size)
+        if not block:
+            break
+        a, b = weak_checksum(block)
+        parts.append(struct.pack(">I16s", a | b << 16,
+                                 hashlib.md5(block).digest()))
+    return b"".join(parts)
+
+
+def parse_signature(data):
+    """Return block size and {weak: {strong: block number}} of a signature"""
+    block_size = struct.unpack(">I", data[:4])[0]
+    blocks = {}
+    for number, offset in enumerate(range(4, len(data), 20)):
+        weak, strong = struct.unpack(">I16s", data[offset:offset + 20])
+        blocks.setdefault(weak, {}).setdefault(strong, number)
+    return block_size, blocks
+
+
+def delta(f, signature_data, give_up=None):
+    """Return the delta that turns the signed file into file object f
+
+    f is read READ_SIZE bytes at a time, and literal data is added to the
+    delta as it goes, so only a little of f is held at once. If give_up is
+    given and nothing in that many bytes from the start of f, or in all of
+    f if it is shorter, matches a block of the signed file, None is
+    returned: the delta would be all literal data, which is quicker to
+    send as the file itself.
+    """
+    block_size, blocks = parse_signature(signature_data)
+    ops = []
+    # Unprocessed data from f. The window being matched starts at position
+    # and the literal data not yet in ops at literal_start. base is where
+    # data starts in f.
+    data = bytearray()
+    base = position = literal_start = 0
+    matched = False
+    state = {"eof": False}
+
+    def fill(size):
+        """Read until data has size bytes from position, or f ends"""
+        while not state["eof"] and len(data) - position < size:
+            chunk = f.read(READ_SIZE)
+            if not chunk:
+                state["eof"] = True
+            data.extend(chunk)
+
+    def add_literal(end):
+        if end > literal_start:
+            ops.append(b"D" + struct.pack(">I", end - literal_start) +
+                       bytes(data[literal_start:end]))
+
+    fill(block_size)
+    a, b = weak_checksum(data[position:position + block_size])
+    while len(data) - position >= block_size:
+        matches = blocks.get(a | b << 16)
+        if matches:
+            block = bytes(data[position:position + block_size])
+            number = matches.get(hashlib.md5(block).digest())
+            if number is not None:
+                add_literal(position)
+                ops.append(b"C" + struct.pack(">I", number))
+                position += block_size
+                literal_start = position
+                matched = True
+                if literal_start >= READ_SIZE:
+                    # Forget what has been dealt with
+                    del data[:literal_start]
+                    base += literal_start
+                    position = literal_start = 0
+                fill(block_size)
+                a, b = weak_checksum(data[position:position + block_size])
+                continue
+
+        if give_up is not None and not matched and base + position >= give_up:
+            return None
+
+        # Roll the checksum on by a byte
+        fill(block_size + 1)
+        if len(data) - position > block_size:
+            out_byte = data[position]
+            in_byte = data[position + block_size]
+            a = (a - out_byte + in_byte) & 0xffff
+            b = (b - block_size * out_byte + a) & 0xffff
+        position += 1
+        if position - literal_start >= READ_SIZE:
+            add_literal(position)
+            del data[:position]
+            base += position
+            position = literal_start = 0
+
+    # A short last block can still match the basis file's last block
+    fill(block_size)
+    tail = bytes(data[literal_start:])
+    if tail and len(tail) < block_size:
+        tail_a, tail_b = weak_checksum(tail)
+        number = blocks.get(tail_a | tail_b << 16, {}).get(
+            hashlib.md5(tail).digest())
+        if number is not None:
+            ops.append(b"C" + struct.pack(">I", number))
+            literal_start = len(data)
+            matched = True
+
+    if give_up is not None and not matched:
+        return None
+    add_literal(len(data))
+    ops.append(b"E")
+    return b"".join(ops)
+
+
+def patch(basis, delta_file, out, block_size=BLOCK_SIZE):
+    """Write basis, a file object, with delta_file applied to out.
+
+    Returns the number of literal bytes the delta carried.
+    """
+    literal = 0
+    while True:
+        op = delta_file.read(1)
+        if op == b"C":
+            number = struct.unpack(">I", delta_file.read(4))[0]
+            basis.seek(number * block_size)
+            out.write(basis.read(block_size))
+        elif op == b"D":
+            length = struct.unpack(">I", delta_file.read(4))[0]
+            out.write(delta_file.read(length))
+            literal += length
+        elif op == b"E":
+            return literal
+        else:
+            raise ValueError("bad delta operation %r" % op)
+
+
+def list_tree(root):
+    """Return {relative path: [kind, size, mtime, mode or link target]}"""
+    tree = {}
+    root = os.path.expanduser(root)
+    for directory, names, files in os.walk(root):
+        for name in names + files:
+            path = os.path.join(directory, name)
+            relative = os.path.relpath(path, root)
+            info = os.lstat(path)
+            if stat.S_ISLNK(info.st_mode):
+                tree[relative] = ["link", 0, 0, os.readlink(path)]
+            elif stat.S_ISDIR(info.st_mode):
+                tree[relative] = ["dir", 0, 0, stat.S_IMODE(info.st_mode)]
+            elif stat.S_ISREG(info.st_mode):
+                tree[relative] = ["file", info.st_size, int(info.st_mtime),
+                                  stat.S_IMODE(info.st_mode)]
+    return tree
+
+
+def apply_patch(path, delta_file, mtime, mode, block_size=BLOCK_SIZE):
+    """Replace path with itself patched by delta_file"""
+    with open(path, "rb") as basis:
+        with open(path + ".ci-part", "wb") as out:
+            literal = patch(basis, delta_file, out, block_size)
+    os.chmod(path + ".ci-part", mode)
+    os.utime(path + ".ci-part", (mtime, mtime))
+    os.rename(path + ".ci-part", path)
+    return literal
+
+
+def make_tree(root, tree):
+    """Create directories and symlinks listed in tree under root"""
+    for relative in sorted(tree):
+        kind, _, _, extra = tree[relative]
+        path = os.path.join(root, relative)
+        if kind == "dir" and not os.path.isdir(path):
+            os.makedirs(path)
+        elif kind == "link":
+            if os.path.lexists(path):
+                if os.path.islink(path) and os.readlink(path) == extra:
+                    continue
+                remove([path])
+            os.symlink(extra, path)
+
+
+def remove(paths):
+    for path in paths:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+
+
+def quote(text):
+    """text quoted for a POSIX shell"""
+    return "'%s'" % text.replace("'", "'\\''")
+
+
+def excluded(relative, exclude):
+    """True if relative, or a directory it is in, matches an exclude"""
+    parts = relative.split(os.sep)
+    for pattern in exclude:
+        for index in range(len(parts)):
+            if(fnmatch.fnmatch(parts[index], pattern) or
+               fnmatch.fnmatch(os.sep.join(parts[:index + 1]), pattern)):
+                return True
+    return False
+
+
+class SyncResult(object):
+    """What a sync_dir call did"""
+    def __init__(self):
+        self.unchanged = 0
+        self.whole = 0
+        self.delta = 0
+        self.deleted = 0
+        self.size = 0
+        self.sent = 0
+
+    def __str__(self):
+        return ("%d unchanged, %d sent whole, %d by delta, %d deleted; "
+                "%d of %d bytes transferred" %
+                (self.unchanged, self.whole, self.delta, self.deleted,
+                 self.sent, self.size))
+
+
+class DirectorySync(object):
+    """Synchronise a directory on this machine with one on a slave.
+
+    Files are compared by size and modification time. Changed files big
+    enough to be worth it are sent as an rsync style delta against the
+    old copy, computed with the helper (this file) run on the slave over
+    an exec channel of engine's transport. Everything else goes whole
+    through engine, a TransferEngine. Files are handled engine.channels at
+    a time.
+    """
+    def __init__(self, engine, helper_dir=".cache/ci-runtime"):
+        self.engine = engine
+        self.helper = os.path.join(helper_dir, "sync_helper.py")
+        self.helper_ready = False
+
+    def _run(self, args, stdin=b""):
+        """Run the helper on the slave, return its stdout"""
+        if not self.helper_ready:
+            channel = self.engine.transport.open_session()
+            channel.exec_command("mkdir -p %s" %
+                                 os.path.dirname(self.helper))
+            channel.recv_exit_status()
+            self.engine.put(os.path.abspath(__file__).replace(".pyc", ".py"),
+                            self.helper)
+            self.helper_ready = True
+
+        channel = self.engine.transport.open_session()
+        try:
+            channel.exec_command(
+                '"$(command -v python3 || command -v python)" %s %s' %
+                (self.helper, " ".join(quote(arg) for arg in args)))
+            channel.sendall(stdin)
+            channel.shutdown_write()
+            output = channel.makefile("rb").read()
+            error = channel.makefile_stderr("rb").read()
+            if channel.recv_exit_status() != 0:
+                raise IOError("sync helper %s failed: %s" %
+                              (args[0], error))
+        finally:
+            channel.close()
+        return output
+
+    def sync(self, local, remote, direction="push", delete=False,
+             exclude=()):
+        local = os.path.expanduser(local)
+        # SFTP and the helper both start in the login directory
+        if remote.startswith("~/"):
+            remote = remote[2:]
+
+        self._run(["mkdir", remote])
+        if direction == "push":
+            if not os.path.isdir(local):
+                os.makedirs(local)
+            source = list_tree(local)
+            dest = json.loads(self._run(["list", remote]).decode("utf-8"))
+        elif direction == "pull":
+            if not os.path.isdir(local):
+                os.makedirs(local)
+            source = json.loads(self._run(["list", remote]).decode("utf-8"))
+            dest = list_tree(local)
+        else:
+            raise ValueError("direction must be push or pull")
+
+        source = dict((path, info) for path, info in source.items()
+                      if not excluded(path, exclude))
+        result = SyncResult()
+
+        # Remove what the source doesn't have first, so a path can change
+        # from a file to a directory or back
+        stale = [path for path, info in dest.items()
+                 if not excluded(path, exclude) and (
+                     path not in source or source[path][0] != info[0] or
+                     info[0] == "link" and source[path][3] != info[3])]
+        if not delete:
+            stale = [path for path in stale if path in source]
+        if stale:
+            result.deleted = len([path for path in stale
+                                  if path not in source])
+            if direction == "push":
+                self._run(["remove", remote], json.dumps(stale).encode())
+            else:
+                remove([os.path.join(local, path) for path in stale])
+            for path in stale:
+                dest.pop(path)
+
+        tree = dict((path, info) for path, info in source.items()
+                    if info[0] != "file")
+        if direction == "push":
+            self._run(["make-tree", remote], json.dumps(tree).encode())
+        else:
+            make_tree(local, tree)
+
+        files = []
+        for path, info in sorted(source.items()):
+            if info[0] != "file":
+                continue
+            result.size += info[1]
+            if path in dest and dest[path][1:3] == info[1:3]:
+                result.unchanged += 1
+            else:
+                files.append((path, info, path in dest))
+
+        lock = threading.Lock()
+
+        def sync_file(item):
+            path, info, exists = item
+            local_path = os.path.join(local, path)
+            remote_path = os.path.join(remote, path)
+            sent = None
+            if exists and DELTA_MIN_SIZE <= info[1] <= DELTA_MAX_SIZE:
+                if direction == "push":
+                    sent = self._push_delta(local_path, remote_path, info)
+                else:
+                    sent = self._pull_delta(remote_path, local_path, info)
+                if sent is not None:
+                    with lock:
+                        result.delta += 1
+            if sent is None:
+                if direction == "push":
+                    self._put(local_path, remote_path, info)
+                else:
+                    self._get(remote_path, local_path, info)
+                sent = info[1]
+                with lock:
+                    result.whole += 1
+            with lock:
+                result.sent += sent
+
+        self._parallel(sync_file, files)
+        logging.info("sync_dir: %s %s %s: %s" %
+                     (local, "->" if direction == "push" else "<-", remote,
+                      result))
+        return result
+
+    def _parallel(self, function, items):
+        self.engine.parallel(function, items)
+
+    def _put(self, local_path, remote_path, info):
+        """Copy a whole file to the slave, keeping its mtime and mode"""
+        self.engine.put(local_path, remote_path)
+
+    def _get(self, remote_path, local_path, info):
+        self.engine.get(remote_path, local_path)
+
+    def _push_delta(self, local_path, remote_path, info):
+        """Send the changes to local_path as a delta. Returns the bytes
+        sent, or None if the file would be better sent whole"""
+        signature_data = self._run(["signature", remote_path])
+        with open(local_path, "rb") as f:
+            delta_data = delta(f, signature_data, DELTA_GIVE_UP)
+        if delta_data is None:
+            return None
+        self._run(["patch", remote_path, str(info[2]), str(info[3])],
+                  delta_data)
+        return len(delta_data)
+
+    def _pull_delta(self, remote_path, local_path, info):
+        with open(local_path, "rb") as f:
+            signature_data = signature(f)
+        delta_data = self._run(["delta", remote_path], signature_data)
+        if not delta_data:
+            # The helper gave up, see delta
+            return None
+        apply_patch(local_path, BytesReader(delta_data), info[2], info[3])
+        return len(delta_data)
+
+
+class BytesReader(object):
+    """Minimal file object reading from a byte string"""
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, size):
+        data = self.data[self.offset:self.offset + size]
+        self.offset += size
+        return data
+
+
+class LocalDirectorySync(DirectorySync):
+    """DirectorySync with a slave that is this machine.
+
+    files is the slave's LocalFiles. The helper's commands run in this
+    process and files are copied by files, one at a time, so nothing needs
+    an SSH connection. Remote paths are relative to files.root.
+    """
+    def _run(self, args, stdin=b""):
+        stdout = io.BytesIO()
+        path = os.path.join(self.engine.root, os.path.expanduser(args[1]))
+        helper([args[0], path] + args[2:], io.BytesIO(stdin), stdout)
+        return stdout.getvalue()
+
+    def _parallel(self, function, items):
+        for item in items:
+            function(item)
+
+
+class SlaveDirectorySync(DirectorySync):
+    """DirectorySync through a slave's commands, for slaves with neither
+    an SSH transport nor local files.
+
+    The tree on the slave is listed and changed with shell commands, and
+    files are copied whole, one at a time, by the slave's put_file and
+    get_file. Slower, but works with any slave that can copy files.
+    Relative remote paths are in the login directory, as with SFTP.
+    """
+    def _remote(self, path):
+        if path.startswith("/"):
+            return quote(path)
+        return '"$HOME"/' + quote(path)
+
+    def _run(self, args, stdin=b""):
+        command, path = args[0], args[1]
+        slave = self.engine
+        if command == "mkdir":
+            slave.mkdir(self._remote(path))
+        elif command == "list":
+            tree = {}
+            rx = slave.query("find %s -mindepth 1 -printf "
+                             "'%%y\\t%%s\\t%%T@\\t%%m\\t%%l\\t%%P\\n'" %
+                             self._remote(path), "list the tree to sync")
+            for line in rx:
+                fields = line.split("\t", 5)
+                if len(fields) != 6:
+                    continue
+                kind, size, mtime, mode, link, relative = fields
+                if kind == "l":
+                    tree[relative] = ["link", 0, 0, link]
+                elif kind == "d":
+                    tree[relative] = ["dir", 0, 0, int(mode, 8)]
+                elif kind == "f":
+                    tree[relative] = ["file", int(size), int(float(mtime)),
+                                      int(mode, 8)]
+            return json.dumps(tree).encode("utf-8")
+        elif command == "remove":
+            paths = json.loads(stdin.decode("utf-8"))
+            for start in range(0, len(paths), 100):
+                slave.cmd("rm -rf " + " ".join(
+                    self._remote(os.path.join(path, relative))
+                    for relative in paths[start:start + 100]),
+                    "remove what the source doesn't have")
+        elif command == "make-tree":
+            tree = json.loads(stdin.decode("utf-8"))
+            for relative in sorted(tree):
+                kind, _, _, extra = tree[relative]
+                target = self._remote(os.path.join(path, relative))
+                if kind == "dir":
+                    slave.mkdir(target)
+                elif kind == "link":
+                    slave.cmd("ln -sfn %s %s" % (quote(extra), target),
+                              "link as in the source")
+        else:
+            raise ValueError("unknown command %s" % command)
+        return b""
+
+    def _parallel(self, function, items):
+        for item in items:
+            function(item)
+
+    def _push_delta(self, local_path, remote_path, info):
+        return None
+
+    def _pull_delta(self, remote_path, local_path, info):
+        return None
+
+    def _put(self, local_path, remote_path, info):
+        self.engine.put_file(local_path, remote_path)
+        self.engine.cmd("touch -m -d @%d %s && chmod %o %s" %
+                        (info[2], self._remote(remote_path), info[3],
+                         self._remote(remote_path)),
+                        "keep the source's mtime and mode")
+
+    def _get(self, remote_path, local_path, info):
+        self.engine.get_file(remote_path, local_path)
+        os.utime(local_path, (info[2], info[2]))
+        os.chmod(local_path, info[3])
+
+
+def helper(args, stdin, stdout):
+    """Run a helper command, reading and writing binary file objects"""
+    command, path = args[0], os.path.expanduser(args[1])
+
+    if command == "mkdir":
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    elif command == "list":
+        stdout.write(json.dumps(list_tree(path)).encode("utf-8"))
+    elif command == "signature":
+        with open(path, "rb") as f:
+            stdout.write(signature(f))
+    elif command == "delta":
+        with open(path, "rb") as f:
+            # Nothing if it isn't worth it, as a delta is never empty
+            stdout.write(delta(f, stdin.read(), DELTA_GIVE_UP) or b"")
+    elif command == "patch":
+        apply_patch(path, stdin, int(args[2]), int(args[3]))
+    elif command == "remove":
+        remove([os.path.join(path, relative)
+                for relative in json.loads(stdin.read().decode("utf-8"))])
+    elif command == "make-tree":
+        make_tree(path, json.loads(stdin.read().decode("utf-8")))
+    else:
+        raise ValueError("unknown command %s" % command)
+
+
+def main(args):
+    """Helper commands run on the slave"""
+    helper(args, getattr(sys.stdin, "buffer", sys.stdin),
+           getattr(sys.stdout, "buffer", sys.stdout))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
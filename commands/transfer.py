@@ -0,0 +1,297 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import hashlib
+import logging
+import os
+import pipes
+import Queue
+import stat
+import threading
+import time
+
+
+# Bytes per SFTP read or write request. 32k is the largest request every
+# SFTP server is required to accept.
+BLOCK_SIZE = 32768
+
+
+def local_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), ""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class Transfer(object):
+    """Record of one file transfer"""
+    def __init__(self, direction, source, dest, size, seconds, channels,
+                 skipped=False):
+        self.direction = direction
+        self.source = source
+        self.dest = dest
+        self.size = size
+        self.seconds = seconds
+        self.channels = channels
+        self.skipped = skipped
+
+    @property
+    def rate(self):
+        """Bytes per second"""
+        if self.skipped or not self.seconds:
+            return 0
+        return self.size / self.seconds
+
+    def __str__(self):
+        if self.skipped:
+            return "%s %s -> %s: unchanged, skipped" % (
+                self.direction, self.source, self.dest)
+        return "%s %s -> %s: %d bytes in %.2fs (%.1f MB/s, %d channel%s)" % (
+            self.direction, self.source, self.dest, self.size, self.seconds,
+            self.rate / (1024 * 1024), self.channels,
+            "" if self.channels == 1 else "s")
+
+
+class TransferEngine(object):
+    """Copy files to and from a slave over SFTP on an SSH transport.
+
+    SFTP sessions are opened on the transport as needed and kept in a pool.
+    Writes are pipelined and reads prefetched, so a transfer isn't limited
+    to one request per round trip. Files of at least split_size bytes are
+    split into ranges copied over up to channels sessions at once, and
+    put_files/get_files copy many files concurrently over the same number
+    of sessions.
+
+    Unchanged files are skipped. check is "mtime" (same size and
+    modification time), "checksum" (same size and sha256, computed on the
+    slave with sha256sum) or None to always copy. Copied files get the
+    source's modification time and permissions so the mtime check works
+    next time.
+    """
+    def __init__(self, transport, channels=4, split_size=32 * 1024 ** 2,
+                 check="mtime"):
+        self.transport = transport
+        self.channels = channels
+        self.split_size = split_size
+        self.check = check
+        self.transfers = []
+        self._pool = []
+        self._lock = threading.Lock()
+
+    def _sftp(self):
+        import paramiko
+        with self._lock:
+            if self._pool:
+                return self._pool.pop()
+        return paramiko.SFTPClient.from_transport(self.transport)
+
+    def _release(self, sftp):
+        with self._lock:
+            self._pool.append(sftp)
+
+    def close(self):
+        with self._lock:
+            for sftp in self._pool:
+                sftp.close()
+            self._pool = []
+
+    def remote_sha256(self, path):
+        channel = self.transport.open_session()
+        try:
+            channel.exec_command("sha256sum %s" % pipes.quote(path))
+            output = channel.makefile("rb").read()
+            if channel.recv_exit_status() != 0:
+                return None
+        finally:
+            channel.close()
+        return output.split(" ")[0]
+
+    def _ranges(self, size):
+        """Split size bytes into one range per channel, if it's worth it"""
+        if size < self.split_size or self.channels < 2:
+            return [(0, size)]
+        part = -(-size // self.channels)
+        part += -part % BLOCK_SIZE
+        return [(offset, min(part, size - offset))
+                for offset in range(0, size, part)]
+
+    def parallel(self, function, items):
+        """Call function on each item, self.channels at a time"""
+        if len(items) == 1:
+            function(items[0])
+            return
+
+        queue = Queue.Queue()
+        for item in items:
+            queue.put(item)
+        errors = []
+
+        def worker():
+            while not errors:
+                try:
+                    item = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    function(item)
+                except Exception, e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(self.channels, len(items)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+
+    def _log(self, transfer):
+        self.transfers.append(transfer)
+        logging.info("transfer: %s" % transfer)
+
+    def _put_unchanged(self, local_path, remote_path, local_stat):
+        sftp = self._sftp()
+        try:
+            remote_stat = sftp.stat(remote_path)
+        except IOError:
+            return False
+        finally:
+            self._release(sftp)
+
+        if remote_stat.st_size != local_stat.st_size:
+            return False
+        if self.check == "checksum":
+            return (self.remote_sha256(remote_path) ==
+                    local_sha256(local_path))
+        return remote_stat.st_mtime == int(local_stat.st_mtime)
+
+    def put(self, local_path, remote_path):
+        local_stat = os.stat(local_path)
+        if self.check and self._put_unchanged(local_path, remote_path,
+                                              local_stat):
+            self._log(Transfer("put", local_path, remote_path,
+                               local_stat.st_size, 0, 0, skipped=True))
+            return
+
+        start_time = time.time()
+        ranges = self._ranges(local_stat.st_size)
+        part_path = remote_path + ".ci-part"
+
+        sftp = self._sftp()
+        try:
+            sftp.open(part_path, "wb").close()
+        finally:
+            self._release(sftp)
+
+        def put_range((offset, length)):
+            sftp = self._sftp()
+            try:
+                remote = sftp.open(part_path, "r+b")
+                remote.set_pipelined(True)
+                remote.seek(offset)
+                with open(local_path, "rb") as local:
+                    local.seek(offset)
+                    while length > 0:
+                        data = local.read(min(BLOCK_SIZE, length))
+                        if not data:
+                            break
+                        remote.write(data)
+                        length -= len(data)
+                remote.close()
+            finally:
+                self._release(sftp)
+
+        self.parallel(put_range, ranges)
+
+        sftp = self._sftp()
+        try:
+            sftp.chmod(part_path, stat.S_IMODE(local_stat.st_mode))
+            sftp.utime(part_path, (local_stat.st_atime, local_stat.st_mtime))
+            sftp.posix_rename(part_path, remote_path)
+        finally:
+            self._release(sftp)
+
+        self._log(Transfer("put", local_path, remote_path,
+                           local_stat.st_size, time.time() - start_time,
+                           len(ranges)))
+
+    def _get_unchanged(self, remote_path, local_path, remote_stat):
+        if not os.path.isfile(local_path):
+            return False
+
+        local_stat = os.stat(local_path)
+        if local_stat.st_size != remote_stat.st_size:
+            return False
+        if self.check == "checksum":
+            return (self.remote_sha256(remote_path) ==
+                    local_sha256(local_path))
+        return int(local_stat.st_mtime) == remote_stat.st_mtime
+
+    def get(self, remote_path, local_path):
+        sftp = self._sftp()
+        try:
+            remote_stat = sftp.stat(remote_path)
+        finally:
+            self._release(sftp)
+
+        if self.check and self._get_unchanged(remote_path, local_path,
+                                              remote_stat):
+            self._log(Transfer("get", remote_path, local_path,
+                               remote_stat.st_size, 0, 0, skipped=True))
+            return
+
+        start_time = time.time()
+        ranges = self._ranges(remote_stat.st_size)
+        part_path = local_path + ".ci-part"
+        with open(part_path, "wb") as local:
+            local.truncate(remote_stat.st_size)
+
+        def get_range((offset, length)):
+            sftp = self._sftp()
+            try:
+                remote = sftp.open(remote_path, "rb")
+                blocks = [(block, min(BLOCK_SIZE, offset + length - block))
+                          for block in range(offset, offset + length,
+                                             BLOCK_SIZE)]
+                with open(part_path, "r+b") as local:
+                    local.seek(offset)
+                    # readv requests every block up front, like prefetch()
+                    for data in remote.readv(blocks):
+                        local.write(data)
+                remote.close()
+            finally:
+                self._release(sftp)
+
+        self.parallel(get_range, ranges)
+
+        os.chmod(part_path, stat.S_IMODE(remote_stat.st_mode))
+        os.utime(part_path, (remote_stat.st_atime, remote_stat.st_mtime))
+        os.rename(part_path, local_path)
+
+        self._log(Transfer("get", remote_path, local_path,
+                           remote_stat.st_size, time.time() - start_time,
+                           len(ranges)))
+
+    def write(self, remote_path, contents):
+        """Write contents, a string, to remote_path"""
+        start_time = time.time()
+        sftp = self._sftp()
+        try:
+            remote = sftp.open(remote_path, "wb")
+            remote.set_pipelined(True)
+            remote.write(contents)
+            remote.close()
+        finally:
+            self._release(sftp)
+        self._log(Transfer("write", "<string>", remote_path, len(contents),
+                           time.time() - start_time, 1))
+
+    def put_files(self, pairs):
+        """Put each (local_path, remote_path) in pairs, concurrently"""
+        self.parallel(lambda pair: self.put(*pair), pairs)
+
+    def get_files(self, pairs):
+        """Get each (remote_path, local_path) in pairs, concurrently"""
+        self.parallel(lambda pair: self.get(*pair), pairs)
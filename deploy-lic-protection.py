@@ -4,7 +4,6 @@ from commands.commands import *
 import os
 import socket
 from tempfile import mkdtemp
-from subprocess import call
 import shutil
 import inspect
 import argparse
@@ -33,51 +32,56 @@ class DeployLicenseProtection(LinaroCIJob):
                              "python-requests",
                              "python-textile"])
 
-        target.in_directory(srv_path, sudo=True)
-        target.cmd("chmod a+rx %s" % (srv_path),
-                   "Make %s usable by non-root" % (srv_path), sudo=True)
-        target.cmd("chmod ug+w %s" % (srv_path),
-                   "Make %s usable by non-root" % (srv_path), sudo=True)
+        # Commands whose output isn't looked at are sent in batches, each
+        # run in one round trip
+        with target.batch():
+            target.in_directory(srv_path, sudo=True)
+            target.cmd("chmod a+rx %s" % (srv_path),
+                       "Make %s usable by non-root" % (srv_path), sudo=True)
+            target.cmd("chmod ug+w %s" % (srv_path),
+                       "Make %s usable by non-root" % (srv_path), sudo=True)
 
-        target.cmd("chown -R www-data.www-data %s" % (srv_path),
-                   "Give ownership of %s to www-data." % (srv_path), sudo=True)
+            target.cmd("chown -R www-data.www-data %s" % (srv_path),
+                       "Give ownership of %s to www-data." % (srv_path),
+                       sudo=True)
 
         target.checkout("bzr", "lp:linaro-license-protection")
         target.checkout("bzr", "lp:linaro-license-protection/configs",
                         name="configs")
 
-        target.cmd("a2enmod xsendfile",
-                   "Make sure the Apache xsendfile module is enabled",
-                   sudo=True)
-        target.cmd("a2enmod python",
-                   "Make sure the Apache xsendfile module is enabled",
-                   sudo=True)
+        with target.batch():
+            target.cmd("a2enmod xsendfile",
+                       "Make sure the Apache xsendfile module is enabled",
+                       sudo=True)
+            target.cmd("a2enmod python",
+                       "Make sure the Apache xsendfile module is enabled",
+                       sudo=True)
 
-        target.cmd("cp %s/configs/apache/%s /etc/apache2/sites-available" %
-                   (srv_path, config["service"]["url"]),
-                   "Copy Apache2 config from configuration branch to etc.",
-                   sudo=True)
+            target.cmd("cp %s/configs/apache/%s /etc/apache2/sites-available" %
+                       (srv_path, config["service"]["url"]),
+                       "Copy Apache2 config from configuration branch to etc.",
+                       sudo=True)
 
-        target.cmd("cp -r %s/configs/apache/security /etc/apache2/"
-                   % (srv_path), "Copy Apache security settings.",
-                   sudo=True)
+            target.cmd("cp -r %s/configs/apache/security /etc/apache2/"
+                       % (srv_path), "Copy Apache security settings.",
+                       sudo=True)
 
-        target.cmd("a2ensite %s" % config["service"]["url"],
-                   "Enable %s" % config["service"]["url"], sudo=True)
+            target.cmd("a2ensite %s" % config["service"]["url"],
+                       "Enable %s" % config["service"]["url"], sudo=True)
 
-        # TODO: SSL certificate required...
+            # TODO: SSL certificate required...
 
-        python_path = "{0}:{0}/linaro-license-protection:" \
-                      "{0}/configs/django".format(srv_path)
-        target.cmd("export PYTHONPATH=%s" % python_path,
-                   "Set PYTHONPATH to %s" % python_path)
-        target.cmd("export DJANGO_SETTINGS_MODULE=%s" %
-                   config["service"]["django settings module"],
-                   "Set Django settings module")
+            python_path = "{0}:{0}/linaro-license-protection:" \
+                          "{0}/configs/django".format(srv_path)
+            target.cmd("export PYTHONPATH=%s" % python_path,
+                       "Set PYTHONPATH to %s" % python_path)
+            target.cmd("export DJANGO_SETTINGS_MODULE=%s" %
+                       config["service"]["django settings module"],
+                       "Set Django settings module")
 
-        target.mkdir(os.path.join(srv_path, "db"))
-        target.mkdir(os.path.join(srv_path, "www"))
-        target.chdir(srv_path)
+            target.mkdir(os.path.join(srv_path, "db"))
+            target.mkdir(os.path.join(srv_path, "www"))
+            target.chdir(srv_path)
 
         # Create local_settings with random SECRET_KEY and MASTER_API_KEY
         secret_char_selection = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFG' \
@@ -97,15 +101,17 @@ class DeployLicenseProtection(LinaroCIJob):
         android_build_ip = socket.gethostbyname("android-build.linaro.org")
         validation_ip = socket.gethostbyname("validation.linaro.org")
 
+        # The target already has the branch, so copy config.py from there
+        # rather than branching it again here.
         temp_dir = mkdtemp()
-        os.chdir(temp_dir)
-        call("bzr branch --quiet lp:linaro-license-protection", shell=True)
+        target.get_file(os.path.join(srv_path,
+                                     "linaro-license-protection",
+                                     "license_protected_downloads",
+                                     "config.py"),
+                        os.path.join(temp_dir, "config.py"))
 
         new_config = []
-        with open(os.path.join(temp_dir,
-                               "linaro-license-protection",
-                               "license_protected_downloads",
-                               "config.py")) as f:
+        with open(os.path.join(temp_dir, "config.py")) as f:
             for line in f.readlines():
                 if re.search("# android-build.linaro.org", line):
                     new_config.append(
@@ -3,6 +3,8 @@
 # Copyright 2013 Linaro Ltd.  This software is licensed under the
 # GNU General Public License version 3 (see the file COPYING).
 import json
+import logging
+import time
 import urllib2
 import xmlrpclib
 import os
@@ -33,12 +35,9 @@ class KernelBuild(LinaroCIJob):
     def setup(self):
         """Setup step called before run"""
 
-        # Get a slave machine to run the build on
-        self.x86_64 = x86_64(self.config["target machine"])
-
-        # Find the number of CPUs the target machine has
-        self.cpus = int(self.x86_64.cmd("nproc",
-                                        "Find number of CPUs on system.")[0])
+        # Get a slave machine to run the build on. Steps that run at the
+        # same time each get their own session on it.
+        self.x86_64 = SlaveSessions(x86_64(self.config["target machine"]))
 
         # Create the working directory (if needed) and change into it
         self.x86_64.in_directory(self.config["working directory"])
@@ -46,6 +45,11 @@ class KernelBuild(LinaroCIJob):
         # Record the full path to this directory
         self.base_directory = self.x86_64.cwd()
 
+        # Where this build's hardware pack and packages go. In a matrix run
+        # each board gets its own, see setup_variant.
+        self.results_directory = self.base_directory
+        self.variant = None
+
         # output_dir used to contain kernel version - excluded for this demo
         self.output_dir = os.path.join(self.base_directory, "output_dir")
         self.builddeb_orig_name = None
@@ -53,22 +57,31 @@ class KernelBuild(LinaroCIJob):
         # If there is exactly 1 hardware pack and
         # self.config["hwpack_file_path"] isn't set, fill it in.
         if not self.config["hwpack_file_path"]:
-            hwpacks = self.x86_64.ls("hwpack*.gz")
+            hwpacks = self.x86_64.glob("hwpack*.gz")
             if len(hwpacks) == 1:
-                self.config["hwpack_file_path"] = hwpacks[0]
+                self.config["hwpack_file_path"] = hwpacks[0].path
 
+    def setup_variant(self, name):
+        """Build for this board into a directory of its own"""
+        self.variant = name
+        self.results_directory = os.path.join(self.base_directory, name)
+        self.output_dir = os.path.join(self.results_directory, "output_dir")
+
+    @step(shared=True)
     def install_os_prerequisites(self):
+        # ccache is installed here, once, rather than by every board's build
         self.x86_64.install_deps(
             ["curl", "bzr", "gcc", "git", "u-boot-tools", "build-essential",
              "ia32-libs", "python-html2text", "python-beautifulsoup",
-             "python-xdgapp"])
+             "python-xdgapp", "pbzip2", "pigz", "ccache"])
 
+    @step(depends=["install_os_prerequisites"], shared=True)
     def prepare_environment(self):
-        # -- Set up required directories and get dependencies
-        self.x86_64.mkdir(self.output_dir)
+        # -- Get dependencies
         self.x86_64.in_directory(self.base_directory)
         self.x86_64.use("linaro-gnu-toolchain", ["2012.10", "v4.7"])
 
+    @step(depends=["install_os_prerequisites"], shared=True)
     def checkout(self):
         """Fetch kernel source"""
         self.x86_64.in_directory(self.base_directory)
@@ -81,7 +94,7 @@ class KernelBuild(LinaroCIJob):
         # the make deb-pkg stage will fail unless we use an updated builddeb
         # script. We copy our own over:
         if not re.search("linux-linaro-tracking", self.config["git url"]):
-            self.source = self.x86_64.checkout(
+            self.x86_64.checkout(
                 "bzr", "lp:~linaro-infrastructure/linaro-ci/lci-build-tools")
             self.builddeb_path = "linux/scripts/package/builddeb"
             self.builddeb_orig_name = self.builddeb_path + ".orig_kernel_ci"
@@ -89,13 +102,23 @@ class KernelBuild(LinaroCIJob):
             self.x86_64.copy("lci-build-tools/build-scripts/builddeb",
                              self.builddeb_path)
 
+    @step(depends=["checkout"], shared=True)
     def clean(self):
+        if self.config.get("incremental build", True):
+            # build() cleans if the configuration or toolchain has changed
+            logging.info("clean: incremental build, cleaning only if needed")
+            return
+
+        self._clean_source()
+
+    def _clean_source(self):
         self.x86_64.chdir(os.path.join(self.base_directory,
                                        "linux-linaro-tracking"))
 
         # XXX This clean doesn't specify the output directory. Should it?
         # Do we need it after a clean checkout?
-        self.x86_64.build("make", build_command="make ARCH=arm clean mrproper")
+        self.x86_64.build("clean",
+                          build_command="make ARCH=arm clean mrproper")
 
     def _setup_build(self):
         self.x86_64.chdir(os.path.join(self.base_directory,
@@ -104,21 +127,26 @@ class KernelBuild(LinaroCIJob):
         self.kernel_config_name = re.sub("_defconfig", "",
                                          self.config["env"]["kernel_config"])
 
-        # -- Create kernel version string
+        # -- Create kernel version string. The checkout doesn't change once
+        # made (builds go in output_dir), so hwpack_replace gets the answer
+        # build got without asking the slave again.
         try:
-            self.kernel_version = self.x86_64.cmd("make kernelversion",
-                                                  "find kernel version")[0]
+            self.kernel_version = self.x86_64.query(
+                "make kernelversion", "find kernel version", stable=True)[0]
         except CommandFailed:
             # Couldn't find a kernel version, try for latest tag
-            self.kernel_version = self.x86_64.cmd("git describe --match='v*'",
-                                                  "find kernel version")[0]
+            self.kernel_version = self.x86_64.query(
+                "git describe --match='v*'", "find kernel version",
+                stable=True)[0]
             self.kernel_version = re.sub("^v", "", self.kernel_version)
             self.kernel_version = "-".join([self.kernel_version,
                                        self.config["env"]["kernel id"],
                                        self.kernel_config_name,
                                        self.config["env"]["kernel_flavour"]])
 
+    @step(depends=["clean", "prepare_environment"])
     def build(self):
+        self.x86_64.mkdir(self.output_dir)
         self._setup_build()
         self.x86_64.chdir(os.path.join(self.base_directory,
                                        "linux-linaro-tracking"))
@@ -126,28 +154,60 @@ class KernelBuild(LinaroCIJob):
             self.base_directory, "toolchain/bin/arm-linux-gnueabihf-")
 
         # hack hack hack LOADADDR below is a nasty hack
-        make = ('LOADADDR=0x80008000 make -j%(cpus)d ARCH=arm O=%(out_dir)s '
+        # build() adds -j and -l for the slave it runs on.
+        make = ('LOADADDR=0x80008000 make ARCH=arm O=%(out_dir)s '
                 'KERNELVERSION="%(k_ver)s" '
                 'KERNELRELEASE="%(k_ver)s" '
                 'CROSS_COMPILE="%(t_prefix)s" '
                 % {"out_dir": self.output_dir,
                    "k_ver": self.kernel_version,
-                   "t_prefix": self.toolchain_prefix,
-                   "cpus": self.cpus})
+                   "t_prefix": self.toolchain_prefix})
 
-        self.x86_64.build("make",
-                          make + " " + self.config["env"]["kernel_config"])
+        # Compile through ccache, keyed on this toolchain
+        ccache = {"ccache": True, "toolchain": self.toolchain_prefix}
+
+        start_time = time.time()
+
+        self.x86_64.build(self.config["env"]["kernel_config"],
+                          make + " " + self.config["env"]["kernel_config"],
+                          **ccache)
 
         # -- Update configuration
         k_config = "%s/.config" % (self.output_dir)
         self.x86_64.append_to_file("CONFIG_ARCH_OMAP2=n", k_config)
         self.x86_64.append_to_file("CONFIG_THUMB2_KERNEL=y", k_config)
 
-        # -- Build
-        self.x86_64.build("make", "yes "" | " + make + " oldconfig")
-
+        self.x86_64.build("oldconfig", "yes "" | " + make + " oldconfig",
+                          **ccache)
+
+        # -- Decide between an incremental and a full build. Objects left
+        # in output_dir from the last build are only reused if they were
+        # built from the same .config with the same toolchain.
+        fingerprint, last_fingerprint = self._build_fingerprint()
+        incremental = (self.config.get("incremental build", True) and
+                       fingerprint is not None and
+                       fingerprint == last_fingerprint)
+        if not incremental:
+            logging.info("build: configuration or toolchain changed, "
+                         "doing a full build")
+            # Until the full build has finished, output_dir doesn't hold
+            # what any fingerprint says, so the next run mustn't build on it
+            self.x86_64.cmd("rm -f " + self.fingerprint_path,
+                            "Forget what output_dir was built from")
+            # Other boards in a matrix run are building from the same
+            # source, which the shared clean step left clean
+            if self.variant is None:
+                self._clean_source()
+            self.x86_64.chdir(os.path.join(self.base_directory,
+                                           "linux-linaro-tracking"))
+            self.x86_64.build("clean", make + " clean")
+
+        # -- Build. Full and incremental builds take such different times
+        # that make -j is tuned for each separately.
+        compile_options = dict(ccache, kind="incremental" if incremental
+                               else "full")
         multi_platform_check = self.x86_64.cmd(
-            "grep 'CONFIG_ARCH_MULTIPLATFORM=y' %s" % os.path.join(
+            "grep 'CONFIG_ARCH_MULTIPLATFORM=y' %s || true" % os.path.join(
                 self.output_dir, ".config"),
             "Check to see if CONFIG_ARCH_MULTIPLATFORM is set")
 
@@ -156,48 +216,154 @@ class KernelBuild(LinaroCIJob):
         else:
             kernel_img_cmd = "uImage"
 
-        self.x86_64.build("make", make + " %s" % kernel_img_cmd)
-
-        self.x86_64.build("make", make + " modules")
-
+        targets = [kernel_img_cmd, "modules"]
         if("make dtbs" in self.config["env"] and
            self.config["env"]["make dtbs"]):
-            self.x86_64.build("make", make + " dtbs")
+            targets.append("dtbs")
+
+        compile_start_time = time.time()
+        if self.config.get("fused make", True):
+            self._build_fused(make, targets, compile_options)
+            compile_kind, other = "fused", "separate"
+        else:
+            for target in targets:
+                self.x86_64.build(target, make + " " + target,
+                                  **compile_options)
+            compile_kind, other = "separate", "fused"
+        self._report_time(compile_kind, other,
+                          time.time() - compile_start_time)
+
+        # deb-pkg packages what the targets above built, so it runs after
+        self.x86_64.build("deb-pkg",
+                          make + " KBUILD_DEBARCH=armhf V=1 deb-pkg",
+                          **compile_options)
+
+        if fingerprint:
+            self.x86_64.cmd("echo %s > %s" %
+                            (fingerprint, self.fingerprint_path),
+                            "Record what output_dir was built from")
+        if incremental:
+            self._report_time("incremental", "full", time.time() - start_time)
+        else:
+            self._report_time("full", "incremental", time.time() - start_time)
 
-        self.x86_64.build("make", make + " KBUILD_DEBARCH=armhf V=1 deb-pkg")
+    def _build_fused(self, make, targets, options):
+        """Build independent targets in a single parallel make run
 
-    def hwpack_replace(self):
-        self._setup_build()
+        One make reads the Kbuild files once and keeps every job slot busy
+        across target boundaries. -k carries on past a failing target so
+        the others are still built and reported.
+        """
+        try:
+            self.x86_64.build("+".join(targets),
+                              make + " -k " + " ".join(targets), **options)
+        except CommandFailed, e:
+            status = make_target_status(e.command_output, targets)
+            for target in targets:
+                if status[target] == "ok":
+                    logging.info("build: %s ok" % target)
+                elif status[target] == "failed":
+                    logging.error("build: %s failed" % target)
+                else:
+                    logging.error("build: %s status unknown" % target)
+            raise
+
+        for target in targets:
+            logging.info("build: %s ok" % target)
+
+    def _build_fingerprint(self):
+        """Return the fingerprints of this build and the last one
+
+        The fingerprint is a hash of the resolved .config (after the
+        append_to_file tweaks and oldconfig) and the toolchain. The last
+        build's fingerprint is None if there hasn't been one.
+        """
+        self.fingerprint_path = os.path.join(self.output_dir,
+                                             ".ci-build-fingerprint")
+        toolchain = self.x86_64.toolchain_id(self.toolchain_prefix)
+        rx = self.x86_64.cmd(
+            'echo "ci-fingerprint: $( (cat %s; echo %s) | sha1sum | '
+            'cut -d" " -f1) $(cat %s 2>/dev/null)"' %
+            (os.path.join(self.output_dir, ".config"), toolchain,
+             self.fingerprint_path),
+            "Fingerprint the kernel configuration and toolchain")
+
+        for line in rx:
+            search = re.search(r"^ci-fingerprint: (\w+) ?(\w+)?$", line)
+            if search:
+                return search.groups()
+        return None, None
+
+    def _report_time(self, kind, other, seconds):
+        """Log how long a build of one kind took against the last of other
+
+        kind and other are, for example, "incremental" and "full".
+        """
+        times_path = os.path.join(self.results_directory, ".ci-build-times")
+
+        last = {}
+        for line in self.x86_64.cmd("cat %s 2>/dev/null || true" % times_path,
+                                    "Read previous build times"):
+            search = re.search(r"^(\S+) (\d+)$", line)
+            if search:
+                last[search.group(1)] = int(search.group(2))
+
+        message = "build: %s build took %ds" % (kind, seconds)
+        if other in last:
+            message += ", last %s build took %ds" % (other, last[other])
+        logging.info(message)
+
+        last[kind] = int(seconds)
+        self.x86_64.write_file(times_path, "".join(
+            "%s %d\n" % times for times in sorted(last.items())))
+
+    @step(depends=["install_os_prerequisites"], shared=True)
+    def fetch_tools(self):
+        """Fetch the scripts used to get and update hardware packs"""
         self.x86_64.in_directory(self.base_directory)
-        self.x86_64.checkout("bzr", "lp:linaro-ci", name="lci-build-tools")
+        # Not checked out as lci-build-tools: checkout() may be putting a
+        # different branch there at the same time.
+        self.x86_64.checkout("bzr", "lp:linaro-ci", name="linaro-ci")
+        self.x86_64.checkout("bzr", "lp:linaro-image-tools")
+
+    @step(depends=["fetch_tools"])
+    def fetch_hwpack(self):
+        """Download the latest hardware pack for the target board"""
+        self.x86_64.in_directory(self.results_directory)
+        linaro_ci = os.path.join(self.base_directory, "linaro-ci")
 
         self.x86_64.set_env("hwpack_type", self.config["env"]["hwpack_type"])
 
         hwpack_url = self.x86_64.cmd(
-            "lci-build-tools/get_latest_slo_hwpack",
+            os.path.join(linaro_ci, "get_latest_slo_hwpack"),
             "get the URL of the latest hardware pack for the target board")[0]
 
-        self.x86_64.cmd("lci-build-tools/download_file " + hwpack_url,
-                        "download the hardware pack")
+        self.x86_64.cmd(os.path.join(linaro_ci, "download_file ") +
+                        hwpack_url, "download the hardware pack")
 
-        hwpack_file_name = os.path.basename(hwpack_url)
+        self.hwpack_file_name = os.path.basename(hwpack_url)
 
-        self.x86_64.checkout("bzr", "lp:linaro-image-tools")
+    @step(depends=["build", "fetch_hwpack"])
+    def hwpack_replace(self):
+        self._setup_build()
+        self.x86_64.in_directory(self.results_directory)
         new_hwpack_name = self.x86_64.cmd(
-            "linaro-image-tools/linaro-hwpack-replace"
+            os.path.join(self.base_directory, "linaro-image-tools",
+                         "linaro-hwpack-replace") +
             " -t {hwpack_file_name}"
             " -p ./linux-image*{kernel_version}*.deb"
             " -r linux-image"
             " -n {build_number}".format(
-            hwpack_file_name=hwpack_file_name,
+            hwpack_file_name=self.hwpack_file_name,
             kernel_version=self.kernel_version,
             build_number=self.config["env"]["build_number"]),
             "Replace the kernel in the hardware pack with"
             " the one we have just built.")
 
-        self.x86_64.rm(hwpack_file_name)
+        self.x86_64.rm(self.hwpack_file_name)
         self.config["hwpack_file_path"] = new_hwpack_name[1]
 
+    @step(depends=["build"], shared=True)
     def tidy_up(self):
         """Tidy up after build"""
         self.x86_64.in_directory(self.base_directory)
@@ -205,26 +371,22 @@ class KernelBuild(LinaroCIJob):
         if self.builddeb_orig_name:
             self.x86_64.move(self.builddeb_orig_name, self.builddeb_path)
 
+    @step(depends=["hwpack_replace"])
     def publish(self):
         """Push files up to specified server, run listed commands."""
-        self.x86_64.in_directory(self.base_directory)
-
         for to_path, file_globs in self.config["publish files"].iteritems():
-            for filename_glob in file_globs:
-                filenames = self.x86_64.ls(filename_glob)
-                for filename in filenames:
-                    # Keep a record of where we uploaded the hwpack to
-                    if filename == self.config["hwpack_file_path"]:
-                        self.config["hwpack_file_path"] = os.path.join(
-                            to_path.format(**self.config["env"]),
-                            filename)
-                    self.x86_64.publish_file(
-                        filename,
-                        os.path.join(to_path.format(**self.config["env"]),
-                                     filename),
-                        self.config["publish to"],
-                    )
-
+            destination = to_path.format(**self.config["env"])
+            manifest = self.x86_64.publish(self.results_directory, file_globs,
+                                           destination,
+                                           self.config["publish to"])
+
+            # Keep a record of where we uploaded the hwpack to
+            for entry in manifest:
+                if entry["path"] == self.config["hwpack_file_path"]:
+                    self.config["hwpack_file_path"] = os.path.join(
+                        destination, entry["path"])
+
+    @step(depends=["publish"])
     def submit_lava_job(self):
         hwpack = "{host}/{path}?key={key}".format(
             host=self.config["publish to"]["hostname"],
@@ -321,15 +483,7 @@ class KernelBuild(LinaroCIJob):
             sys.exit(1)
 
     def run(self):
-        self.install_os_prerequisites()
-        self.prepare_environment()
-        self.checkout()
-        self.clean()
-        self.build()
-        self.hwpack_replace()
-        self.tidy_up()
-        self.publish()
-        self.submit_lava_job()
+        self.run_steps()
 
     def _command_line_args(self, parameters):
         parser = argparse.ArgumentParser(
@@ -366,7 +520,7 @@ class KernelBuild_linux_origen_exynos4(KernelBuild):
         self.set_triggers(["daily 22:00", "on merge request"])
         args = self._command_line_args(parameters)
 
-        self.config = {
+        self.config = ConfigDict({
             "target machine": {
                 "reserved": {
                     "hostname": args.host,
@@ -406,14 +560,15 @@ class KernelBuild_linux_origen_exynos4(KernelBuild):
                 "lava_user": "dooferlad",
                 "lava_server": "lavaserver/RPC2/",
                 "lava_https": False,
-                "os image": get_latest_lava_nano_image_url(),
+                "os image": LazyValue(get_latest_lava_nano_image_url,
+                                      "lava nano image url"),
             },
             "git url":
             "git://git.linaro.org/kernel/linux-linaro-tracking.git",
 
             "hwpack_file_path": args.hwpack_file_path,
             "working directory": "~/_not_backed_up_/ci-runtime/kernel",
-        }
+        })
 
     def run(self):
         super(KernelBuild_linux_origen_exynos4, self).run()
@@ -439,7 +594,7 @@ class KernelBuild_linux_panda(KernelBuild):
         self.set_triggers(["daily 22:00", "on merge request"])
         args = self._command_line_args(parameters)
 
-        self.config = {
+        self.config = ConfigDict({
             "target machine": {
                 "reserved": {
                     "hostname": args.host,
@@ -481,13 +636,14 @@ class KernelBuild_linux_panda(KernelBuild):
                 "lava_user": "dooferlad",
                 "lava_server": "lavaserver/RPC2/",
                 "lava_https": False,
-                "os image": get_latest_lava_nano_image_url(),
+                "os image": LazyValue(get_latest_lava_nano_image_url,
+                                      "lava nano image url"),
             },
             "git url":
             "git://git.linaro.org/kernel/linux-linaro-tracking.git",
             "hwpack_file_path": args.hwpack_file_path,
              "working directory": "~/_not_backed_up_/ci-runtime/kernel",
-        }
+        })
 
     def run(self):
         super(KernelBuild_linux_panda, self).run()
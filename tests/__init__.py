@@ -9,6 +9,21 @@ def test_suite():
         'tests.cli_processing',
         'tests.screen_and_shell',
         'tests.job_commands',
+        'tests.build_cache',
+        'tests.artifacts',
+        'tests.transfer',
+        'tests.sync',
+        'tests.publish',
+        'tests.remote_fs',
+        'tests.local_files',
+        'tests.checkpoint',
+        'tests.steps',
+        'tests.daemon',
+        'tests.scheduler',
+        'tests.slave_pool',
+        'tests.matrix',
+        'tests.batch',
+        'tests.query_cache',
     ]
     # if pyflakes is installed and we're running from a bzr checkout...
     if(subprocess.call('which pyflakes', shell=True) and
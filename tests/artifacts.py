@@ -0,0 +1,170 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import BaseHTTPServer
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from utils import *
+from commands.artifacts import (Artifact, ArtifactFailed, ArtifactIndex,
+                                ArtifactNotFound, decompressor)
+
+INDEX = {
+    "artifacts": [
+        {"name": "toolchain", "tags": ["4.7", "daily"],
+         "url": "old.tar.bz2"},
+        {"name": "toolchain", "tags": ["4.7", "daily"],
+         "url": "new.tar.bz2", "sha256": "a" * 64, "size": 10,
+         "directory": "tc", "strip_components": 1},
+        {"name": "toolchain", "tags": ["4.8"],
+         "url": "http://example.com/4.8.tar.bz2"},
+    ]
+}
+
+
+class IndexHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.headers.getheader("If-None-Match"))
+        if self.headers.getheader("If-None-Match") == '"1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", '"1"')
+        self.end_headers()
+        self.wfile.write(json.dumps(INDEX))
+
+    def log_message(self, *args):
+        pass
+
+
+class TestArtifactIndex(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        with open(os.path.join(self.basedir, "index.json"), "w") as f:
+            json.dump(INDEX, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_find_local_directory(self):
+        index = ArtifactIndex(self.basedir)
+        artifact = index.find("toolchain", ["daily"])
+
+        # Last match wins, relative URLs are next to the index
+        self.assertEqual(artifact.url, "file://" + os.path.join(
+            self.basedir, "new.tar.bz2"))
+        self.assertEqual(artifact.id, "a" * 64)
+        self.assertEqual(artifact.directory, "tc")
+        self.assertEqual(artifact.strip_components, 1)
+
+        artifact = index.find("toolchain", ["4.8"])
+        self.assertEqual(artifact.url, "http://example.com/4.8.tar.bz2")
+        self.assertEqual(artifact.directory, "toolchain")
+
+        self.assertRaises(ArtifactNotFound, index.find, "toolchain", ["4.9"])
+
+    def test_http_index_cached(self):
+        IndexHandler.requests = []
+        server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), IndexHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            url = "http://127.0.0.1:%d/index.json" % server.server_port
+            cache_dir = os.path.join(self.basedir, "cache")
+
+            index = ArtifactIndex(url, cache_dir)
+            self.assertEqual(index.find("toolchain", ["4.8"]).name,
+                             "toolchain")
+            self.assertEqual(
+                ArtifactIndex(url, cache_dir).find("toolchain", ["daily"]).url,
+                "http://127.0.0.1:%d/new.tar.bz2" % server.server_port)
+            # Within the TTL, the second index didn't ask the server
+            self.assertEqual(IndexHandler.requests, [None])
+
+            # After it, the ETag is sent and the cached copy re-used
+            ArtifactIndex(url, cache_dir, ttl=0).load()
+            self.assertEqual(IndexHandler.requests, [None, '"1"'])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestSlaveArtifactStore(unittest.TestCase):
+    def setUp(self):
+        self.slave = RecordSlave()
+        self.slave.artifact_index = ArtifactIndex(
+            os.path.join(os.path.dirname(__file__), os.pardir, "commands",
+                         "artifacts.json"))
+
+    def test_use(self):
+        self.slave.set_response("ci-artifact", "ci-artifact: 0")
+        self.slave.use("linaro-gnu-toolchain", ["v4.7"])
+
+        sent = self.slave.shell.sent[-1]
+        self.assertTrue(sent.startswith(
+            "(set -o pipefail; x=~/.cache/ci-runtime/artifacts/extracted/"))
+        # Streamed through a parallel bzip2 if there is one, quietly
+        self.assertTrue("| tee $d.tmp | $(command -v pbzip2 || echo bzip2) "
+                        "-dc | tar -C $x.tmp --strip-components 1 -x &&"
+                        in sent)
+        self.assertTrue(sent.endswith("ln -sfn $x toolchain); "
+                                      'echo "ci-artifact: $?"'))
+
+    def test_checksum(self):
+        artifact = Artifact("tc", [], "http://example.com/tc.tar.xz",
+                            sha256="b" * 64)
+        self.slave.set_response("ci-artifact", "ci-artifact: 2")
+        self.assertRaises(ArtifactFailed, self.slave.artifact_store.fetch,
+                          self.slave, artifact)
+        self.assertTrue("b" * 64 + "  $d" in self.slave.shell.sent[-1])
+
+    def test_size(self):
+        artifact = Artifact("tc", [], "http://example.com/tc.tar.xz",
+                            size=10, sha256="b" * 64)
+        self.slave.set_response("ci-artifact", "ci-artifact: 0")
+        self.slave.artifact_store.fetch(self.slave, artifact)
+        self.assertTrue('test "$(stat -c %s $d)" = 10 ||' in
+                        self.slave.shell.sent[-1])
+
+    def test_unpinned_revalidated(self):
+        self.slave.set_response("ci-artifact", "ci-artifact: 0")
+        self.slave.use("linaro-gnu-toolchain", ["v4.7"])
+        sent = self.slave.shell.sent[-1]
+        # Asks the server which version the URL has and keeps the answer
+        self.assertTrue("if h=$(curl -sSfLkI https://releases.linaro.org/"
+                        in sent)
+        self.assertTrue("> $x.tmp/.ci-stamp;" in sent)
+
+        artifact = Artifact("tc", [], "http://example.com/tc.tar.xz",
+                            sha256="b" * 64)
+        self.slave.artifact_store.fetch(self.slave, artifact)
+        self.assertFalse(".ci-stamp" in self.slave.shell.sent[-1])
+
+    def test_url_quoted(self):
+        artifact = Artifact("tc", [], "http://example.com/tc.tar.xz;reboot",
+                            sha256="b" * 64, directory="my tc")
+        self.slave.set_response("ci-artifact", "ci-artifact: 0")
+        self.slave.artifact_store.fetch(self.slave, artifact)
+        sent = self.slave.shell.sent[-1]
+        self.assertTrue("curl -sSfLk 'http://example.com/tc.tar.xz;reboot' |"
+                        in sent)
+        self.assertTrue("ln -sfn $x 'my tc');" in sent)
+
+    def test_failed(self):
+        self.slave.set_response("ci-artifact", "ci-artifact: 1")
+        self.assertRaises(ArtifactFailed, self.slave.use,
+                          "linaro-gnu-toolchain", ["v4.7"])
+
+    def test_decompressor(self):
+        self.assertEqual(decompressor("http://a/b.tar.gz"),
+                         "$(command -v pigz || echo gzip) -dc")
+        self.assertEqual(decompressor("http://a/b.tar.xz"), "xz -T0 -dc")
+        self.assertEqual(decompressor("http://a/b.tar"), "cat")
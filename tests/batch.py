@@ -0,0 +1,119 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from utils import *
+from commands import batch
+from commands.local_files import LocalFiles
+
+
+class TestScript(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.path = os.path.join(self.basedir, "batch.sh")
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def run_script(self, commands):
+        with open(self.path, "w") as f:
+            f.write(batch.script(commands, self.path))
+        return subprocess.check_output(
+            ["bash", "-c", batch.run_command(self.path) +
+             '; echo "status $?"; pwd']).splitlines()
+
+    def test_script(self):
+        rx = self.run_script(["cd " + self.basedir, "printf no-newline",
+                              "echo a; echo b"])
+        self.assertEqual(batch.parse(rx), [(0, []), (0, ["no-newline"]),
+                                           (0, ["a", "b"])])
+        # Run in the shell that sourced it, which kept the cd
+        self.assertEqual(rx[-2:], ["status 0", self.basedir])
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_failure(self):
+        rx = self.run_script(["echo ran", "(exit 3)", "echo not run"])
+        self.assertEqual(batch.parse(rx), [(0, ["ran"]), (3, [])])
+        self.assertEqual(rx[-2], "status 3")
+
+
+class TestBatch(unittest.TestCase):
+    def setUp(self):
+        self.slave = RecordSlave()
+        self.slave.sftp = LocalFiles()
+        self.slave.sudo_password = ""
+
+    def run_batch(self, response):
+        """Respond to the batch script with response, returning its path
+        and contents"""
+        self.slave.set_response(r"^\. /tmp/ci-batch-", response)
+        self.slave.flush()
+        path = self.slave.shell.sent[-1][2:]
+        with open(path) as f:
+            contents = f.read()
+        os.remove(path)
+        return path, contents
+
+    def test_batch(self):
+        with self.slave.batch():
+            self.slave.in_directory("/srv/site", sudo=True)
+            self.slave.set_env("A", "b")
+            self.slave.cmd("a2enmod python", "enable", sudo=True)
+            self.assertEqual(self.slave.shell.sent, [])
+
+            path, contents = self.run_batch(
+                "\n".join("ci-batch: %d 0" % index for index in range(4)))
+
+        self.assertEqual(self.slave.shell.sent, [". " + path])
+        self.assertEqual(
+            [line for line in contents.splitlines()
+             if not line.startswith("ci_status")],
+            ["rm -f " + path, "sudo mkdir -p /srv/site", "cd /srv/site",
+             "export A='b'", "sudo a2enmod python"])
+
+    def test_read_output(self):
+        with self.slave.batch():
+            self.slave.mkdir("a")
+            output = self.slave.cmd("apache2ctl -S", "list sites")
+            self.assertEqual(self.slave.shell.sent, [])
+
+            self.run_batch("ci-batch: 0 0\nsite\nci-batch: 1 0")
+            # Reading the output ran the commands recorded before it
+            self.assertEqual(list(output), ["site"])
+            self.assertEqual(len(self.slave.shell.sent), 1)
+            self.slave.chdir("a")
+        self.assertEqual(self.slave.shell.sent[1:], ["cd a"])
+
+    def test_other_commands_flush(self):
+        with self.slave.batch():
+            self.slave.mkdir("a")
+            self.slave.ls()
+        self.assertEqual(self.slave.shell.sent, ["mkdir -p a", "ls"])
+
+    def test_no_file_access(self):
+        # Nowhere to write a script, so the commands are run one by one
+        slave = commands.CISlave()
+        slave.shell = RecordShell("ci_lava_target_machine: ")
+        with slave.batch():
+            slave.mkdir("a")
+            slave.copy("a", "b")
+        self.assertEqual(slave.shell.sent, ["mkdir -p a", "cp a b"])
+
+    def test_failure(self):
+        self.slave.set_response(r"^\. /tmp/ci-batch-",
+                                "ci-batch: 0 0\ncp: failed\n\nci-batch: 1 1")
+        try:
+            with self.slave.batch():
+                self.slave.mkdir("a")
+                self.slave.copy("a", "b")
+                self.slave.chdir("b")
+            self.fail("CommandFailed not raised")
+        except commands.CommandFailed, e:
+            self.assertEqual((e.cmd, e.return_code, e.command_output),
+                             ("cp a b", "1", ["cp: failed"]))
+        finally:
+            os.remove(self.slave.shell.sent[-1][2:])
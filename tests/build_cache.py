@@ -0,0 +1,139 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+from utils import *
+from commands.build_cache import build_key, LocalBuildCache, RESTORE
+
+
+class TestBuildKey(unittest.TestCase):
+    def test_key_depends_on_everything(self):
+        parts = ["uid", "make", "target", "A=1", "toolchain"]
+        key = build_key(*parts)
+        self.assertEqual(key, build_key(*parts))
+
+        for index in range(len(parts)):
+            changed = list(parts)
+            changed[index] += "x"
+            self.assertNotEqual(key, build_key(*changed))
+
+
+class TestSlaveBuildCache(unittest.TestCase):
+    def setUp(self):
+        self.slave = RecordSlave()
+        self.slave.jobs_tuner = None
+        self.slave.set_response("ci-toolchain", "ci-toolchain: " + "1" * 64)
+
+    def build(self):
+        self.slave.build(build_command="make images", cached=True,
+                         source_uid="abc", outputs=["out/*.img"])
+
+    def test_hit_skips_build(self):
+        self.slave.set_response("exit 3", "ci-build-cache: 0")
+        self.build()
+
+        self.assertFalse([sent for sent in self.slave.shell.sent
+                          if sent.startswith("make")])
+        self.assertEqual(self.slave.build_cache.hits, 1)
+
+    def test_miss_builds_and_stores(self):
+        self.slave.set_response("exit 3", "ci-build-cache: 1")
+        self.slave.set_response("find out/\*.img", "ci-build-cache-stored: 0")
+        self.build()
+
+        self.assertTrue("make -j1 -l1 images" in self.slave.shell.sent)
+        self.assertTrue(self.slave.shell.sent[-1].startswith(
+            "(mkdir -p ~/.cache/ci-runtime/build-cache/objects"))
+        self.assertEqual(self.slave.build_cache.misses, 1)
+
+    def test_corrupt_entry_is_a_miss(self):
+        self.slave.set_response("exit 3", "ci-build-cache: 3")
+        self.build()
+
+        self.assertTrue("make -j1 -l1 images" in self.slave.shell.sent)
+        self.assertEqual(self.slave.build_cache.corrupt, 1)
+        self.assertEqual(self.slave.build_cache.misses, 1)
+
+    def test_restore_corrupt_keeps_shared_objects(self):
+        root = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(root, "objects"))
+            os.makedirs(os.path.join(root, "entries"))
+            objects = {}
+            for content in ["good", "bad"]:
+                sha256 = hashlib.sha256(content).hexdigest()
+                objects[content] = sha256
+                with open(os.path.join(root, "objects", sha256), "w") as f:
+                    f.write(content if content == "good" else "changed")
+            with open(os.path.join(root, "entries", "key"), "w") as f:
+                f.write("%s 644 out/good\n%s 644 out/bad\n" %
+                        (objects["good"], objects["bad"]))
+
+            output = subprocess.check_output(
+                ["bash", "-c", RESTORE % {"root": root, "key": "key"}],
+                cwd=root, stderr=open(os.devnull, "w"))
+            self.assertTrue(output.endswith("ci-build-cache: 3\n"))
+            self.assertEqual(os.listdir(os.path.join(root, "entries")), [])
+            # Another entry could be using the good object
+            self.assertEqual(os.listdir(os.path.join(root, "objects")),
+                             [objects["good"]])
+        finally:
+            shutil.rmtree(root)
+
+    def test_no_source_uid_not_cached(self):
+        self.slave.build(build_command="make images", cached=True,
+                         source_uid=None, outputs=["out/*.img"])
+        self.assertEqual(self.slave.shell.sent[-1], "make -j1 -l1 images")
+
+
+class TestLocalBuildCache(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache = LocalBuildCache(self.root, max_size=10)
+        os.makedirs(self.cache.objects)
+        os.makedirs(self.cache.entries)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def add_entry(self, key, objects, age):
+        files = []
+        for sha256, content in objects:
+            with open(os.path.join(self.cache.objects, sha256), "w") as f:
+                f.write(content)
+            files.append([sha256, "644", "out/" + sha256])
+
+        entry_path = os.path.join(self.cache.entries, key + ".json")
+        with open(entry_path, "w") as f:
+            json.dump(files, f)
+        os.utime(entry_path, (time.time() - age, time.time() - age))
+
+    def test_evict_least_recently_used(self):
+        self.add_entry("old", [("a", "12345"), ("shared", "12")], 100)
+        self.add_entry("new", [("b", "12345"), ("shared", "12")], 0)
+
+        self.cache._evict()
+
+        self.assertEqual(os.listdir(self.cache.entries), ["new.json"])
+        self.assertEqual(sorted(os.listdir(self.cache.objects)),
+                         ["b", "shared"])
+        self.assertEqual(self.cache.evictions, 1)
+
+    def test_restore_corrupt_object(self):
+        shared = hashlib.sha256("shared").hexdigest()
+        self.add_entry("key", [("0" * 64, "not the content"),
+                               (shared, "shared")], 0)
+        self.add_entry("other", [(shared, "shared")], 0)
+
+        self.assertFalse(self.cache.restore(None, "key"))
+        self.assertEqual(self.cache.corrupt, 1)
+        self.assertEqual(os.listdir(self.cache.entries), ["other.json"])
+        # Only the bad object goes; the other entry still has its object
+        self.assertEqual(os.listdir(self.cache.objects), [shared])
@@ -0,0 +1,65 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from utils import *
+from commands.checkpoint import Checkpoint, decode, encode, step
+
+
+class Job(object):
+    runs = []
+
+    @step
+    def build(self):
+        self.runs.append(self)
+        self.version = "3.10"
+        return "built"
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "job.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        Job.runs = []
+
+    def test_encode(self):
+        checkout = commands.Checkout("git", "url", "master", {".": "abc"})
+        value = {"checkout": checkout, "slave": RecordSlave(),
+                 "lazy": commands.LazyValue(lambda: 1), "list": [1, "a"]}
+
+        decoded = decode(json.loads(json.dumps(encode(value))))
+
+        self.assertEqual(sorted(decoded), ["checkout", "list"])
+        self.assertEqual(decoded["checkout"].uid, checkout.uid)
+        self.assertEqual(decoded["list"], [1, "a"])
+
+    def test_step_without_checkpoint(self):
+        job = Job()
+        self.assertEqual(job.build(), "built")
+        self.assertEqual(Job.runs, [job])
+
+    def test_skip_completed(self):
+        job = Job()
+        job._checkpoint = Checkpoint(self.path, "key")
+        job.build()
+
+        job = Job()
+        job._checkpoint = Checkpoint(self.path, "key", resume=True)
+        job.build()
+        self.assertFalse(job in Job.runs)
+        self.assertEqual(job.version, "3.10")
+
+        # A different key, or not resuming, runs everything again
+        for checkpoint in [Checkpoint(self.path, "new key", resume=True),
+                           Checkpoint(self.path, "key")]:
+            job = Job()
+            job._checkpoint = checkpoint
+            job.build()
+            self.assertTrue(job in Job.runs)
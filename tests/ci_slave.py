@@ -34,3 +34,37 @@ class TestSlaveGenerics(unittest.TestCase):
                             u'\nci_lava_target_machine 10034: '])
         rx = slave._in_shell_cmd("", quiet=True)
         self.assertEqual(["0"], rx)
+
+
+class TestSessions(unittest.TestCase):
+    def test_new_session_shares_machine(self):
+        slave = commands.x86_64({})
+        session = slave.new_session("ci-runtime-1")
+        slave.sudo_password = ""
+        session.resources = (8, 2097152)
+        session.checked_out.append("git://git.linaro.org/kernel/linux.git")
+        session.toolchain_ids["gcc"] = "1" * 64
+
+        self.assertEqual(session.sudo_password, "")
+        self.assertEqual(slave.resources, (8, 2097152))
+        # So the lease's warm repos include what sessions checked out
+        self.assertEqual(slave.checked_out,
+                         ["git://git.linaro.org/kernel/linux.git"])
+        self.assertEqual(slave.toolchain_ids, {"gcc": "1" * 64})
+        self.assertTrue(session.ccache_dirs is slave.ccache_dirs)
+
+    def test_sudo_checked_once(self):
+        slave = RecordSlave()
+        session = RecordSlave()
+        session.machine = slave.machine
+        slave.cmd("apt-get update", "update", sudo=True)
+        session.cmd("apt-get update", "update", sudo=True)
+        self.assertEqual(slave.shell.sent, ["sudo -n ls",
+                                            "sudo apt-get update"])
+        self.assertEqual(session.shell.sent, ["sudo apt-get update"])
+
+
+class TestShells(unittest.TestCase):
+    def test_no_reserved_machine(self):
+        self.assertRaises(ValueError, commands.TelnetShell, {},
+                          "ci_lava_target_machine: ")
@@ -2,13 +2,19 @@
 # GNU General Public License version 3 (see the file COPYING).
 
 
+import os
+import shutil
 import sys
-from commands.commands import CIJobRuntime
+import tempfile
+from commands import commands
+from commands.commands import CIJobRuntime, ConfigDict, LazyValue
 import unittest
 
 
 class TestArgParse(unittest.TestCase):
     def setUp(self):
+        self.checkpoint_dir = tempfile.mkdtemp()
+        CIJobRuntime.checkpoint_dir = self.checkpoint_dir
         self.test_job_path = "tests/test_jobs"
         if not self.test_job_path in sys.path:
             sys.path.append(self.test_job_path)
@@ -17,6 +23,7 @@ class TestArgParse(unittest.TestCase):
             self.added_path = False
 
     def tearDown(self):
+        shutil.rmtree(self.checkpoint_dir)
         if self.added_path:
             sys.path.remove(self.test_job_path)
 
@@ -174,3 +181,99 @@ class TestArgParse(unittest.TestCase):
         self.assertFalse(runtime.job.run_called)
         self.assertTrue(runtime.job.setup_called)
         self.assertTrue(runtime.job.some_function_called)
+
+    def test_lazy_config_only_resolved_when_used(self):
+        runtime = CIJobRuntime(["LazyJob", "some_function"])
+        self.assertEqual(runtime.job.lookups, 0)
+
+        runtime = CIJobRuntime(["LazyJob", "use_config", "use_config"])
+        self.assertEqual(runtime.job.image, "image.tar.gz")
+        self.assertEqual(runtime.job.lookups, 1)
+
+    def test_resume(self):
+        import CIJob
+        CIJob.StepJob.calls = []
+        CIJob.StepJob.fail = True
+        self.assertRaises(commands.CommandFailed, CIJobRuntime,
+                          ["StepJob", "--thing"])
+        self.assertEqual(CIJob.StepJob.calls, ["first", "second"])
+
+        CIJob.StepJob.calls = []
+        CIJob.StepJob.fail = False
+        runtime = CIJobRuntime(["StepJob", "--resume", "--thing"])
+        self.assertEqual(runtime.job.parameters, ["--thing"])
+        self.assertEqual(CIJob.StepJob.calls, ["second"])
+        # State left by the skipped step is restored
+        self.assertEqual(runtime.job.source.uid,
+                         commands.Checkout("git", "url",
+                                           revisions={".": "abc"}).uid)
+        self.assertEqual(runtime.job.config["path"], "built")
+        self.assertEqual(runtime.job.config["env"]["image"], "x")
+
+        # The run completed, so there is nothing left to resume
+        CIJob.StepJob.calls = []
+        CIJobRuntime(["StepJob", "--resume", "--thing"])
+        self.assertEqual(CIJob.StepJob.calls, ["first", "second"])
+
+    def test_resume_other_parameters(self):
+        import CIJob
+        CIJob.StepJob.calls = []
+        CIJob.StepJob.fail = True
+        self.assertRaises(commands.CommandFailed, CIJobRuntime, ["StepJob"])
+
+        CIJob.StepJob.calls = []
+        CIJob.StepJob.fail = False
+        CIJobRuntime(["StepJob", "--resume", "--other"])
+        self.assertEqual(CIJob.StepJob.calls, ["first", "second"])
+
+    def test_matrix(self):
+        import CIJob
+        CIJob.BoardJob.calls = []
+        runtime = CIJobRuntime(["--matrix=BoardJob_panda,BoardJob_origen"])
+        self.assertEqual(runtime.job_name, "BoardJob_panda")
+        self.assertTrue(runtime.job.setup_called)
+        # Shared steps once, each board's build in between
+        calls = CIJob.BoardJob.calls
+        self.assertEqual(calls[0], "checkout")
+        self.assertEqual(sorted(calls[1:3]), ["build BoardJob_origen",
+                                              "build BoardJob_panda"])
+        self.assertEqual(calls[3:], ["tidy_up"])
+
+
+class TestLazyValue(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.calls = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def function(self):
+        self.calls += 1
+        return "value %d" % self.calls
+
+    def test_config_dict(self):
+        config = ConfigDict({"a": LazyValue(self.function),
+                             "nested": {"b": LazyValue(self.function)}})
+        self.assertEqual(self.calls, 0)
+        self.assertEqual(config["a"], "value 1")
+        self.assertEqual(config.get("a"), "value 1")
+        self.assertEqual(config["nested"]["b"], "value 2")
+        self.assertEqual(config.get("missing", "default"), "default")
+        self.assertEqual("{a} {b}".format(a=config["a"], **config["nested"]),
+                         "value 1 value 2")
+        self.assertEqual(self.calls, 2)
+
+    def test_disk_cache(self):
+        value = LazyValue(self.function, "key", cache_dir=self.cache_dir)
+        self.assertEqual(value.get(), "value 1")
+        value = LazyValue(self.function, "key", cache_dir=self.cache_dir)
+        self.assertEqual(value.get(), "value 1")
+        self.assertEqual(self.calls, 1)
+
+        value = LazyValue(self.function, "key", ttl=0,
+                          cache_dir=self.cache_dir)
+        self.assertEqual(value.get(), "value 2")
+        value = LazyValue(self.function, "other key",
+                          cache_dir=self.cache_dir)
+        self.assertEqual(value.get(), "value 3")
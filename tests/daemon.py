@@ -0,0 +1,137 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from utils import *
+from commands.daemon import Daemon, ShellPool, submit
+
+
+class PoolShell(object):
+    def __init__(self, broken=False):
+        self.sessions = 0
+        self.ended = 0
+        self.terminated = False
+        self.broken = broken
+
+    def start_session(self):
+        self.sessions += 1
+
+    def end_session(self):
+        if self.broken:
+            raise socket.timeout("shell didn't respond")
+        self.ended += 1
+
+    def terminate(self):
+        self.terminated = True
+
+
+class PoolSlave(object):
+    def __init__(self, hostname="slave", shell=None):
+        self.config = {"reserved": {"hostname": hostname,
+                                    "username": "ci"}}
+        self.shell = shell
+        self.sudo_password = None
+
+
+class TestShellPool(unittest.TestCase):
+    def test_reuse(self):
+        pool = ShellPool()
+        shell = PoolShell()
+        first = PoolSlave(shell=shell)
+        self.assertFalse(pool.lease(first))
+        pool.add(first)
+        first.sudo_password = ""
+        pool.release_all()
+        self.assertEqual((shell.sessions, shell.ended), (1, 1))
+
+        # Another host doesn't get the connection
+        self.assertFalse(pool.lease(PoolSlave("other")))
+
+        second = PoolSlave()
+        self.assertTrue(pool.lease(second))
+        self.assertTrue(second.shell is shell)
+        self.assertEqual(second.sudo_password, "")
+        self.assertEqual(shell.sessions, 2)
+
+        # Only one job can have it at a time
+        self.assertFalse(pool.lease(PoolSlave()))
+
+        pool.release_all()
+        pool.idle_timeout = 0
+        time.sleep(0.01)
+        pool.expire()
+        self.assertTrue(shell.terminated)
+        self.assertFalse(pool.lease(PoolSlave()))
+
+    def test_broken_connection(self):
+        pool = ShellPool()
+        shell = PoolShell(broken=True)
+        pool.add(PoolSlave(shell=shell))
+        pool.release_all()
+        self.assertTrue(shell.terminated)
+        self.assertFalse(pool.lease(PoolSlave()))
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tempdir, "lrn.sock")
+        self.test_job_path = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "test_jobs")
+        sys.path.append(self.test_job_path)
+        # Jobs run in the client's directory
+        os.chdir(self.tempdir)
+
+    def tearDown(self):
+        os.chdir(os.path.dirname(os.path.dirname(self.test_job_path)))
+        sys.path.remove(self.test_job_path)
+        shutil.rmtree(self.tempdir)
+
+    def test_no_daemon(self):
+        self.assertEqual(submit([], self.socket_path), None)
+
+    def test_submit(self):
+        daemon = Daemon(self.socket_path, poll_interval=0.05)
+        thread = threading.Thread(target=daemon.serve)
+        thread.start()
+        try:
+            while not daemon.running:
+                time.sleep(0.01)
+
+            output = StringIO.StringIO()
+            self.assertEqual(submit(["CIJob", "OutputJob"], self.socket_path,
+                                    output), 0)
+            self.assertEqual(output.getvalue(), "logged\nprinted\n")
+
+            output = StringIO.StringIO()
+            self.assertEqual(submit(["CIJob", "OutputJob", "--fail"],
+                                    self.socket_path, output), 3)
+            self.assertEqual(output.getvalue(), "logged\nprinted\n")
+        finally:
+            daemon.stop()
+            thread.join()
+        self.assertFalse(os.path.exists(self.socket_path))
+        self.assertTrue(commands.CISlave.shell_pool is None)
+        self.assertTrue(commands.CISlave.interactive)
+
+    def test_socket_private(self):
+        daemon = Daemon(self.socket_path)
+        server = daemon._listen()
+        try:
+            self.assertEqual(os.stat(self.socket_path).st_mode & 0077, 0)
+        finally:
+            server.close()
+
+    def test_sudo_password(self):
+        # No one can type it in, so asking would hang the job
+        slave = RecordSlave()
+        slave.interactive = False
+        slave.shell.responses = [(r"echo \$\?", "1")]
+        self.assertRaises(RuntimeError, slave.cmd, "ls", "list", sudo=True)
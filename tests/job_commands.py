@@ -1,10 +1,14 @@
 # Copyright 2013 Linaro Ltd.  This software is licensed under the
 # GNU General Public License version 3 (see the file COPYING).
 
+import hashlib
+import json
 import shlex
 import shutil
 import unittest
 import tempfile
+import threading
+import time
 import os
 import re
 from utils import *
@@ -110,6 +114,18 @@ class TestJobCommands(unittest.TestCase):
                          self.git_repo_name,
                          self.file_in_repo)))
 
+    def test_checkout_git_revision(self):
+        self.set_up_git_repo()
+        head = check_output(["git", "rev-parse", "HEAD"]).strip()
+        self.in_working_dir()
+
+        source = self.slave.checkout("git", self.git_repo_path)
+
+        self.assertEqual(source.vcs_type, "git")
+        self.assertEqual(source.revision, head)
+        self.assertFalse(source.dirty)
+        self.assertNotEqual(source.uid, None)
+
     def test_checkout_git_exists(self):
         self.set_up_git_repo()
         self.in_working_dir()
@@ -130,7 +146,8 @@ class TestJobCommands(unittest.TestCase):
 
         # We expect the second git operation to work out that it has already
         # got that repository checked out and just update it...
-        self.assertTrue("git pull" in self.slave.shell.sent)
+        self.assertTrue([sent for sent in self.slave.shell.sent
+                         if sent.startswith("git pull")])
 
         if self.git_repo_name[-4:] == ".git":
             self.git_repo_name = self.git_repo_name[:-4]
@@ -177,7 +194,8 @@ class TestJobCommands(unittest.TestCase):
 
         # We expect the second git operation to work out that it has already
         # got that repository checked out and just update it...
-        self.assertTrue("bzr update" in self.slave.shell.sent)
+        self.assertTrue([sent for sent in self.slave.shell.sent
+                         if sent.startswith("bzr update")])
 
         self.assertTrue(os.path.isfile(
             os.path.join(self.working_dir,
@@ -221,6 +239,22 @@ class TestJobCommands(unittest.TestCase):
             self.slave.ls(os.path.join(self.basedir, "a_dir")),
             ["another_file"])
 
+    def test_stat_many_and_glob(self):
+        self.call("mkdir " + os.path.join(self.basedir, "a_dir"))
+        self.call("touch " + os.path.join(self.basedir, "a_file"))
+
+        stats = self.slave.stat_many(["a_dir", "a_file", "missing"],
+                                     base_dir=self.basedir, sha256=True)
+        self.assertEqual(sorted(stats), ["a_dir", "a_file"])
+        self.assertEqual(stats["a_dir"].type, "directory")
+        self.assertEqual(stats["a_file"].size, 0)
+        self.assertEqual(stats["a_file"].sha256,
+                         hashlib.sha256("").hexdigest())
+
+        self.slave.chdir(self.basedir)
+        self.assertEqual([stat.path for stat in self.slave.glob("a_*")],
+                         ["a_dir", "a_file"])
+
     def test_copy(self):
         filename = os.path.join(self.basedir, "test_file")
         target = os.path.join(self.basedir, "target")
@@ -303,6 +337,8 @@ class TestJobCommandsFakeRun(unittest.TestCase):
         self.basedir = tempfile.mkdtemp()
         os.chdir(self.basedir)
         self.call_output = None
+        self.slave.jobs_tuner = commands.JobsTuner(
+            os.path.join(self.basedir, "build-jobs.json"))
 
     def tearDown(self):
         if os.path.exists(self.basedir):
@@ -315,12 +351,247 @@ class TestJobCommandsFakeRun(unittest.TestCase):
         self.slave.set_response("dpkg -l .*", "no packages found matching")
         self.slave.install_deps(["repo", "gcc", "git"])
 
-        self.assertTrue(
-            re.search(r"^sudo apt-get -yq install\b", self.slave.shell.sent[-1]))
+        self.assertTrue(re.search(r"^sudo apt-get -yq install\b",
+                                  self.slave.shell.sent[-1]))
         self.assertTrue(re.search(r"\brepo\b", self.slave.shell.sent[-1]))
         self.assertTrue(re.search(r"\bgcc\b", self.slave.shell.sent[-1]))
         self.assertTrue(re.search(r"\bgit\b", self.slave.shell.sent[-1]))
 
+    def test_install_deps_one_at_a_time(self):
+        # Another session on the machine is installing packages
+        session = RecordSlave()
+        session.package_lock = self.slave.package_lock
+        session.set_response("dpkg -l .*", "no packages found matching")
+        with self.slave.package_lock:
+            thread = threading.Thread(target=session.install_deps,
+                                      args=(["ccache"],))
+            thread.start()
+            time.sleep(0.05)
+            self.assertEqual(session.shell.sent, [])
+        thread.join()
+        self.assertEqual(session.shell.sent[-1],
+                         "sudo apt-get -yq install ccache")
+
+    def test_checkout_revisions(self):
+        self.slave.set_response("git clone",
+                                "ci-revision: . %s 0" % ("a" * 40))
+        source = self.slave.checkout("git", "git://example.com/project.git")
+
+        self.assertEqual(source.revision, "a" * 40)
+        self.assertFalse(source.dirty)
+        self.assertTrue(re.search(r"git clone .* && \(cd project && ",
+                                  self.slave.shell.sent[-1]))
+
+        # The UID depends only on content, not on where it came from.
+        same = commands.Checkout("git", "http://mirror/project.git",
+                                 revisions={".": "a" * 40})
+        self.assertEqual(source.uid, same.uid)
+
+    def test_git_revision_ignores_untracked(self):
+        env = dict(os.environ, GIT_AUTHOR_NAME="ci", GIT_AUTHOR_EMAIL="ci@x",
+                   GIT_COMMITTER_NAME="ci", GIT_COMMITTER_EMAIL="ci@x")
+        for command in ["git init -q", "touch tracked", "git add tracked",
+                        "git commit -qm initial"]:
+            check_output(shlex.split(command), env=env)
+
+        def changed():
+            output = check_output(["bash", "-c",
+                                   commands.GIT_REVISION % "."])
+            return output.split()[-1]
+
+        # Build output left in the tree doesn't make it dirty
+        with open("built.o", "w") as f:
+            f.write("object")
+        self.assertEqual(changed(), "0")
+        with open("tracked", "w") as f:
+            f.write("edited")
+        self.assertEqual(changed(), "1")
+
+    def test_checkout_repo_revisions(self):
+        self.slave.set_response("ci-host", "ci-host: 4 8388608")
+        self.slave.set_response(r"^echo \$HOME", "/home/ci")
+        self.slave.set_response(
+            "repo sync", "ci-revision: a/b %s 0\nci-revision: c %s 2" %
+            ("a" * 40, "b" * 40))
+        source = self.slave.checkout("repo", "git://example.com/manifest.git")
+
+        self.assertEqual(source.revisions, {"a/b": "a" * 40, "c": "b" * 40})
+        self.assertTrue(source.dirty)
+        self.assertEqual(source.uid, None)
+
+    def test_checkout_repo_sync(self):
+        self.slave.set_response("ci-host", "ci-host: 4 8388608")
+        self.slave.set_response(r"^echo \$HOME", "/home/ci")
+        self.slave.set_response("repo sync -j4 --current-branch",
+                                "ci-rx-bytes: 1500")
+        self.slave.set_response("rx", "ci-rx-bytes: 1000")
+        source = self.slave.checkout("repo", "git://example.com/manifest.git",
+                                     branch="master")
+
+        mirror = [sent for sent in self.slave.shell.sent
+                  if "repo init --mirror" in sent]
+        self.assertEqual(len(mirror), 1)
+        self.assertTrue(re.search(r"repo sync -j4\)$", mirror[0]))
+
+        # The mirror is made and referenced at the same absolute path
+        path = os.path.join("/home/ci/.cache/ci-runtime/repo-mirrors",
+                            hashlib.sha1("git://example.com/manifest.git")
+                            .hexdigest())
+        self.assertTrue(mirror[0].startswith(
+            "(mkdir -p %s && cd %s && " % (path, path)))
+        init = [sent for sent in self.slave.shell.sent
+                if sent.startswith("~/bin/repo init -u")]
+        self.assertTrue(init[0].endswith("-b master --reference=" + path))
+        self.assertEqual(source.bytes_transferred, 500)
+        self.assertNotEqual(source.sync_seconds, None)
+
     def test_build(self):
         self.slave.build()
         self.assertTrue(re.search(r"\bmake\b", self.slave.shell.sent[-1]))
+
+    def test_build_ccache_cross_compile(self):
+        self.slave.set_response("dpkg -l", "no packages found matching")
+        self.slave.set_response("ci-toolchain", "ci-toolchain: " + "1" * 64)
+        self.slave.set_response("ccache -s", "cache hit (direct) 30\n"
+                                             "cache hit (preprocessed) 10\n"
+                                             "cache miss 10")
+        self.slave.build(build_command='make CROSS_COMPILE="tc/bin/arm-" all',
+                         toolchain="tc/bin/arm-", ccache=True)
+
+        self.assertTrue("sudo apt-get -yq install ccache" in
+                        self.slave.shell.sent)
+        ccache_dir = "~/.cache/ci-runtime/ccache/1111111111111111"
+        self.assertTrue("CCACHE_DIR=%s ccache -M 10G" % ccache_dir in
+                        self.slave.shell.sent)
+        self.assertEqual(
+            self.slave.shell.sent[-1],
+            "(export CCACHE_DIR=%s; " % ccache_dir +
+            "ccache -z > /dev/null; "
+            'make -j1 -l1 CROSS_COMPILE="ccache tc/bin/arm-" all; r=$?; '
+            "ccache -s; exit $r)")
+
+    def test_build_ccache_native(self):
+        self.slave.set_response("ci-toolchain", "ci-toolchain: " + "1" * 64)
+        self.slave.build(build_command="make all", ccache=True)
+        self.assertTrue('CC="ccache gcc" make -j1 -l1 all' in
+                        self.slave.shell.sent[-1])
+
+    def test_build_jobs_auto(self):
+        # 8 CPUs but only enough memory for 4 jobs
+        self.slave.set_response("ci-host", "ci-host: 8 2097152")
+        self.slave.build("all", build_command="yes | make all")
+        self.assertEqual(self.slave.shell.sent[-1], "yes | make -j4 -l8 all")
+
+    def test_build_jobs_requested(self):
+        self.slave.set_response("ci-host", "ci-host: 8 2097152")
+        self.slave.build("all", build_command="make all", jobs=16)
+        self.assertEqual(self.slave.shell.sent[-1], "make -j16 -l8 all")
+
+    def test_build_jobs_in_command(self):
+        self.slave.build("all", build_command="make -j3 all")
+        self.assertEqual(self.slave.shell.sent[-1], "make -j3 all")
+
+    def test_build_jobs_tuned(self):
+        self.slave.set_response("ci-host", "ci-host: 4 8388608")
+        tried = []
+        for build in range(3):
+            self.slave.build("all", build_command="make all")
+            tried.append(self.slave.shell.sent[-1])
+
+        # Try the default, half and one and a half times, then the fastest
+        self.assertEqual(tried, ["make -j4 -l4 all",
+                                 "make -j2 -l4 all",
+                                 "make -j6 -l4 all"])
+        # These builds take no time, so make -j2 the fastest
+        for jobs, seconds in [(4, 600), (4, 600), (6, 500), (6, 500)]:
+            self.slave.jobs_tuner.record("unknown", "all", jobs, seconds)
+        self.slave.build("all", build_command="make all")
+        self.assertEqual(self.slave.shell.sent[-1], "make -j2 -l4 all")
+
+    def test_build_jobs_tuned_by_kind(self):
+        tuner = self.slave.jobs_tuner
+        for jobs, seconds in [(4, 600), (2, 900), (6, 500)]:
+            tuner.record("host", "all", jobs, seconds)
+        # A no-op incremental build doesn't make -j4 look fastest for
+        # full builds
+        tuner.record("host", "all", 4, 5, kind="incremental")
+        self.assertEqual(tuner.choose("host", "all", 4, [2, 4, 6]), 6)
+        self.assertEqual(tuner.choose("host", "all", 4, [2, 4, 6],
+                                      kind="incremental"), 2)
+
+    def test_build_jobs_tuner_explores(self):
+        tuner = self.slave.jobs_tuner
+        tuner.explore_every = 4
+        for jobs, seconds in [(4, 600), (2, 900), (6, 500)]:
+            tuner.record("host", "all", jobs, seconds)
+        # One lucky build is outweighed by the others at that -j
+        for seconds in [100, 550, 560]:
+            tuner.record("host", "all", 6, seconds)
+        self.assertEqual(tuner.choose("host", "all", 4, [2, 4, 6]), 6)
+
+        # Every few builds, the candidate tried longest ago gets another go
+        tuner.record("host", "all", 6, 500)
+        self.age("4", 60)
+        self.assertEqual(tuner.choose("host", "all", 4, [2, 4, 6]), 4)
+
+        # Old times are forgotten, so -j2 is tried again
+        tuner.record("host", "all", 6, 500)
+        self.age("2", tuner.max_age)
+        self.assertEqual(tuner.choose("host", "all", 4, [2, 4, 6]), 2)
+
+    def age(self, jobs, seconds):
+        """Make the tuner's times for jobs seconds older"""
+        tuner = self.slave.jobs_tuner
+        history = tuner._load()
+        for sample in history["host"]["all"]["full"]["jobs"][jobs]:
+            sample[0] -= seconds
+        with open(tuner.path, "w") as f:
+            json.dump(history, f)
+
+    def test_build_jobs_not_tuned(self):
+        self.slave.set_response("ci-host", "ci-host: 4 8388608")
+        for target in ["clean", "oldconfig", "omap2plus_defconfig",
+                       "clean+mrproper"]:
+            self.slave.build(target, build_command="make " + target)
+            self.assertEqual(self.slave.shell.sent[-1],
+                             "make -j4 -l4 " + target)
+        self.assertEqual(self.slave.jobs_tuner._load(), {})
+
+    def test_make_target_status(self):
+        targets = ["uImage", "modules", "dtbs"]
+        # make -k O=... uImage modules dtbs, with a compile error in drivers
+        output = [
+            "make[1]: Entering directory `/build/out'",
+            "  CC      drivers/foo.o",
+            "drivers/foo.c:10:1: error: expected ';' before '}' token",
+            "make[3]: *** [drivers/foo.o] Error 1",
+            "make[2]: *** [drivers] Error 2",
+            "  DTC     arch/arm/boot/dts/omap4-panda.dtb",
+            "make[1]: Target `uImage' not remade because of errors.",
+            "make[1]: Target `modules' not remade because of errors.",
+            "make[1]: Leaving directory `/build/out'",
+            "make: *** [sub-make] Error 2",
+            "make: Target `uImage' not remade because of errors.",
+            "make: Target `modules' not remade because of errors.",
+            "make: Target `dtbs' not remade because of errors."]
+        self.assertEqual(commands.make_target_status(output, targets),
+                         {"uImage": "failed", "modules": "failed",
+                          "dtbs": "ok"})
+
+        # Without O=, from a newer make, failing in a recursive make
+        output = [
+            "make[1]: *** [arch/arm/boot/zImage] Error 2",
+            "make[1]: Target 'arch/arm/boot/zImage' not remade because of "
+            "errors.",
+            "make: *** [Makefile:150: zImage] Error 2",
+            "make: Target 'zImage' not remade because of errors."]
+        self.assertEqual(commands.make_target_status(output,
+                                                     ["zImage", "modules"]),
+                         {"zImage": "failed", "modules": "ok"})
+
+        # Stopped before saying what it didn't make
+        output = ["make[2]: *** [drivers] Error 2",
+                  "make[1]: *** [drivers] Error 2",
+                  "make: *** [sub-make] Error 2"]
+        self.assertEqual(commands.make_target_status(output, targets),
+                         dict((target, "unknown") for target in targets))
@@ -0,0 +1,86 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import os
+import shutil
+import tempfile
+import unittest
+from utils import *
+from commands import local_files
+from commands.local_files import LocalFiles, MappedFile
+
+
+class TestLocalFiles(unittest.TestCase):
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.root = tempfile.mkdtemp()
+        self.files = LocalFiles(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.local)
+        shutil.rmtree(self.root)
+
+    def make_file(self, name, contents):
+        path = os.path.join(self.local, name)
+        with open(path, "wb") as f:
+            f.write(contents)
+        return path
+
+    def test_sendfile_available(self):
+        self.assertTrue(local_files.sendfile is not None)
+
+    def test_put_get(self):
+        contents = os.urandom(3 * 1024 ** 2 + 5)
+        path = self.make_file("big", contents)
+        os.chmod(path, 0750)
+
+        self.files.put(path, "copy")
+
+        copy = os.path.join(self.root, "copy")
+        with open(copy, "rb") as f:
+            self.assertEqual(f.read(), contents)
+        self.assertEqual(os.stat(copy).st_mode & 0777, 0750)
+        self.assertEqual(int(os.path.getmtime(copy)),
+                         int(os.path.getmtime(path)))
+
+        self.files.get("copy", os.path.join(self.local, "back"))
+        with open(os.path.join(self.local, "back"), "rb") as f:
+            self.assertEqual(f.read(), contents)
+
+    def test_put_unchanged_skipped(self):
+        path = self.make_file("small", "contents")
+        self.files.put(path, "copy")
+        copy = os.path.join(self.root, "copy")
+        with open(copy, "r+b") as f:
+            f.write("CONTENTS")
+        os.utime(copy, (os.path.getatime(path), os.path.getmtime(path)))
+
+        self.files.put(path, "copy")
+        with open(copy) as f:
+            self.assertEqual(f.read(), "CONTENTS")
+
+    def test_open(self):
+        with self.files.open("small", "w") as f:
+            f.write("line 1\nline 2\n")
+        self.assertEqual(list(self.files.open("small")),
+                         ["line 1\n", "line 2\n"])
+
+        lines = ["line %d\n" % index for index in range(200000)]
+        with self.files.open("big", "w") as f:
+            f.writelines(lines)
+        big = self.files.open("big")
+        self.assertTrue(isinstance(big, MappedFile))
+        self.assertEqual(big.readline(), lines[0])
+        self.assertEqual(list(big), lines[1:])
+        big.seek(0)
+        self.assertEqual(big.read(), "".join(lines))
+        big.close()
+
+        self.assertRaises(IOError, self.files.open, "missing")
+
+    def test_write_file(self):
+        slave = RecordSlave()
+        slave.sftp = self.files
+        slave.write_file("written", "contents")
+        self.assertEqual(slave.file_open("written").read(), "contents")
+        self.assertEqual(slave.shell.sent, [])
@@ -0,0 +1,116 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import unittest
+from utils import *
+from commands.checkpoint import step
+from commands.matrix import Matrix, share_state
+
+
+class BoardBuild(commands.LinaroCIJob):
+    """Fetch and toolchain once, then a build per board, then tidy up"""
+    _fail = False
+
+    def __init__(self, board):
+        self.config = {"board": board}
+        self.ran = []
+
+    def setup(self):
+        self.slave = object()
+
+    def setup_variant(self, name):
+        self.results_directory = "base/" + name
+
+    @step(shared=True)
+    def fetch(self):
+        self.ran.append("fetch")
+        self.source = {"path": "base/linux"}
+
+    @step(shared=True)
+    def toolchain(self):
+        self.ran.append("toolchain")
+
+    @step(depends=["fetch", "toolchain"])
+    def build(self):
+        if self._fail:
+            raise commands.CommandFailed("build", "1", [])
+        self.ran.append("build")
+        self.source["built for"] = self.config["board"]
+
+    @step(depends=["build"])
+    def publish(self):
+        self.ran.append("publish")
+
+    @step(depends=["build"], shared=True)
+    def tidy_up(self):
+        self.ran.append("tidy_up")
+
+
+class TestMatrix(unittest.TestCase):
+    def variants(self):
+        return [("panda", BoardBuild("panda")),
+                ("origen", BoardBuild("origen"))]
+
+    def test_split(self):
+        matrix = Matrix(self.variants())
+        self.assertEqual(matrix.before, ["fetch", "toolchain"])
+        self.assertEqual(matrix.unshared, ["build", "publish"])
+        self.assertEqual(matrix.after, ["tidy_up"])
+
+    def test_depends_on_after(self):
+        class AfterTidy(BoardBuild):
+            @step(depends=["tidy_up"])
+            def report(self):
+                pass
+
+        self.assertRaises(ValueError, Matrix,
+                          [("panda", AfterTidy("panda"))])
+        self.assertRaises(ValueError, Matrix,
+                          [("panda", BoardBuild("panda")),
+                           ("report", AfterTidy("report"))])
+
+    def test_share_state(self):
+        source = BoardBuild("panda")
+        source.setup()
+        source.fetch()
+        target = BoardBuild("origen")
+        share_state(source, target)
+
+        self.assertEqual(target.config["board"], "origen")
+        self.assertEqual(target.ran, ["fetch"])
+        # Copied, so the variants can change it separately
+        self.assertEqual(target.source, source.source)
+        self.assertFalse(target.source is source.source)
+        # Can't be copied, so shared
+        self.assertTrue(target.slave is source.slave)
+
+    def test_run(self):
+        variants = self.variants()
+        results = Matrix(variants).run()
+
+        panda, origen = variants[0][1], variants[1][1]
+        self.assertEqual(panda.ran, ["fetch", "toolchain", "build",
+                                     "publish", "tidy_up"])
+        self.assertEqual(origen.ran, ["fetch", "toolchain", "build",
+                                      "publish"])
+        self.assertEqual(origen.source["built for"], "origen")
+        self.assertEqual(panda.source["built for"], "panda")
+        self.assertEqual(origen.results_directory, "base/origen")
+
+        for name in ["panda", "origen"]:
+            self.assertEqual(results[name]["error"], None)
+            self.assertEqual(sorted(results[name]["times"]),
+                             ["build", "publish"])
+
+    def test_failure(self):
+        variants = self.variants()
+        variants[1][1]._fail = True
+        results = Matrix(variants).run()
+
+        self.assertTrue(isinstance(results["origen"]["error"],
+                                   commands.CommandFailed))
+        self.assertEqual(results["panda"]["error"], None)
+        # panda was built and published despite origen failing
+        self.assertEqual(variants[0][1].ran[-3:],
+                         ["build", "publish", "tidy_up"])
+        self.assertFalse("publish" in variants[1][1].ran)
@@ -0,0 +1,240 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import BaseHTTPServer
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+from utils import *
+from commands import publish, remote_fs
+
+
+class UploadHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Stands in for a linaro-license-protection server"""
+    protocol_version = "HTTP/1.1"
+    uploads = []
+    connections = set()
+    fail_once = set()
+    content = set()
+
+    def do_HEAD(self):
+        sha256 = self.path.split("/")[-1]
+        self.send_response(200 if sha256 in self.content else 404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        self.connections.add(self.client_address)
+        body = self.rfile.read(int(self.headers.getheader("Content-Length")))
+        if self.path.startswith("/api/link/"):
+            sha256 = re.search(r"[0-9a-f]{64}", body).group(0)
+            self.uploads.append("link " + self.path[len("/api/link"):])
+            self.send_response(200 if sha256 in self.content else 404)
+        elif self.path in self.fail_once:
+            self.fail_once.remove(self.path)
+            self.send_response(503)
+        else:
+            self.uploads.append(self.path)
+            self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def glob_response(files):
+    """What the slave says about files, a list of (path, size, sha256)"""
+    return "\n".join("ci-stat: f %d 0 644 %s\nci-sha256: %s  %s" %
+                     (size, path, sha256, path)
+                     for path, size, sha256 in files)
+
+
+class TestPublish(unittest.TestCase):
+    def setUp(self):
+        self.slave = RecordSlave()
+        self.server_config = {"hostname": "server", "key": "secret"}
+
+    def test_publish(self):
+        self.slave.set_response("sha256sum", glob_response(
+            [("a.txt", 5, "a" * 64), ("dir/b.tar.gz", 7, "b" * 64)]))
+        self.slave.set_response(
+            "wait\)", "ci-publish: 200 0.5 http://server/to/a.txt\n"
+            "ci-publish: 201 1.5 http://server/to/dir/b.tar.gz")
+
+        manifest = self.slave.publish("base", ["*.txt", "dir/*"], "to",
+                                      self.server_config)
+
+        self.assertTrue(self.slave.shell.sent[0].startswith(
+            "(cd base || exit 1; shopt -s nullglob; set -- *.txt dir/*;"))
+        self.assertEqual(manifest, [
+            {"path": "a.txt", "size": 5, "sha256": "a" * 64,
+             "url": "http://server/to/a.txt", "seconds": 0.5,
+             "linked": False, "saved": 0},
+            {"path": "dir/b.tar.gz", "size": 7, "sha256": "b" * 64,
+             "url": "http://server/to/dir/b.tar.gz", "seconds": 1.5,
+             "linked": False, "saved": 0}])
+
+    def test_publish_dedup(self):
+        self.server_config["dedup"] = True
+        self.slave.set_response("sha256sum", glob_response(
+            [("a.txt", 5, "a" * 64), ("b.txt", 7, "b" * 64),
+             ("c.txt", 9, "c" * 64)]))
+        self.slave.set_response(
+            " -I ", "ci-publish-exists: 200 http://server/api/content/%s\n"
+            "ci-publish-exists: 200 http://server/api/content/%s\n"
+            "ci-publish-exists: 404 http://server/api/content/%s" %
+            ("a" * 64, "b" * 64, "c" * 64))
+        # b.txt's content went between asking and linking
+        self.slave.set_response(
+            "wait\)", "ci-publish: 200 0.1 http://server/api/link/to/a.txt\n"
+            "ci-publish: 404 0.1 http://server/api/link/to/b.txt\n"
+            "ci-publish: 200 0.1 http://server/to/b.txt\n"
+            "ci-publish: 200 0.1 http://server/to/c.txt")
+
+        manifest = self.slave.publish("base", ["*.txt"], "to",
+                                      self.server_config)
+
+        self.assertEqual([(entry["path"], entry["linked"], entry["saved"])
+                          for entry in manifest],
+                         [("a.txt", True, 5), ("b.txt", False, 0),
+                          ("c.txt", False, 0)])
+        upload = self.slave.shell.sent[-1]
+        self.assertTrue("-F file=@b.txt" in upload)
+        self.assertFalse("a.txt" in upload)
+
+    def test_publish_failed(self):
+        self.slave.set_response("sha256sum",
+                                glob_response([("a.txt", 5, "a" * 64)]))
+        self.slave.set_response(
+            "wait\)", "ci-publish: 500 0.5 http://server/to/a.txt")
+        self.assertRaises(commands.CommandFailed, self.slave.publish,
+                          "base", ["*.txt"], "to", self.server_config)
+
+    def test_group_files(self):
+        files = [{"path": str(size), "size": size}
+                 for size in [1, 9, 5, 5, 2]]
+        groups = publish.group_files(files, 2)
+        self.assertEqual([[entry["size"] for entry in group]
+                          for group in groups], [[9, 2], [5, 5, 1]])
+        self.assertEqual(len(publish.group_files(files[:1], 4)), 1)
+
+
+class TestUploadCommand(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        UploadHandler.uploads = []
+        UploadHandler.connections = set()
+        UploadHandler.fail_once = set(["/to/f1"])
+        UploadHandler.content = set()
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0),
+                                                UploadHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.basedir)
+
+    def run_shell(self, cmd):
+        return subprocess.check_output(["bash", "-c", cmd]).splitlines()
+
+    def list_files(self, patterns):
+        return [{"path": stat.path, "size": stat.size,
+                 "sha256": stat.sha256}
+                for stat in remote_fs.parse_stats(self.run_shell(
+                    remote_fs.glob_command(patterns, base_dir=self.basedir,
+                                           sha256=True)))]
+
+    def test_upload(self):
+        for index in range(6):
+            with open(os.path.join(self.basedir, "f%d" % index), "w") as f:
+                f.write("file %d" % index)
+
+        files = self.list_files(["f*", "missing*"])
+        self.assertEqual(sorted(entry["path"] for entry in files),
+                         ["f%d" % index for index in range(6)])
+        self.assertEqual(files[0]["sha256"],
+                         hashlib.sha256("file 0").hexdigest())
+
+        server_config = {"hostname": "127.0.0.1:%d" %
+                         self.server.server_port, "key": "k"}
+        uploads = publish.parse_uploads(self.run_shell(
+            publish.upload_command(self.basedir, files, server_config, "to",
+                                   jobs=2, retries=2)))
+
+        self.assertEqual(sorted(UploadHandler.uploads),
+                         ["/to/f%d" % index for index in range(6)])
+        self.assertEqual(set(status for status, _ in uploads.values()),
+                         set([200]))
+        # Each curl process kept its connection open between uploads
+        self.assertTrue(len(UploadHandler.connections) < 6)
+
+    def test_dedup(self):
+        with open(os.path.join(self.basedir, "old"), "w") as f:
+            f.write("published before")
+        with open(os.path.join(self.basedir, "new"), "w") as f:
+            f.write("new")
+        UploadHandler.content.add(
+            hashlib.sha256("published before").hexdigest())
+
+        files = self.list_files(["*"])
+        server_config = {"hostname": "127.0.0.1:%d" %
+                         self.server.server_port, "key": "k"}
+        existing = publish.parse_exists(self.run_shell(
+            publish.exists_command(files, server_config)))
+        self.assertEqual(existing, UploadHandler.content)
+
+        for entry in files:
+            entry["linked"] = entry["sha256"] in existing
+        self.run_shell(publish.upload_command(self.basedir, files,
+                                              server_config, "to"))
+        self.assertEqual(sorted(UploadHandler.uploads),
+                         ["/to/new", "link /to/old"])
+
+    def test_quoted(self):
+        for name in ["a b", "c#d"]:
+            with open(os.path.join(self.basedir, name), "w") as f:
+                f.write(name)
+
+        files = self.list_files(["*"])
+        server_config = {"hostname": "127.0.0.1:%d" %
+                         self.server.server_port}
+        uploads = publish.parse_uploads(self.run_shell(
+            publish.upload_command(self.basedir, files, server_config,
+                                   "to")))
+        self.assertEqual(sorted(UploadHandler.uploads),
+                         ["/to/a%20b", "/to/c%23d"])
+        self.assertEqual(sorted(uploads),
+                         [publish.upload_url(server_config, "to", name)
+                          for name in ["a b", "c#d"]])
+
+    def test_connection_refused(self):
+        with open(os.path.join(self.basedir, "f"), "w") as f:
+            f.write("f")
+        files = self.list_files(["f"])
+
+        # Nothing listens on the port until after the first attempt
+        self.server.shutdown()
+        self.server.server_close()
+        port = self.server.server_port
+
+        def start():
+            self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", port),
+                                                    UploadHandler)
+            self.server.serve_forever()
+        timer = threading.Timer(0.5, start)
+        timer.daemon = True
+        timer.start()
+
+        server_config = {"hostname": "127.0.0.1:%d" % port}
+        self.run_shell(publish.upload_command(self.basedir, files,
+                                              server_config, "to"))
+        self.assertEqual(UploadHandler.uploads, ["/to/f"])
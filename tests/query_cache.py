@@ -0,0 +1,112 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import shutil
+import tempfile
+import unittest
+from utils import *
+from commands.local_files import LocalFiles
+from commands.query_cache import QueryCache, change_directory
+
+
+class TestQueryCache(unittest.TestCase):
+    def setUp(self):
+        self.slave = RecordSlave()
+        self.slave.set_response("^make kernelversion", "3.10.0")
+
+    def query(self, command="make kernelversion", stable=False):
+        return self.slave.query(command, "test", stable=stable)
+
+    def test_repeated(self):
+        self.assertEqual(self.query(), ["3.10.0"])
+        self.assertEqual(self.query(), ["3.10.0"])
+        self.assertEqual(self.slave.shell.sent, ["make kernelversion"])
+        self.assertEqual(self.slave.query_cache.hits.values(), [1])
+
+    def test_changes_forget(self):
+        self.query()
+        self.slave.cmd("make", "build")
+        self.query()
+        self.slave.mkdir("out")
+        self.query()
+        self.assertEqual(self.slave.shell.sent, [
+            "make kernelversion", "make", "make kernelversion",
+            "mkdir -p out", "make kernelversion"])
+
+    def test_file_transfers_forget(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            self.slave.sftp = LocalFiles(tempdir)
+            self.query()
+            self.slave.write_file("config", "CONFIG_SMP=y\n")
+            self.query()
+            # Reading changes nothing
+            self.slave.file_open("config").close()
+            self.query()
+        finally:
+            shutil.rmtree(tempdir)
+        self.assertEqual(self.slave.shell.sent, ["make kernelversion"] * 2)
+
+    def test_directory(self):
+        self.slave.chdir("/src/linux")
+        self.query()
+        self.slave.chdir("/src/other")
+        self.query()
+        # Changing directory changes nothing, so this is still known
+        self.slave.chdir("/src/linux")
+        self.query()
+        self.assertEqual([sent for sent in self.slave.shell.sent
+                          if sent.startswith("make")],
+                         ["make kernelversion"] * 2)
+
+        self.assertEqual(change_directory("/src", "linux"), "/src/linux")
+        self.assertEqual(change_directory("/src", "~/linux"), "~/linux")
+        self.assertEqual(change_directory("/src/linux", ".."),
+                         "/src/linux/..")
+
+    def test_directory_changed_by_command(self):
+        self.slave.chdir("/src/linux")
+        self.slave.cmd("cd /src/other", "somewhere else")
+        self.query()
+        # Isn't where the last answer came from
+        self.slave.chdir("/src/linux")
+        self.query()
+        self.assertEqual([sent for sent in self.slave.shell.sent
+                          if sent.startswith("make")],
+                         ["make kernelversion"] * 2)
+
+    def test_query_while_changing(self):
+        # Another session on the machine queries while make runs
+        other = RecordSlave()
+        other.query_cache = self.slave.query_cache
+        other.set_response("^make kernelversion", "3.10.0")
+        recv = self.slave.shell.recv
+
+        def make_running(size=1000):
+            if self.slave.shell.last_sent == "make\n":
+                other.query("make kernelversion", "test")
+            return recv(size)
+        self.slave.shell.recv = make_running
+        self.slave.cmd("make", "build")
+
+        other.query("make kernelversion", "test")
+        self.assertEqual(other.shell.sent, ["make kernelversion"] * 2)
+
+    def test_stable(self):
+        self.slave.chdir("/src/linux")
+        self.query(stable=True)
+        self.slave.cmd("make", "build")
+        # make could have left the shell anywhere
+        self.slave.chdir("/src/linux")
+        self.query(stable=True)
+        self.assertEqual(self.slave.shell.sent, [
+            "cd /src/linux", "make kernelversion", "make", "cd /src/linux"])
+
+    def test_changed_during_query(self):
+        cache = QueryCache()
+        generation, output = cache.get("key")
+        self.assertEqual(output, None)
+        # Another session changed the slave while the query ran
+        cache.changed()
+        cache.put("key", generation, ["old"])
+        self.assertEqual(cache.get("key"), (1, None))
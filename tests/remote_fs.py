@@ -0,0 +1,63 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from utils import *
+from commands import remote_fs
+
+
+class TestQuery(unittest.TestCase):
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.basedir, "dir"))
+        for path in ["a.gz", "b.gz", "dir/c", "with space"]:
+            with open(os.path.join(self.basedir, path), "w") as f:
+                f.write(path)
+        os.chmod(os.path.join(self.basedir, "b.gz"), 0755)
+        os.symlink("a.gz", os.path.join(self.basedir, "link"))
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def run_query(self, cmd):
+        return remote_fs.parse_stats(subprocess.check_output(
+            ["bash", "-c", cmd]).splitlines())
+
+    def test_glob(self):
+        stats = self.run_query(remote_fs.glob_command(
+            ["*.gz", "dir", "missing*"], base_dir=self.basedir))
+
+        self.assertEqual([(stat.path, stat.type) for stat in stats],
+                         [("a.gz", "file"), ("b.gz", "file"),
+                          ("dir", "directory")])
+        self.assertEqual(stats[1].size, 4)
+        self.assertEqual(stats[1].mode, 0755)
+        self.assertEqual(int(stats[0].mtime), int(os.path.getmtime(
+            os.path.join(self.basedir, "a.gz"))))
+        self.assertEqual(stats[0].sha256, None)
+
+    def test_stat(self):
+        stats = self.run_query(remote_fs.stat_command(
+            ["with space", "link", "dir", "missing", "*.gz"],
+            base_dir=self.basedir, sha256=True, recursive=True))
+
+        self.assertEqual([(stat.path, stat.type, stat.sha256)
+                          for stat in stats],
+                         [("dir", "directory", None),
+                          ("dir/c", "file",
+                           hashlib.sha256("dir/c").hexdigest()),
+                          ("link", "file", hashlib.sha256("a.gz").hexdigest()),
+                          ("with space", "file",
+                           hashlib.sha256("with space").hexdigest())])
+
+    def test_no_matches(self):
+        self.assertEqual(self.run_query(remote_fs.glob_command(
+            ["missing*"], base_dir=self.basedir, sha256=True)), [])
+        self.assertRaises(subprocess.CalledProcessError, self.run_query,
+                          remote_fs.glob_command(
+                              ["*"], base_dir=self.basedir + "/missing"))
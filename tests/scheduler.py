@@ -0,0 +1,145 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from utils import *
+from commands.scheduler import ScheduledJob, Scheduler, Trigger, discover
+
+
+class BlockingScheduler(Scheduler):
+    """Scheduler whose runs last until the test finishes them"""
+    def __init__(self, *args, **kwargs):
+        super(BlockingScheduler, self).__init__(*args, **kwargs)
+        self.started = []
+        self.finish = {}
+
+    def execute(self, run):
+        finish = threading.Event()
+        with self.condition:
+            self.finish[run.job.job_name] = finish
+            self.started.append(run.job.job_name)
+        finish.wait(5)
+        return 0
+
+    def wait_for_starts(self, count):
+        for _ in range(500):
+            with self.condition:
+                if len(self.started) >= count:
+                    return list(self.started)
+            time.sleep(0.01)
+        return list(self.started)
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.merge_requests = os.path.join(self.tempdir, "merge-requests")
+        os.mkdir(self.merge_requests)
+        self.test_job_path = os.path.join(os.path.dirname(__file__),
+                                          "test_jobs")
+        sys.path.append(self.test_job_path)
+
+    def tearDown(self):
+        sys.path.remove(self.test_job_path)
+        shutil.rmtree(self.tempdir)
+
+    def scheduler(self, jobs, cls=Scheduler, **kwargs):
+        return cls(jobs, merge_request_dir=self.merge_requests,
+                   log_dir=os.path.join(self.tempdir, "logs"), **kwargs)
+
+    def test_trigger(self):
+        trigger = Trigger("daily 22:00")
+        self.assertEqual(trigger.next_time(datetime.datetime(2013, 5, 1, 9)),
+                         datetime.datetime(2013, 5, 1, 22))
+        self.assertEqual(trigger.next_time(datetime.datetime(2013, 5, 1, 22)),
+                         datetime.datetime(2013, 5, 2, 22))
+        self.assertEqual(Trigger("on merge request").kind, "merge request")
+        self.assertRaises(ValueError, Trigger, "daily 25:00")
+        self.assertRaises(ValueError, Trigger, "hourly")
+
+    def test_discover(self):
+        jobs = discover(["CIJob"], {"NightlyJob": ["slave1"]})
+        self.assertEqual([job.job_name for job in jobs], ["NightlyJob"])
+        self.assertEqual(jobs[0].priority, 5)
+        self.assertEqual(jobs[0].slave, "slave1")
+        self.assertEqual(jobs[0].command()[-3:],
+                         ["CIJob", "NightlyJob", "slave1"])
+
+        jobs = discover(["CIJob"], {"NightlyJob": ["slave1"]},
+                        {"NightlyJob": 1})
+        self.assertEqual(jobs[0].priority, 1)
+
+        # Without parameters NightlyJob can't be configured
+        self.assertEqual(discover(["CIJob"]), [])
+
+    def test_daily(self):
+        job = ScheduledJob("CIJob", "NightlyJob", triggers=["daily 22:00"])
+        scheduler = self.scheduler([job])
+        trigger = job.triggers[0]
+        job.next_times[trigger] = datetime.datetime(2013, 5, 1, 22)
+
+        scheduler.tick(datetime.datetime(2013, 5, 1, 21, 59))
+        self.assertEqual(scheduler.queue, [])
+        scheduler.tick(datetime.datetime(2013, 5, 1, 22, 0, 30))
+        self.assertEqual(len(scheduler.queue), 1)
+        self.assertEqual(job.next_times[trigger],
+                         datetime.datetime(2013, 5, 2, 22))
+
+        # Still waiting from the last trigger, so not queued twice
+        self.assertEqual(scheduler.enqueue(job, "again"), None)
+        self.assertEqual(len(scheduler.queue), 1)
+
+    def test_merge_request(self):
+        job = ScheduledJob("CIJob", "NightlyJob",
+                           triggers=["on merge request"])
+        other = ScheduledJob("CIJob", "OtherJob", triggers=["daily 1:00"])
+        scheduler = self.scheduler([job, other])
+        for name, contents in [("1", "NightlyJob\n"), ("2", "OtherJob"),
+                               ("3", "Missing")]:
+            with open(os.path.join(self.merge_requests, name), "w") as f:
+                f.write(contents)
+
+        scheduler.tick()
+        self.assertEqual([run.job for _, _, run in scheduler.queue], [job])
+        self.assertEqual(scheduler.queue[0][2].reason, "merge request 1")
+        self.assertEqual(os.listdir(self.merge_requests), [])
+
+    def test_limits_and_priority(self):
+        jobs = [ScheduledJob("CIJob", "a", slave="s1"),
+                ScheduledJob("CIJob", "b", slave="s1"),
+                ScheduledJob("CIJob", "c", slave="s2"),
+                ScheduledJob("CIJob", "urgent", slave="s3", priority=9)]
+        scheduler = self.scheduler(jobs, BlockingScheduler, workers=2)
+        for job in jobs:
+            scheduler.enqueue(job, "test")
+
+        scheduler.start()
+        try:
+            # Started by two workers at once, so in either order
+            self.assertEqual(sorted(scheduler.wait_for_starts(2)),
+                             ["a", "urgent"])
+
+            # b waits for s1 even though c was queued after it
+            scheduler.finish["urgent"].set()
+            self.assertEqual(scheduler.wait_for_starts(3)[2], "c")
+            scheduler.finish["a"].set()
+            self.assertEqual(scheduler.wait_for_starts(4)[3], "b")
+            scheduler.finish["b"].set()
+            scheduler.finish["c"].set()
+        finally:
+            scheduler.stop()
+
+        metrics = scheduler.metrics()
+        self.assertEqual(metrics["a"]["runs"], 1)
+        self.assertEqual(metrics["a"]["failures"], 0)
+        self.assertTrue(metrics["b"]["max wait"] >= metrics["a"]["max wait"])
+        self.assertEqual(metrics["queue"]["waiting"], 0)
+        with open(os.path.join(self.tempdir, "logs", "runs.json")) as f:
+            self.assertEqual(len(f.readlines()), 4)
@@ -0,0 +1,200 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+"""An SSH server, run in a thread, serving SFTP from a local directory.
+
+Stands in for a slave when testing file transfers. Commands run with
+exec_command are run locally in the root directory.
+"""
+
+import logging
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+
+import paramiko
+
+HOST_KEY = None
+
+# Clients hanging up at the end of a test isn't an error
+logging.getLogger("paramiko").setLevel(logging.CRITICAL)
+
+
+class Server(paramiko.ServerInterface):
+    def __init__(self, root):
+        self.root = root
+
+    def check_auth_none(self, username):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return "none"
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        def feed(process):
+            data = channel.recv(65536)
+            while data:
+                process.stdin.write(data)
+                data = channel.recv(65536)
+            process.stdin.close()
+
+        def run():
+            stderr = tempfile.TemporaryFile()
+            process = subprocess.Popen(command, shell=True, cwd=self.root,
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       stderr=stderr)
+            stdin_thread = threading.Thread(target=feed, args=[process])
+            stdin_thread.daemon = True
+            stdin_thread.start()
+            for data in iter(lambda: process.stdout.read(65536), ""):
+                channel.sendall(data)
+            process.wait()
+            stderr.seek(0)
+            channel.sendall_stderr(stderr.read())
+            channel.send_exit_status(process.returncode)
+            channel.close()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return True
+
+
+class SFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(
+                os.fstat(self.readfile.fileno()))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            paramiko.SFTPServer.set_file_attr(self.filename, attr)
+            return paramiko.SFTP_OK
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+
+class SFTPServer(paramiko.SFTPServerInterface):
+    """SFTP access to the directory Server was given"""
+    def __init__(self, server, *args, **kwargs):
+        super(SFTPServer, self).__init__(server, *args, **kwargs)
+        self.root = server.root
+
+    def _path(self, path):
+        return os.path.join(self.root, self.canonicalize(path).lstrip("/"))
+
+    def _errno(self, function, *args):
+        try:
+            function(*args)
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def stat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def list_folder(self, path):
+        path = self._path(path)
+        try:
+            return [paramiko.SFTPAttributes.from_stat(
+                os.lstat(os.path.join(path, name)), name)
+                for name in os.listdir(path)]
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        try:
+            fd = os.open(path, flags | getattr(os, "O_BINARY", 0), 0666)
+        except OSError, e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_CREAT and attr is not None:
+            attr._flags &= ~attr.FLAG_PERMISSIONS
+            paramiko.SFTPServer.set_file_attr(path, attr)
+
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        handle = SFTPHandle(flags)
+        handle.filename = path
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    def remove(self, path):
+        return self._errno(os.remove, self._path(path))
+
+    def rename(self, old_path, new_path):
+        return self._errno(os.rename, self._path(old_path),
+                           self._path(new_path))
+
+    posix_rename = rename
+
+    def mkdir(self, path, attr):
+        return self._errno(os.mkdir, self._path(path))
+
+    def rmdir(self, path):
+        return self._errno(os.rmdir, self._path(path))
+
+    def chattr(self, path, attr):
+        return self._errno(paramiko.SFTPServer.set_file_attr,
+                           self._path(path), attr)
+
+
+class LocalSSHServer(object):
+    """Accept SSH connections on a local port until stop() is called"""
+    def __init__(self, root):
+        global HOST_KEY
+        if HOST_KEY is None:
+            HOST_KEY = paramiko.RSAKey.generate(1024)
+
+        self.root = root
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("127.0.0.1", 0))
+        self.socket.listen(5)
+        self.port = self.socket.getsockname()[1]
+        self.transports = []
+        self.thread = threading.Thread(target=self._accept)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                connection, _ = self.socket.accept()
+            except socket.error:
+                return
+            transport = paramiko.Transport(connection)
+            transport.add_server_key(HOST_KEY)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer,
+                                            SFTPServer)
+            transport.start_server(server=Server(self.root))
+            self.transports.append(transport)
+
+    def connect(self):
+        """Return a client transport connected to the server"""
+        transport = paramiko.Transport(("127.0.0.1", self.port))
+        transport.connect()
+        transport.auth_none("ci")
+        return transport
+
+    def stop(self):
+        self.socket.close()
+        for transport in self.transports:
+            transport.close()
@@ -0,0 +1,102 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from utils import *
+from commands.slave_pool import (NoSlaveAvailable, Requirements, SlavePool,
+                                 parse_size)
+
+REPO = "git://android.git.linaro.org/platform/manifest.git"
+
+
+class TestSlavePool(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.inventory = os.path.join(self.tempdir, "slaves.json")
+        self.write_inventory([
+            {"hostname": "a", "username": "ci", "machine type": "x86_64",
+             "memory": "16GB", "cpus": 8, "max leases": 2},
+            {"hostname": "b", "username": "ci", "machine type": "x86_64",
+             "memory": "8GB", "cpus": 8, "max leases": 2},
+            {"hostname": "arm", "machine type": "armv7l", "memory": "1GB",
+             "cpus": 2},
+        ])
+        self.pool = SlavePool(self.inventory,
+                              os.path.join(self.tempdir, "state.json"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write_inventory(self, hosts):
+        with open(self.inventory, "w") as f:
+            json.dump({"hosts": hosts}, f)
+
+    def test_requirements(self):
+        self.assertEqual(parse_size("8GB"), 8192)
+        self.assertEqual(parse_size("512mb"), 512)
+        self.assertEqual(parse_size(2), 2048)
+        self.assertRaises(ValueError, parse_size, "lots")
+
+        requirements = Requirements(["machine type x86_64", "memory 8GB",
+                                     "cpus 4", "OS Ubuntu 12.04",
+                                     "repo " + REPO])
+        self.assertEqual(requirements.repos, [REPO])
+        host = {"machine type": "x86_64", "memory": "8GB", "cpus": 4,
+                "os": "ubuntu 12.04"}
+        self.assertTrue(requirements.met_by(host))
+        for key, value in [("memory", "4GB"), ("cpus", 2),
+                           ("machine type", "armv7l")]:
+            self.assertFalse(requirements.met_by(dict(host, **{key: value})))
+        del host["os"]
+        self.assertFalse(requirements.met_by(host))
+
+        self.assertRaises(ValueError, Requirements, ["colour blue"])
+
+    def test_lease(self):
+        lease = self.pool.lease(["memory 12GB"])
+        self.assertEqual((lease.hostname, lease.username), ("a", "ci"))
+        self.assertTrue(lease.expires > time.time())
+        self.assertEqual(self.pool.load(), {"a": 1, "b": 0, "arm": 0})
+
+        # Only a has enough memory, and it takes two leases
+        self.pool.lease(["memory 12GB"])
+        self.assertRaises(NoSlaveAvailable, self.pool.lease, ["memory 12GB"],
+                          wait=0)
+        lease.release()
+        self.assertEqual(self.pool.lease(["memory 12GB"]).hostname, "a")
+
+        # No host could ever meet these
+        self.assertRaises(NoSlaveAvailable, self.pool.lease, ["cpus 64"])
+
+    def test_balance_on_load(self):
+        hosts = [self.pool.lease(["machine type x86_64", "cpus 4"]).hostname
+                 for _ in range(2)]
+        self.assertEqual(sorted(hosts), ["a", "b"])
+
+    def test_prefer_warm(self):
+        lease = self.pool.lease(["machine type x86_64"])
+        self.pool.lease(["machine type x86_64"]).release([REPO])
+
+        # b is now the more loaded host, but has the repo
+        self.assertEqual(lease.hostname, "a")
+        self.assertEqual(self.pool.lease(["machine type x86_64",
+                                          "repo " + REPO]).hostname, "b")
+
+    def test_expiry(self):
+        self.pool.ttl = 0.05
+        lease = self.pool.lease(["machine type armv7l"])
+        self.assertRaises(NoSlaveAvailable, self.pool.lease,
+                          ["machine type armv7l"], wait=0)
+        time.sleep(0.1)
+        self.assertEqual(self.pool.load()["arm"], 0)
+
+        self.pool.ttl = 60
+        lease.renew()
+        self.assertEqual(self.pool.load()["arm"], 1)
+        lease.release()
+        self.assertEqual(self.pool.load()["arm"], 0)
@@ -0,0 +1,157 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from utils import *
+from commands.checkpoint import Checkpoint, step
+from commands.steps import SlaveSessions, StepGraph
+
+
+class GraphJob(commands.LinaroCIJob):
+    """checkout and fetch run together, then build, then publish"""
+    _fail = None
+
+    def __init__(self):
+        self.ran = []
+        self.fetching = threading.Event()
+
+    def _run(self, name):
+        if name == self._fail:
+            raise commands.CommandFailed(name, "1", [])
+        self.ran.append(name)
+
+    @step
+    def prepare(self):
+        self._run("prepare")
+
+    @step(depends=["prepare"])
+    def checkout(self):
+        # Only finishes if fetch is running at the same time
+        self.overlapped = self.fetching.wait(5)
+        self._run("checkout")
+
+    @step(depends=["prepare"])
+    def fetch(self):
+        self.fetching.set()
+        self._run("fetch")
+
+    @step(depends=["checkout", "fetch"])
+    def build(self):
+        self._run("build")
+
+    @step(depends=["build"])
+    def publish(self):
+        self._run("publish")
+
+
+class SessionSlave(object):
+    def __init__(self, name="ci-runtime"):
+        self.name = name
+
+    def new_session(self, name):
+        return SessionSlave(name)
+
+
+class TestStepGraph(unittest.TestCase):
+    def test_order(self):
+        graph = StepGraph(GraphJob())
+        self.assertEqual(graph.depends["build"], ["checkout", "fetch"])
+        self.assertEqual(graph.order(), ["prepare", "checkout", "fetch",
+                                         "build", "publish"])
+        self.assertEqual(graph.order(["fetch"]), ["prepare", "fetch"])
+        self.assertRaises(ValueError, graph.order, ["missing"])
+
+    def test_bad_depends(self):
+        class Loop(commands.LinaroCIJob):
+            @step(depends=["second"])
+            def first(self):
+                pass
+
+            @step(depends=["first"])
+            def second(self):
+                pass
+
+        class Unknown(commands.LinaroCIJob):
+            @step(depends=["missing"])
+            def first(self):
+                pass
+
+        self.assertRaises(ValueError, StepGraph, Loop())
+        self.assertRaises(ValueError, StepGraph, Unknown())
+
+    def test_run(self):
+        job = GraphJob()
+        times = job.run_steps()
+
+        self.assertTrue(job.overlapped)
+        self.assertEqual(sorted(job.ran), sorted(times))
+        self.assertEqual(job.ran[0], "prepare")
+        self.assertEqual(job.ran[-2:], ["build", "publish"])
+        graph = StepGraph(job)
+        for name, depends in graph.depends.items():
+            for depend in depends:
+                self.assertTrue(times[depend][1] <= times[name][0])
+
+        path = graph.critical_path(times)
+        self.assertEqual(path[0], "prepare")
+        self.assertEqual(path[-2:], ["build", "publish"])
+        # checkout waited for fetch, so took longer
+        self.assertEqual(path[1], "checkout")
+
+    def test_targets(self):
+        job = GraphJob()
+        job.fetching.set()
+        self.assertEqual(sorted(job.run_steps(["checkout"])),
+                         ["checkout", "prepare"])
+
+    def test_failure(self):
+        job = GraphJob()
+        job._fail = "fetch"
+        self.assertRaises(commands.CommandFailed, job.run_steps)
+        self.assertFalse("build" in job.ran)
+        self.assertFalse("publish" in job.ran)
+
+    def test_resume(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, "job.json")
+            job = GraphJob()
+            job._fail = "build"
+            job._checkpoint = Checkpoint(path, "key")
+            self.assertRaises(commands.CommandFailed, job.run_steps)
+
+            job = GraphJob()
+            job._checkpoint = Checkpoint(path, "key", resume=True)
+            job.run_steps()
+            # ran was restored from the checkpoint, with nothing run twice
+            self.assertEqual(sorted(job.ran[:3]),
+                             ["checkout", "fetch", "prepare"])
+            self.assertEqual(job.ran[3:], ["build", "publish"])
+        finally:
+            shutil.rmtree(tempdir)
+
+
+class TestSlaveSessions(unittest.TestCase):
+    def test_session_per_thread(self):
+        slave = SessionSlave()
+        sessions = SlaveSessions(slave)
+        self.assertEqual(sessions.name, "ci-runtime")
+
+        names = []
+
+        def use():
+            names.append(sessions.name)
+            sessions.release()
+
+        for _ in range(2):
+            thread = threading.Thread(target=use)
+            thread.start()
+            thread.join()
+
+        # The second thread reused the session the first gave back
+        self.assertEqual(names, ["ci-runtime-1", "ci-runtime-1"])
+        self.assertEqual(sessions.name, "ci-runtime")
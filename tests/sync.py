@@ -0,0 +1,234 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import os
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import unittest
+from StringIO import StringIO
+from utils import *
+from commands.sync import delta, patch, signature, DirectorySync
+from commands.local_files import LocalFiles
+from commands.transfer import TransferEngine
+from sftp_server import LocalSSHServer
+
+
+class TestDelta(unittest.TestCase):
+    def roundtrip(self, old, new):
+        delta_data = delta(StringIO(new), signature(StringIO(old)))
+        out = StringIO()
+        patch(StringIO(old), StringIO(delta_data), out)
+        self.assertEqual(out.getvalue(), new)
+        return delta_data
+
+    def test_roundtrip(self):
+        old = os.urandom(100000)
+        new = old[:5000] + "inserted" + old[5000:60000] + old[61000:]
+        delta_data = self.roundtrip(old, new)
+        # Only the changes and a few blocks around them are sent
+        self.assertTrue(len(delta_data) < 10000)
+
+        self.roundtrip(old, "")
+        self.roundtrip("", new)
+        self.roundtrip(old, old + "tail")
+
+    def test_bigger_than_a_read(self):
+        old = os.urandom(3 * 1024 ** 2)
+        # Changes either side of where delta reads and forgets data
+        new = (old[:1024 ** 2 - 10] + "x" * 20 + old[1024 ** 2 + 10:-5000] +
+               os.urandom(4000))
+        delta_data = self.roundtrip(old, new)
+        self.assertTrue(len(delta_data) < 20000)
+
+    def test_give_up(self):
+        old = os.urandom(100000)
+        self.assertEqual(delta(StringIO(os.urandom(100000)),
+                               signature(StringIO(old)), 50000), None)
+        # Once a block has matched, it carries on
+        new = os.urandom(10000) + old[:60000] + os.urandom(60000)
+        delta_data = delta(StringIO(new), signature(StringIO(old)), 50000)
+        out = StringIO()
+        patch(StringIO(old), StringIO(delta_data), out)
+        self.assertEqual(out.getvalue(), new)
+
+
+class TestSyncDir(unittest.TestCase):
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.remote = tempfile.mkdtemp()
+        self.server = LocalSSHServer(self.remote)
+        self.transport = self.server.connect()
+        self.sync = DirectorySync(TransferEngine(self.transport))
+        random.seed(0)
+
+    def tearDown(self):
+        self.sync.engine.close()
+        self.transport.close()
+        self.server.stop()
+        shutil.rmtree(self.local)
+        shutil.rmtree(self.remote)
+
+    def write(self, root, path, content):
+        path = os.path.join(root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "wb") as f:
+            f.write(content)
+
+    def read(self, root, path):
+        with open(os.path.join(root, path), "rb") as f:
+            return f.read()
+
+    def test_push(self):
+        big = os.urandom(200000)
+        self.write(self.local, "big", big)
+        self.write(self.local, "dir/small", "small")
+        self.write(self.local, "build/object.o", "excluded")
+        os.symlink("big", os.path.join(self.local, "link"))
+        self.write(self.remote, "tree/stale", "stale")
+
+        result = self.sync.sync(self.local, "tree", delete=True,
+                                exclude=["build"])
+        self.assertEqual((result.whole, result.delta, result.deleted),
+                         (2, 0, 1))
+        tree = os.path.join(self.remote, "tree")
+        self.assertEqual(sorted(os.listdir(tree)), ["big", "dir", "link"])
+        self.assertEqual(os.readlink(os.path.join(tree, "link")), "big")
+        self.assertEqual(self.read(tree, "dir/small"), "small")
+
+        # Unchanged files are skipped, changed ones sent as a delta
+        self.write(self.local, "big", big[:1000] + "change" + big[1000:])
+        result = self.sync.sync(self.local, "tree")
+        self.assertEqual((result.unchanged, result.delta), (1, 1))
+        self.assertTrue(result.sent < 20000)
+        self.assertEqual(self.read(tree, "big"), self.read(self.local, "big"))
+
+    def test_rewritten(self):
+        self.write(self.local, "big", os.urandom(200000))
+        self.sync.sync(self.local, "tree")
+        # Nothing in common with the old copy, so it is sent whole
+        self.write(self.local, "big", os.urandom(200000))
+        os.utime(os.path.join(self.local, "big"), (1, 1))
+        result = self.sync.sync(self.local, "tree")
+        self.assertEqual((result.whole, result.delta), (1, 0))
+        self.assertEqual(self.read(os.path.join(self.remote, "tree"), "big"),
+                         self.read(self.local, "big"))
+
+    def test_pull(self):
+        big = os.urandom(200000)
+        self.write(self.remote, "tree/big", big)
+        self.write(self.remote, "tree/dir/small", "small")
+        self.sync.sync(self.local, "tree", direction="pull")
+        self.assertEqual(self.read(self.local, "big"), big)
+
+        self.write(self.remote, "tree/big", big + "more")
+        os.utime(os.path.join(self.remote, "tree/big"), (1, 1))
+        result = self.sync.sync(self.local, "tree", direction="pull")
+        self.assertEqual(result.delta, 1)
+        self.assertEqual(self.read(self.local, "big"), big + "more")
+        self.assertEqual(self.read(self.local, "dir/small"), "small")
+
+
+class TestLocalSyncDir(TestSyncDir):
+    """The same, with a slave that is this machine"""
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.remote = tempfile.mkdtemp()
+        self.slave = RecordSlave()
+        self.slave.sftp = LocalFiles(self.remote)
+        # Tests call self.sync.sync
+        self.sync = self.slave
+        self.slave.sync = self.slave.sync_dir
+        random.seed(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.local)
+        shutil.rmtree(self.remote)
+
+
+class RunShell(RecordShell):
+    """RecordShell that runs what it is sent, with HOME set to home"""
+    def __init__(self, prompt, home):
+        super(RunShell, self).__init__(prompt)
+        self.home = home
+        self.output = ""
+        self.status = 0
+
+    def send(self, value):
+        super(RunShell, self).send(value)
+        if not re.search("echo \$\?", value):
+            env = dict(os.environ, HOME=self.home)
+            process = subprocess.Popen(["bash", "-c", value], env=env,
+                                       cwd=self.home,
+                                       stdout=subprocess.PIPE)
+            self.output = process.communicate()[0]
+            self.status = process.returncode
+
+    def recv(self, size=1000):
+        if re.search("echo \$\?", self.last_sent):
+            return "%s%d\n%s" % (self.last_sent, self.status, self.prompt)
+        return self.last_sent + self.output + self.prompt
+
+
+class SlaveFiles(object):
+    """Copies files like SFTP does, but isn't LocalFiles"""
+    def __init__(self, root):
+        self.files = LocalFiles(root)
+
+    def put(self, local_path, remote_path):
+        self.files.put(local_path, remote_path)
+
+    def get(self, remote_path, local_path):
+        self.files.get(remote_path, local_path)
+
+
+class TestSlaveSyncDir(TestSyncDir):
+    """With a slave that can only run commands and copy whole files"""
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.remote = tempfile.mkdtemp()
+        self.slave = RecordSlave()
+        self.slave.shell = RunShell(self.slave.prompt, self.remote)
+        self.slave.sftp = SlaveFiles(self.remote)
+        self.sync = self.slave
+        self.slave.sync = self.slave.sync_dir
+
+    def tearDown(self):
+        shutil.rmtree(self.local)
+        shutil.rmtree(self.remote)
+
+    def test_push(self):
+        self.write(self.local, "big", os.urandom(200000))
+        self.write(self.local, "dir/small", "small")
+        self.write(self.local, "build/object.o", "excluded")
+        os.symlink("big", os.path.join(self.local, "link"))
+        self.write(self.remote, "tree/stale", "stale")
+
+        result = self.slave.sync_dir(self.local, "tree", delete=True,
+                                     exclude=["build"])
+        self.assertEqual((result.whole, result.delta, result.deleted),
+                         (2, 0, 1))
+        tree = os.path.join(self.remote, "tree")
+        self.assertEqual(sorted(os.listdir(tree)), ["big", "dir", "link"])
+        self.assertEqual(os.readlink(os.path.join(tree, "link")), "big")
+        self.assertEqual(self.read(tree, "big"), self.read(self.local, "big"))
+
+        # The mtime was kept, so nothing is sent again
+        self.write(self.local, "dir/small", "changed")
+        os.utime(os.path.join(self.local, "dir/small"), (1, 1))
+        result = self.slave.sync_dir(self.local, "tree", exclude=["build"])
+        self.assertEqual((result.unchanged, result.whole), (1, 1))
+        self.assertEqual(self.read(tree, "dir/small"), "changed")
+
+    def test_pull(self):
+        self.write(self.remote, "tree/big", "big")
+        self.write(self.remote, "tree/dir/small", "small")
+        result = self.slave.sync_dir(self.local, "tree", direction="pull")
+        self.assertEqual(result.whole, 2)
+        self.assertEqual(self.read(self.local, "dir/small"), "small")
+
+        result = self.slave.sync_dir(self.local, "tree", direction="pull")
+        self.assertEqual((result.unchanged, result.whole), (2, 0))
@@ -28,3 +28,91 @@ class DefaultJob(LinaroCIJob):
 
 class SomeJob(DefaultJob):
     pass
+
+
+class LazyJob(DefaultJob):
+    def configure(self, parameters):
+        super(LazyJob, self).configure(parameters)
+        self.lookups = 0
+        self.config = ConfigDict({"env": {"image": LazyValue(self.lookup)}})
+
+    def lookup(self):
+        self.lookups += 1
+        return "image.tar.gz"
+
+    def use_config(self):
+        self.image = "{image}".format(**self.config["env"])
+
+
+class StepJob(DefaultJob):
+    fail = False
+    calls = []
+
+    def configure(self, parameters):
+        super(StepJob, self).configure(parameters)
+        self.config = ConfigDict({"env": {"image": LazyValue(lambda: "x")}})
+
+    @step
+    def first(self):
+        self.calls.append("first")
+        self.source = Checkout("git", "url", revisions={".": "abc"})
+        self.config["path"] = "built"
+
+    @step
+    def second(self):
+        self.calls.append("second")
+        if self.fail:
+            raise CommandFailed("second", "1", [])
+
+    def run(self):
+        self.first()
+        self.second()
+
+
+class OutputJob(DefaultJob):
+    def run(self):
+        logging.info("logged")
+        print "printed"
+        if "--fail" in self.parameters:
+            sys.exit(3)
+
+
+class NightlyJob(DefaultJob):
+    priority = 5
+
+    def configure(self, parameters):
+        super(NightlyJob, self).configure(parameters)
+        self.set_triggers(["daily 22:00", "on merge request"])
+        self.config = {"target machine": {"reserved": {
+            "hostname": parameters[0]}}}
+
+
+class BoardJob(DefaultJob):
+    """Build for a board, run with --matrix over BoardJob_* jobs"""
+    calls = []
+
+    def setup_variant(self, name):
+        self.variant = name
+
+    @step(shared=True)
+    def checkout(self):
+        self.calls.append("checkout")
+
+    @step(depends=["checkout"])
+    def build(self):
+        self.calls.append("build " + self.variant)
+
+    @step(depends=["build"], shared=True)
+    def tidy_up(self):
+        self.calls.append("tidy_up")
+
+    def run(self):
+        self.run_steps()
+
+
+class BoardJob_panda(BoardJob):
+    pass
+
+
+class BoardJob_origen(BoardJob):
+    pass
@@ -0,0 +1,85 @@
+# Copyright 2013 Linaro Ltd.  This software is licensed under the
+# GNU General Public License version 3 (see the file COPYING).
+
+import os
+import shutil
+import tempfile
+import unittest
+from utils import *
+from commands.transfer import TransferEngine
+from sftp_server import LocalSSHServer
+
+
+class TestTransferEngine(unittest.TestCase):
+    def setUp(self):
+        self.local = tempfile.mkdtemp()
+        self.remote = tempfile.mkdtemp()
+        self.server = LocalSSHServer(self.remote)
+        self.transport = self.server.connect()
+        self.engine = TransferEngine(self.transport, split_size=100000)
+
+    def tearDown(self):
+        self.engine.close()
+        self.transport.close()
+        self.server.stop()
+        shutil.rmtree(self.local)
+        shutil.rmtree(self.remote)
+
+    def make_file(self, name, size):
+        path = os.path.join(self.local, name)
+        with open(path, "wb") as f:
+            f.write(os.urandom(size))
+        return path
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def test_put_and_get_split(self):
+        local_path = self.make_file("big", 300001)
+        self.engine.put(local_path, "big")
+        self.assertEqual(self.read(os.path.join(self.remote, "big")),
+                         self.read(local_path))
+        self.assertEqual(self.engine.transfers[-1].channels, 4)
+
+        self.engine.get("big", os.path.join(self.local, "big.copy"))
+        self.assertEqual(self.read(os.path.join(self.local, "big.copy")),
+                         self.read(local_path))
+        self.assertFalse([name for name in os.listdir(self.remote)
+                          if name.endswith(".ci-part")])
+
+    def test_skip_unchanged(self):
+        local_path = self.make_file("small", 10)
+        self.engine.put(local_path, "small")
+        self.engine.put(local_path, "small")
+        self.assertEqual([transfer.skipped
+                          for transfer in self.engine.transfers],
+                         [False, True])
+
+        with open(local_path, "wb") as f:
+            f.write("0123456789")
+        os.utime(local_path, (1, 1))
+        self.engine.put(local_path, "small")
+        self.assertFalse(self.engine.transfers[-1].skipped)
+
+    def test_skip_unchanged_checksum(self):
+        self.engine.check = "checksum"
+        local_path = self.make_file("small", 10)
+        self.engine.put(local_path, "small")
+        os.utime(local_path, (1, 1))
+        self.engine.put(local_path, "small")
+        self.assertTrue(self.engine.transfers[-1].skipped)
+
+    def test_put_files(self):
+        pairs = [(self.make_file("f%d" % index, 1000), "f%d" % index)
+                 for index in range(10)]
+        self.engine.put_files(pairs)
+        for local_path, remote_path in pairs:
+            self.assertEqual(self.read(os.path.join(self.remote,
+                                                    remote_path)),
+                             self.read(local_path))
+
+    def test_write(self):
+        self.engine.write("written", "some content")
+        self.assertEqual(self.read(os.path.join(self.remote, "written")),
+                         "some content")